@@ -0,0 +1,168 @@
+"""問答結果快取
+
+同一個問題每天會以些微不同的寫法被問很多次 (「血糖高怎麼辦？」、
+「請問血糖高怎麼辦」、「血糖高怎么办」)。normalize_question() 把這些寫法
+化成同一個形式，檢索與快取都以正規化後的問題為準，因此快取結果與重新
+檢索完全一致。
+
+- normalize_question()：全形 / 半形、大小寫、簡體 → 繁體、去除標點與空白、
+  去除開頭的「請問」等客套語與結尾的語助詞
+- AnswerCache：LRU + TTL，以筆數與估計的記憶體用量為上限，記錄命中率
+
+有安裝 opencc 時以 opencc 轉換簡體，否則使用內建的常用字對照表。
+"""
+import re
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+try:
+    from opencc import OpenCC
+except ImportError:
+    OpenCC = None
+
+# 內建的簡 → 繁對照 (健康問答常用字)
+_SIMPLIFIED = (
+    "么吗还这个们为会对说问请题应该样点种类总觉经过没关系开长门见现实无与让给几岁钟针"
+    "剂疗诊断并症状脏肤红绿选择办处预防术惯练习辅导紧张压睡觉频饮运动药胰岛检饭后测记录"
+    "报历发烧头晕饿体营养鱼汤热麦肾脚伤医师时间烟边吃营养标签视网膜变谱减肥胖"
+    "蓝莓苹桥粮杂谷纤维蛋质脂胆固醇盐钠钾钙铁锌维护数值范围标准偏低偏高尽从来这样学将谢"
+)
+_TRADITIONAL = (
+    "麼嗎還這個們為會對說問請題應該樣點種類總覺經過沒關係開長門見現實無與讓給幾歲鐘針"
+    "劑療診斷並症狀臟膚紅綠選擇辦處預防術慣練習輔導緊張壓睡覺頻飲運動藥胰島檢飯後測記錄"
+    "報歷發燒頭暈餓體營養魚湯熱麥腎腳傷醫師時間煙邊吃營養標籤視網膜變譜減肥胖"
+    "藍莓蘋橋糧雜穀纖維蛋質脂膽固醇鹽鈉鉀鈣鐵鋅維護數值範圍標準偏低偏高盡從來這樣學將謝"
+)
+_S2T = str.maketrans(_SIMPLIFIED, _TRADITIONAL)
+
+# 開頭的客套語 / 發語詞與結尾的語助詞，不影響問題的內容
+_PREFIX = re.compile(r"^(?:請問一下|請問|想請問|我想問|問一下|想問|不好意思|你好|您好|哈囉|嗨)+")
+_SUFFIX = re.compile(r"(?:謝謝您|謝謝你|謝謝|嗎|呢|啊|呀|喔|哦|吧|耶)+$")
+# 標點與符號 (Unicode 類別 P*、S*)
+_STRIP_CATEGORIES = ("P", "S")
+# 只保留英數字之間的空白 ("blood sugar")
+_SPACE = re.compile(r"\s+(?![a-z0-9])|(?<![a-z0-9])\s+")
+
+
+class _Converter:
+    """簡 → 繁轉換；opencc 延後到第一次使用時才建立"""
+
+    def __init__(self):
+        self._opencc = None
+
+    def __call__(self, text):
+        if OpenCC is None:
+            return text.translate(_S2T)
+        if self._opencc is None:
+            self._opencc = OpenCC("s2twp")
+        return self._opencc.convert(text)
+
+
+to_traditional = _Converter()
+
+
+def normalize_question(text):
+    """問題 → 正規化形式 (快取鍵，也是實際拿去檢索的文字)"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = to_traditional(text)
+    text = "".join(
+        char for char in text
+        if unicodedata.category(char)[0] not in _STRIP_CATEGORIES
+    )
+    text = _SPACE.sub("", " ".join(text.split()))
+    stripped = _SUFFIX.sub("", _PREFIX.sub("", text))
+    # 整句都是客套語 (如「你好」) 時保留原字
+    return stripped or text
+
+
+class AnswerCache:
+    """LRU + TTL 的回覆快取 (執行緒安全)
+
+    空字串也會被快取，代表「知識庫中沒有答案」，同樣省下一次檢索。
+    記憶體用量以 sys.getsizeof 估計鍵與值的大小。
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024, ttl=3600, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()   # 鍵 → (值, 到期時間, 大小)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def get(self, key):
+        """取得快取的值；沒有或已過期時回傳 None"""
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires, size = entry
+            if expires <= now:
+                del self._entries[key]
+                self._bytes -= size
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def sizeof(self, key, value):
+        """估計一筆快取的記憶體用量 (值不是字串時由子類別改寫)"""
+        return sys.getsizeof(key) + sys.getsizeof(value)
+
+    def put(self, key, value):
+        size = self.sizeof(key, value)
+        if size > self.max_bytes:
+            return
+        expires = self.clock() + self.ttl
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (value, expires, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evicted += 1
+
+    def get_or_compute(self, key, compute):
+        """快取中沒有時呼叫 compute() 並存入"""
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """命中率與用量 (用來調整上限與 TTL)"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
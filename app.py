@@ -1,40 +1,204 @@
-from flask import Flask, request
+from flask import Flask, Response, request, jsonify, abort, stream_with_context
+import argparse
+import atexit
+import functools
+import hmac
+import importlib.machinery
 import json
 import os
+import sys
+import threading
+import time
 from datetime import datetime
-from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage, ImageSendMessage,
     FlexSendMessage, PostbackEvent, PostbackAction,
     QuickReply, QuickReplyButton, MessageAction
 )
+from answer_cache import AnswerCache, normalize_question
+from blood_sugar import MEAL_LABELS, MEAL_UNKNOWN, parse_reading
+from blood_sugar_io import (
+    FORMATS, export_readings, import_readings, iter_text_lines
+)
+from charts import ChartCache, ChartRenderer
+from dispatcher import EventDispatcher, QueuedDispatcher
+from event_dedup import EventDeduplicator
+from glucometer_ocr import GlucometerAnalyzer, available as ocr_available
+from image_pipeline import AnalysisResult, ImagePipeline, ResultCache, load_analyzer, push_result
+from knowledge import format_answer, load_encoder
+from knowledge_index import KnowledgeIndex, build_index
+from line_client import get_line_clients
+from message_templates import TemplateRegistry, reply_message
+import metrics
+from onboarding import (
+    ONBOARDING, NEW, AGREED, FOLLOW, MEDIA, IMAGE, IMAGE_BUSY_REPLY, CREATE_USER, DELETE_USER
+)
+from rate_limit import ALLOW, LIMITED_NOTICE, RATE_LIMITED_REPLY, RateLimiter
+from reports import DAY_MS, UTC_OFFSET_MS, Report, ReportEngine, day_of, format_report
+from structured_log import configure as configure_logging, get_logger, parse_sample_rates
+from transcription import (
+    CHUNK_SIZE as VOICE_CHUNK_SIZE, DEFAULT_LANGUAGE, LANGUAGES, LiffTokenVerifier,
+    TranscriptionService, load_recognizer
+)
+from user_store import create_user_store
+from webhook import parse_events, verify_signature
 
 app = Flask(__name__)
 
-# 用戶數據文件路徑
-USER_DATA_FILE = "user_data.json"
+# 日誌：JSON lines，由背景執行緒寫到 stdout，不佔用請求的時間
+# user_id 以代號記錄、訊息內容只留字數；LOG_CONTENT=1 保留內容 (僅供本機除錯)，
+# LOG_CONTENT_USERS (逗號分隔) 指定保留內容的用戶 (如測試帳號)
+# LOG_SAMPLE 設定高流量事件的取樣率，如 "message_received=0.1,reply=0.1"
+log_handler = configure_logging(
+    level=os.environ.get('LOG_LEVEL', 'INFO'),
+    sample_rates=parse_sample_rates(os.environ.get('LOG_SAMPLE')),
+    redact_key=(os.environ.get('LOG_REDACT_KEY') or os.environ.get('LINE_CHANNEL_SECRET', '')).encode('utf-8'),
+    log_content=os.environ.get('LOG_CONTENT') == '1',
+    content_users=[user for user in os.environ.get('LOG_CONTENT_USERS', '').split(',') if user]
+)
+log = get_logger("app")
 
-def load_user_data():
-    """載入用戶數據"""
-    if os.path.exists(USER_DATA_FILE):
-        try:
-            with open(USER_DATA_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return {}
-    return {}
-
-def save_user_data(data):
-    """保存用戶數據"""
-    try:
-        with open(USER_DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"保存用戶數據失敗: {e}")
+# 指標：METRICS_ENABLED=1 時記錄各階段耗時並由 /metrics 提供 (Prometheus 文字格式)
+# 未啟用時計時只檢查一個旗標；METRICS_DIR 設定時合併所有 gunicorn worker 的數值
+metrics.REGISTRY.configure(
+    os.environ.get('METRICS_ENABLED') == '1',
+    directory=os.environ.get('METRICS_DIR'),
+    flush_interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+)
+STAGE_SECONDS = metrics.histogram(
+    "linebot_stage_seconds", "webhook 各階段耗時 (秒)", ("stage",))
+EVENT_SECONDS = metrics.histogram(
+    "linebot_event_seconds", "單一事件的處理耗時 (秒，不含等待用戶鎖)", ("event_type", "state"))
+WEBHOOK_REQUESTS = metrics.counter(
+    "linebot_requests_total", "webhook 請求數", ("result",))
+DUPLICATE_EVENTS = metrics.counter(
+    "linebot_duplicate_events_total", "已處理過而略過的重送事件數", ("event_type",))
+THROTTLED_EVENTS = metrics.counter(
+    "linebot_throttled_events_total", "限流或合併而略過的訊息數", ("reason",))
+
+@app.before_request
+def start_metrics_flusher():
+    # fork 後的 worker 在第一個請求時啟動自己的寫檔執行緒
+    metrics.REGISTRY.start_flusher()
+
+# 數據文件路徑：預設放在目前目錄，DATA_DIR 可指定其他目錄 (例如持久化的 volume)
+DATA_DIR = os.environ.get('DATA_DIR', "")
+USER_DATA_FILE = os.path.join(DATA_DIR, "user_data.json")
+USER_JOURNAL_FILE = os.path.join(DATA_DIR, "user_data.journal")
+USER_DB_FILE = os.environ.get('USER_DB_FILE', os.path.join(DATA_DIR, "user_data.db"))
+# 重送事件去重的紀錄表 (所有 worker 共用，第一次收到事件時才建立)
+EVENT_DEDUP_FILE = os.environ.get('EVENT_DEDUP_FILE', os.path.join(DATA_DIR, "webhook_events.dedup"))
+
+# 用戶存儲後端：json (預設，相容 user_data.json) 或 sqlite
+user_store = create_user_store(
+    os.environ.get('USER_STORE_BACKEND', 'json'),
+    USER_DATA_FILE,
+    journal_path=USER_JOURNAL_FILE,
+    db_path=USER_DB_FILE,
+    fsync=os.environ.get('USER_DATA_FSYNC') == '1'
+)
+
+# 同批次事件：同一用戶依序、不同用戶並行處理
+# WEBHOOK_ASYNC=1 時事件放入佇列後立即回應，由背景 worker 處理
+if os.environ.get('WEBHOOK_ASYNC') == '1':
+    event_dispatcher = QueuedDispatcher(
+        workers=int(os.environ.get('EVENT_WORKERS', 8)),
+        queue_size=int(os.environ.get('EVENT_QUEUE_SIZE', 1000))
+    )
+else:
+    event_dispatcher = EventDispatcher(int(os.environ.get('EVENT_WORKERS', 8)))
+# 關閉 (gunicorn 收到 SIGTERM) 時先把佇列中的事件處理完
+atexit.register(event_dispatcher.shutdown)
+
+# 重送事件去重：EVENT_DEDUP_WINDOW 秒內已處理完成的 webhookEventId 再次重送時略過；
+# 處理中的事件在 EVENT_DEDUP_LEASE 秒內的重送也略過，超過時由重送的事件接手，
+# 處理失敗的事件不記錄 (重送時再處理)
+# 紀錄放在 EVENT_DEDUP_FILE (大小固定為 EVENT_DEDUP_SLOTS × 16 bytes)
+# EVENT_DEDUP_SLOTS=0 時停用
+EVENT_DEDUP_SLOTS = int(os.environ.get('EVENT_DEDUP_SLOTS', 1 << 20))
+event_dedup = None
+if EVENT_DEDUP_SLOTS > 0:
+    event_dedup = EventDeduplicator(
+        EVENT_DEDUP_FILE,
+        slots=EVENT_DEDUP_SLOTS,
+        window=float(os.environ.get('EVENT_DEDUP_WINDOW', 24 * 3600)),
+        lease=float(os.environ.get('EVENT_DEDUP_LEASE', 60))
+    )
+
+# 訊息限流：每位用戶每分鐘 RATE_LIMIT_PER_MINUTE 則 (最多連續 RATE_LIMIT_BURST 則)，
+# 超過時略過並回覆一次提醒；RATE_LIMIT_COALESCE 秒內重複的相同文字只處理第一則
+# 只計算正常使用 (AGREED) 狀態的文字訊息，引導流程的快速回覆、貼圖與 postback 不計
+# RATE_LIMIT_PER_MINUTE=0 時停用
+RATE_LIMIT_PER_MINUTE = float(os.environ.get('RATE_LIMIT_PER_MINUTE', 30))
+rate_limiter = None
+if RATE_LIMIT_PER_MINUTE > 0:
+    rate_limiter = RateLimiter(
+        per_minute=RATE_LIMIT_PER_MINUTE,
+        burst=int(os.environ.get('RATE_LIMIT_BURST', 10)),
+        coalesce=float(os.environ.get('RATE_LIMIT_COALESCE', 10)),
+        max_users=int(os.environ.get('RATE_LIMIT_USERS', 100000))
+    )
+
+# 啟動時建立共用的 LINE 用戶端 (fork 後各 worker 會自動重建)
+get_line_clients()
+
+# 報表趨勢圖：PUBLIC_BASE_URL 為本服務對外的 https 網址，未設定時只回覆文字報表
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', '').rstrip('/')
+CHART_DAYS = 14
+CHART_TIMEOUT = float(os.environ.get('CHART_TIMEOUT', 10))
+chart_renderer = ChartRenderer(int(os.environ.get('CHART_PROCESSES', 2)))
+chart_cache = ChartCache(
+    os.environ.get('CHART_CACHE_DIR', "chart_cache"),
+    (os.environ.get('CHART_URL_SECRET') or os.environ.get('LINE_CHANNEL_SECRET', '')).encode('utf-8')
+)
+atexit.register(chart_renderer.shutdown)
+
+# 問答結果快取 (以正規化後的問題為鍵，含「找不到答案」的結果)
+answer_cache = AnswerCache(
+    max_entries=int(os.environ.get('ANSWER_CACHE_ENTRIES', 10000)),
+    max_bytes=int(os.environ.get('ANSWER_CACHE_MB', 16)) * 1024 * 1024,
+    ttl=float(os.environ.get('ANSWER_CACHE_TTL', 3600))
+)
+
+# 糖尿病知識庫：以 python app.py build-knowledge 離線建立索引檔，worker 第一次
+# 查詢時才以 mmap 開啟，CURRENT 換版時自動切換並清除問答快取
+# KNOWLEDGE_ENCODER ("模組:函式") 設定時，建立索引與查詢都加上向量檢索
+KNOWLEDGE_DIR = os.environ.get(
+    'KNOWLEDGE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge"))
+KNOWLEDGE_INDEX_DIR = os.environ.get('KNOWLEDGE_INDEX_DIR', "knowledge_index")
+KNOWLEDGE_ENCODER = os.environ.get('KNOWLEDGE_ENCODER')
+knowledge_base = KnowledgeIndex(
+    KNOWLEDGE_INDEX_DIR,
+    source_dir=KNOWLEDGE_DIR,
+    encoder=load_encoder(KNOWLEDGE_ENCODER) if KNOWLEDGE_ENCODER else None,
+    check_interval=float(os.environ.get('KNOWLEDGE_CHECK_INTERVAL', 30)),
+    on_reload=answer_cache.clear
+)
+
+# 語音轉文字 (LIFF 錄音頁面)：SPEECH_RECOGNIZER 未設定時停用 /voice/transcribe
+# 上傳須帶 LIFF access token，由 LIFF_CHANNEL_ID (LIFF 所屬的 LINE Login channel)
+# 驗證；未設定 LIFF_CHANNEL_ID 時無從驗證，/voice/transcribe 同樣停用
+SPEECH_RECOGNIZER = os.environ.get('SPEECH_RECOGNIZER')
+transcription = None
+if SPEECH_RECOGNIZER:
+    transcription = TranscriptionService(
+        load_recognizer(SPEECH_RECOGNIZER),
+        max_streams=int(os.environ.get('VOICE_MAX_STREAMS', 4)),
+        max_bytes=int(os.environ.get('VOICE_MAX_MB', 10)) * 1024 * 1024,
+        max_seconds=float(os.environ.get('VOICE_MAX_SECONDS', 300)),
+        read_timeout=float(os.environ.get('VOICE_READ_TIMEOUT', 15))
+    )
+LIFF_CHANNEL_ID = os.environ.get('LIFF_CHANNEL_ID')
+liff_verifier = LiffTokenVerifier(LIFF_CHANNEL_ID) if LIFF_CHANNEL_ID else None
+if transcription is not None and liff_verifier is None:
+    log.warning("voice_disabled", reason="LIFF_CHANNEL_ID not set")
 
-# 載入用戶同意狀態
-user_consent = load_user_data()
+def new_user_record():
+    """建立新用戶的初始記錄"""
+    return {
+        "status": "pending",
+        "first_contact": datetime.now().isoformat()
+    }
 
 def create_terms_flex_message():
     """創建專業的用戶條款 Flex Message"""
@@ -1035,213 +1199,589 @@ def create_main_welcome_message():
         }
     }
 
+# 固定內容的訊息在啟動時建立、驗證並預先序列化一次，回覆時只引用樣板
+templates = TemplateRegistry()
+templates.register("terms", create_terms_flex_message)
+templates.register("welcome", create_welcome_message)
+templates.register("button_check", create_button_check_message)
+templates.register("tutorial_choice", create_tutorial_choice_message)
+templates.register("tutorial", create_tutorial_carousel)
+templates.register("qa_tutorial", create_qa_tutorial_carousel)
+templates.register("voice_tutorial", create_voice_tutorial_carousel)
+templates.register("blood_sugar_tutorial", create_blood_sugar_tutorial_carousel)
+templates.register("image_tutorial", create_image_tutorial_carousel)
+templates.register("skip_tutorial", create_skip_tutorial_message)
+templates.register("main_welcome", create_main_welcome_message)
+
+def blood_sugar_reply(mg_dl, meal):
+    """血糖記錄完成的回覆"""
+    label = f"（{MEAL_LABELS[meal]}）" if meal else ""
+    if mg_dl < 70:
+        note = "⚠️ 數值偏低，請留意是否有低血糖症狀，必要時補充糖分。"
+    elif mg_dl > 180:
+        note = "⚠️ 數值偏高，請留意飲食並持續追蹤。"
+    else:
+        note = "👍 數值在一般建議範圍內，繼續保持！"
+    return f"✅ 已記錄血糖 {mg_dl} mg/dL{label}\n\n{note}\n\n輸入「報表」可查看歷史記錄。"
+
+def handle_agreed_message(line_bot_api, event, user_id, tk, msg):
+    """正常使用狀態的文字訊息：血糖數值 → 記錄，其他 → 知識庫問答；回傳 False 表示未處理"""
+    reading = parse_reading(msg)
+    if reading is None:
+        return answer_question(line_bot_api, tk, msg, user_id)
+    mg_dl, meal = reading
+    timestamp = event.timestamp or int(time.time() * 1000)
+    user_store.append_blood_sugar(user_id, timestamp, mg_dl, meal)
+    reply = blood_sugar_reply(mg_dl, meal)
+    log.info("reply", user_id=user_id, kind="blood_sugar", text=reply)
+    reply_message(line_bot_api, tk, TextSendMessage(reply))
+    return True
+
+def lookup_answer(question):
+    """正規化後的問題 → 回覆文字；知識庫中沒有答案時為空字串"""
+    hits = knowledge_base.answer(question)
+    return format_answer(hits) if hits else ""
+
+def answer_question(line_bot_api, tk, msg, user_id=None):
+    """以知識庫中最相關的段落回覆；找不到相關段落時回傳 False"""
+    question = normalize_question(msg)
+    reply = answer_cache.get_or_compute(question, lambda: lookup_answer(question))
+    if not reply:
+        return False
+    log.info("reply", user_id=user_id, kind="answer", text=reply)
+    reply_message(line_bot_api, tk, TextSendMessage(reply))
+    return True
+
+# 各用戶的每日彙總 (每個 worker 記憶體中的 LRU)：快取命中時報表只需走訪天數，
+# 未命中 (重新啟動、另一個 worker) 時第一次報表會重新併入所有記錄
+report_engine = ReportEngine()
+
+# 本 worker 繪製中的圖：名稱 → Future (同一張圖同時只繪一次)
+chart_pending = {}
+chart_pending_lock = threading.Lock()
+
+def render_chart(name, args):
+    """在行程池繪圖，完成後寫入快取；回傳 Future"""
+    with chart_pending_lock:
+        future = chart_pending.get(name)
+        if future is None:
+            future = chart_pending[name] = chart_renderer.submit(*args)
+            future.add_done_callback(functools.partial(chart_rendered, name))
+    return future
+
+def chart_rendered(name, future):
+    with chart_pending_lock:
+        chart_pending.pop(name, None)
+    try:
+        chart_cache.put(name, future.result())
+    except Exception as e:
+        log.warning("chart_failed", chart=name, error=repr(e))
+
+def chart_message(user_id, series, rollup, today):
+    """近 CHART_DAYS 天的趨勢圖 ImageSendMessage；沒有可畫的記錄時回傳 None
+
+    以 (用戶, 日期範圍, 記錄筆數) 為快取鍵，記錄沒有變動時直接使用快取的圖。
+    不等待繪圖：記下繪圖參數並在背景繪製，LINE 取圖時還沒繪好則由
+    /charts 依參數繪製 (在用戶鎖與 webhook 之外)。
+    """
+    if not PUBLIC_BASE_URL or not len(series):
+        return None
+    start_day = today - CHART_DAYS + 1
+    version = f"{len(series)}-{series.timestamps[0]}"
+    name = chart_cache.name(user_id, start_day, today, version)
+    if chart_cache.get(name) is None:
+        recent = series.since(start_day * DAY_MS - UTC_OFFSET_MS)
+        readings = list(zip(recent.timestamps, recent.mg_dl))
+        if not readings:
+            return None
+        daily = [(day, rollup.days[day].mean)
+                 for day in range(start_day, today + 1) if day in rollup.days]
+        args = (readings, daily, start_day, today, UTC_OFFSET_MS)
+        chart_cache.put_job(name, args)
+        try:
+            render_chart(name, args)
+        except Exception as e:
+            # 行程池無法使用時，仍可由 /charts 取圖時重試
+            log.warning("chart_failed", user_id=user_id, error=repr(e))
+    url = f"{PUBLIC_BASE_URL}/charts/{name}.png"
+    return ImageSendMessage(original_content_url=url, preview_image_url=url)
+
+def handle_blood_sugar_report(line_bot_api, event, user_id, tk, msg):
+    """「報表」/「歷史」/「記錄」：回覆趨勢圖與近 7 / 30 天的血糖統計"""
+    now_ms = event.timestamp or int(time.time() * 1000)
+    series = user_store.get_blood_sugar(user_id)
+    rollup = report_engine.rollup(user_id, series)
+    today = day_of(now_ms)
+    reply = format_report(Report(rollup, today))
+    if reply is None:
+        reply = "目前還沒有近 30 天的血糖記錄喔！\n\n直接輸入數值即可記錄，例如：120、150mg/dL 或 早餐後血糖 140"
+        messages = [TextSendMessage(reply)]
+    else:
+        chart = chart_message(user_id, series, rollup, today)
+        messages = [TextSendMessage(reply)] if chart is None else [chart, TextSendMessage(reply)]
+    log.info("reply", user_id=user_id, kind="report", text=reply)
+    reply_message(line_bot_api, tk, messages)
+    return True
+
+# 圖片分析：收到圖片先以 reply 回覆「分析中」，下載與分析在背景進行，完成後以 push 推送結果
+# - IMAGE_OCR=1 時 (須另外安裝 Pillow 與 numpy，不在 requirements.txt 中)，先在本機
+#   讀取血糖機螢幕的數字，讀到時直接記錄；信心不足才交給 IMAGE_ANALYZER 設定的完整分析器。
+#   辨識在每個 worker 的 IMAGE_OCR_PROCESSES 個子行程中進行，不佔用 webhook 行程的 CPU
+# - 兩者都沒有時，圖片訊息仍回覆「多媒體功能整合中」
+# - 分析結果以 (用戶, 圖片內容雜湊) 快取 (IMAGE_CACHE_ENTRIES=0 時停用)，同一用戶重傳的照片不再分析
+IMAGE_ANALYZER = os.environ.get('IMAGE_ANALYZER')
+IMAGE_CACHE_ENTRIES = int(os.environ.get('IMAGE_CACHE_ENTRIES', 2000))
+image_analyzer = load_analyzer(IMAGE_ANALYZER)
+if os.environ.get('IMAGE_OCR', '0') == '1':
+    if ocr_available():
+        image_analyzer = GlucometerAnalyzer(
+            image_analyzer,
+            min_confidence=float(os.environ.get('IMAGE_OCR_MIN_CONFIDENCE', 0.5)),
+            processes=int(os.environ.get('IMAGE_OCR_PROCESSES', 1))
+        )
+        atexit.register(image_analyzer.shutdown)
+    else:
+        log.warning("image_ocr_unavailable", reason="IMAGE_OCR=1 需要 Pillow 與 numpy")
+
+def deliver_image_result(line_bot_api, user_id, result, timestamp):
+    """推送圖片分析結果；讀到血糖數值時以傳送照片的時間寫入記錄 (同一張照片重傳時不重複記錄)"""
+    if result.reading is not None:
+        if result.duplicate:
+            text = f"📷 這張照片的血糖數值 ({result.reading} mg/dL) 先前已辨識過，不重複記錄。"
+        else:
+            with user_store.lock(user_id):
+                user_store.append_blood_sugar(user_id, timestamp or int(time.time() * 1000),
+                                              result.reading, MEAL_UNKNOWN)
+            text = "📷 " + blood_sugar_reply(result.reading, MEAL_UNKNOWN)
+        result = AnalysisResult(result.kind, text, result.reading)
+    log.info("push", user_id=user_id, kind=result.kind, text=result.text)
+    push_result(line_bot_api, user_id, result)
+
+image_pipeline = None
+if image_analyzer is not None:
+    image_pipeline = ImagePipeline(
+        image_analyzer,
+        workers=int(os.environ.get('IMAGE_WORKERS', 2)),
+        queue_size=int(os.environ.get('IMAGE_QUEUE_SIZE', 50)),
+        max_bytes=int(os.environ.get('IMAGE_MAX_MB', 10)) * 1024 * 1024,
+        deliver=deliver_image_result,
+        cache=ResultCache(
+            max_entries=IMAGE_CACHE_ENTRIES,
+            max_bytes=int(os.environ.get('IMAGE_CACHE_MB', 4)) * 1024 * 1024,
+            ttl=float(os.environ.get('IMAGE_CACHE_TTL', 86400))
+        ) if IMAGE_CACHE_ENTRIES > 0 else None
+    )
+    atexit.register(image_pipeline.shutdown)
+
+def handle_image_message(line_bot_api, event, user_id, tk, msg):
+    """圖片訊息：排入背景分析並回覆「分析中」；未啟用圖片分析時不處理"""
+    if image_pipeline is None:
+        return False
+    if image_pipeline.submit(line_bot_api, user_id, event.message_id, event.timestamp):
+        reply = "📷 收到照片，分析中，請稍候…"
+    else:
+        reply = IMAGE_BUSY_REPLY
+    log.info("reply", user_id=user_id, kind="image", text=reply)
+    reply_message(line_bot_api, tk, TextSendMessage(reply))
+    return True
+
+# 轉移表中 handler 名稱 → 處理函式
+HANDLERS = {
+    "agreed_message": handle_agreed_message,
+    "blood_sugar_report": handle_blood_sugar_report,
+    "image_message": handle_image_message,
+}
+
+# 啟動時檢查轉移表：目標狀態、樣板與處理函式都已定義
+ONBOARDING.validate(templates.names(), HANDLERS)
+
+def event_signal(event):
+    """把事件轉成狀態機的輸入：文字訊息為文字本身，其餘為 Signal；不處理的事件回傳 None"""
+    if event.type == 'follow':
+        return FOLLOW
+    if event.type == 'message':
+        if event.message_type == 'text':
+            return event.text
+        if event.message_type == 'image':
+            return IMAGE
+        return MEDIA
+    # 其他事件類型 (unfollow, postback 等)
+    return None
+
+def event_label(event):
+    """指標用的事件類型 ("follow"、"message/text"…)"""
+    if event.type == 'message':
+        return f"message/{event.message_type}"
+    return event.type
+
+def is_throttled(line_bot_api, event, user_id, tk, text):
+    """限流或合併而略過的文字訊息 (剛開始被限流時回覆一次提醒)"""
+    if rate_limiter is None:
+        return False
+    decision = rate_limiter.check(user_id, text)
+    if decision == ALLOW:
+        return False
+    log.info("event_throttled", user_id=user_id, event_type=event_label(event), reason=decision)
+    THROTTLED_EVENTS.inc(decision)
+    if decision == LIMITED_NOTICE:
+        reply_message(line_bot_api, tk, TextSendMessage(RATE_LIMITED_REPLY))
+    return True
+
+def handle_event(line_bot_api, event, user_id, tk):
+    """處理單一事件 (呼叫端須持有該用戶的鎖)，回傳處理時的用戶狀態 (指標用)"""
+    signal = event_signal(event)
+    if signal is None:
+        return None
+
+    # 加好友、多媒體訊息與用戶狀態無關，不必讀取用戶記錄
+    transition = ONBOARDING.global_transition(signal)
+    new_state = None
+    state = "*"
+    if transition is None:
+        if isinstance(signal, str):
+            log.info("message_received", user_id=user_id, event_type=event_label(event), text=signal)
+        else:
+            log.info("message_received", user_id=user_id, event_type=event_label(event), signal=signal.name)
+        with STAGE_SECONDS.time("state_lookup"):
+            user = user_store.get(user_id)
+        state = user.get("status") if user else NEW
+        transition, new_state = ONBOARDING.resolve(state, signal)
+        if transition is None:
+            log.warning("unknown_state", user_id=user_id, state=state)
+            return state
+        # 限流在處理與回覆之前判斷，略過的訊息不寫入用戶數據；
+        # 只計正常使用狀態的文字訊息 (引導流程中的快速回覆不計)
+        if state == AGREED and isinstance(signal, str):
+            if is_throttled(line_bot_api, event, user_id, tk, signal):
+                return state
+
+    # 處理函式會自行回覆；未處理時才使用轉移表上的回覆
+    started = time.perf_counter()
+    handled = False
+    if transition.handler is not None:
+        handled = HANDLERS[transition.handler](line_bot_api, event, user_id, tk, signal)
+    if not handled:
+        if transition.templates:
+            reply_message(line_bot_api, tk, [templates[name] for name in transition.templates])
+        elif transition.text is not None:
+            log.info("reply", user_id=user_id, kind="transition", text=transition.text)
+            reply_message(line_bot_api, tk, TextSendMessage(transition.text))
+    STAGE_SECONDS.observe(time.perf_counter() - started, "reply")
+
+    started = time.perf_counter()
+    if transition.action == CREATE_USER:
+        # 重新加好友時與新用戶相同，清除先前的血糖記錄
+        user_store.create(user_id, new_user_record())
+        report_engine.forget(user_id)
+    elif transition.action == DELETE_USER:
+        user_store.delete(user_id)
+        report_engine.forget(user_id)
+    elif new_state is not None:
+        fields = {transition.stamp: datetime.now().isoformat()} if transition.stamp else {}
+        user_store.update_status(user_id, new_state, **fields)
+    else:
+        return state
+    STAGE_SECONDS.observe(time.perf_counter() - started, "persist")
+    return state
+
+def process_event(line_bot_api, event):
+    """處理單一事件：取得該用戶的鎖後交給 handle_event"""
+    event_type = event.type
+    user_id = event.user_id  # 使用者 ID
+    if not user_id:
+        log.info("event_ignored", event_type=event_type, reason="no_user_id")
+        return
+
+    # 某些事件沒有 replyToken (如 unfollow)
+    tk = event.reply_token
+    if not tk:
+        log.info("event_ignored", user_id=user_id, event_type=event_type, reason="no_reply_token")
+        return
+
+    with user_store.lock(user_id):
+        started = time.perf_counter()
+        state = "error"
+        try:
+            state = handle_event(line_bot_api, event, user_id, tk) or "-"
+        finally:
+            EVENT_SECONDS.observe(time.perf_counter() - started, event_label(event), state)
+
+def handle_webhook_event(line_bot_api, event):
+    """處理事件並更新去重紀錄：成功才記為已處理，失敗時移除紀錄讓 LINE 重送時再處理"""
+    try:
+        process_event(line_bot_api, event)
+    except Exception:
+        event_dedup.release(event)
+        raise
+    event_dedup.complete(event)
+
+def is_duplicate(event):
+    """已處理過 (或另一個 worker 正在處理) 的重送事件 (同一 webhookEventId)"""
+    if not event_dedup.is_duplicate(event):
+        return False
+    log.info("event_duplicate", user_id=event.user_id, event_type=event.type,
+             webhook_event_id=event.webhook_event_id)
+    DUPLICATE_EVENTS.inc(event_label(event))
+    return True
+
 @app.route("/callback", methods=['POST'])
 def linebot():
-    body = request.get_data(as_text=True)
+    started = time.perf_counter()
+    body = request.get_data()
+    clients = get_line_clients()
+    if clients is None:
+        log.error("line_credentials_missing")
+        WEBHOOK_REQUESTS.inc("unconfigured")
+        return "OK"
+
+    # 對原始位元組驗證一次簽章，驗證失敗的請求不解析
+    signature = request.headers.get('X-Line-Signature')
+    with STAGE_SECONDS.time("signature"):
+        verified = verify_signature(clients.channel_secret, body, signature)
+    if not verified:
+        log.warning("invalid_signature", bytes=len(body))
+        WEBHOOK_REQUESTS.inc("invalid_signature")
+        abort(400)
+
+    # 內容不是 JSON 時回應 400；不是物件或沒有 events 時 parse_events 回傳空列表
     try:
-        json_data = json.loads(body)
-        access_token = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
-        secret = os.environ.get('LINE_CHANNEL_SECRET')
-        
-        if not access_token or not secret:
-            print("錯誤: LINE_CHANNEL_ACCESS_TOKEN 或 LINE_CHANNEL_SECRET 環境變數未設定")
-            return
-        line_bot_api = LineBotApi(access_token)
-        handler = WebhookHandler(secret)
-        signature = request.headers['X-Line-Signature']
-        handler.handle(body, signature)
-
-        event = json_data['events'][0]
-        event_type = event['type']
-        user_id = event['source']['userId']  # 使用者 ID
-        
-        # 某些事件沒有 replyToken (如 unfollow)
-        tk = event.get('replyToken')
-        if not tk:
-            print(f"事件類型 {event_type} 沒有 replyToken，忽略")
-            return "OK"
-        
-        # 處理加好友事件
-        if event_type == 'follow':
-            # 新用戶加入 → 發送專業的條款頁面
-            flex_message = create_terms_flex_message()
-            line_bot_api.reply_message(tk, FlexSendMessage(
-                alt_text=flex_message["altText"],
-                contents=flex_message["contents"]
-            ))
-            user_consent[user_id] = {
-                "status": "pending",
-                "first_contact": datetime.now().isoformat(),
-                "blood_sugar_records": []
-            }
-            save_user_data(user_consent)
-            return
-
-        elif event_type == 'message':
-            msg_type = event['message']['type']
-            if msg_type == 'text':
-                msg = event['message']['text']
-                print(f"收到: {msg}")
-
-                # 檢查是否已經同意
-                if user_id not in user_consent:
-                    # 新用戶 → 發送專業的條款頁面
-                    flex_message = create_terms_flex_message()
-                    line_bot_api.reply_message(tk, FlexSendMessage(
-                        alt_text=flex_message["altText"],
-                        contents=flex_message["contents"]
-                    ))
-                    user_consent[user_id] = {
-                        "status": "pending",
-                        "first_contact": datetime.now().isoformat(),
-                        "blood_sugar_records": []
-                    }
-                    save_user_data(user_consent)
-                    return
-
-                elif user_consent[user_id].get("status") == "pending":
-                    # 等待用戶回覆
-                    if msg == "同意":
-                        # 發送條款完成訊息 + 直接發送按鈕確認訊息
-                        welcome_message = create_welcome_message()
-                        button_check_message = create_button_check_message()
-                        
-                        # 發送兩條訊息：條款完成 + 按鈕確認
-                        line_bot_api.reply_message(tk, [
-                            FlexSendMessage(
-                                alt_text=welcome_message["altText"],
-                                contents=welcome_message["contents"]
-                            ),
-                            button_check_message
-                        ])
-                        
-                        user_consent[user_id]["status"] = "awaiting_button_response"  # 直接設為等待按鈕回應
-                        user_consent[user_id]["agreed_time"] = datetime.now().isoformat()
-                        save_user_data(user_consent)
-                        return
-                    elif msg == "不同意":
-                        reply = "感謝您的回覆。如果您改變心意，歡迎隨時重新開始對話。\n\n為了保護您的隱私，我們將不會保存任何資料。"
-                        user_consent[user_id]["status"] = "disagreed"
-                        user_consent[user_id]["disagreed_time"] = datetime.now().isoformat()
-                        save_user_data(user_consent)
-                    else:
-                        reply = "請點選條款頁面中的「同意並開始使用」或「暫不同意」按鈕，或直接回覆「同意」或「不同意」。"
-
-                elif user_consent[user_id].get("status") == "awaiting_button_response":
-                    # 處理按鈕確認回應
-                    if msg == "有":
-                        # 用戶看到按鈕了，詢問是否要教學
-                        tutorial_choice_message = create_tutorial_choice_message()
-                        line_bot_api.reply_message(tk, tutorial_choice_message)
-                        user_consent[user_id]["status"] = "awaiting_tutorial_choice"
-                        save_user_data(user_consent)
-                        return
-                    elif msg == "沒有":
-                        # 用戶沒看到按鈕，提供說明
-                        reply = "沒關係！我們來說明一下：\n\n在我的訊息下方，您會看到一些按鈕，這些按鈕可以幫助您快速選擇回應。\n\n如果您現在看到了，請回覆「有」；如果還是沒看到，請回覆「沒有」。"
-                    else:
-                        reply = "請回覆「有」或「沒有」，讓我知道您是否看到下面的按鈕。"
-
-                elif user_consent[user_id].get("status") == "awaiting_tutorial_choice":
-                    # 處理教學選擇回應
-                    if msg == "我要教學":
-                        # 發送5頁功能介紹carousel
-                        tutorial_carousel = create_tutorial_carousel()
-                        line_bot_api.reply_message(tk, FlexSendMessage(
-                            alt_text=tutorial_carousel["altText"],
-                            contents=tutorial_carousel["contents"]
-                        ))
-                        user_consent[user_id]["status"] = "tutorial_shown"
-                        save_user_data(user_consent)
-                        return
-                    elif msg == "我不要教學":
-                        # 發送跳過教學祝福訊息
-                        skip_message = create_skip_tutorial_message()
-                        line_bot_api.reply_message(tk, skip_message)
-                        user_consent[user_id]["status"] = "agreed"  # 直接進入正常使用狀態
-                        save_user_data(user_consent)
-                        return
-                    else:
-                        reply = "請回覆「我要教學」或「我不要教學」，讓我知道您的選擇。"
-
-                elif user_consent[user_id].get("status") == "tutorial_shown":
-                    # 教學已顯示，處理教學相關回應或進入正常功能
-                    if msg in ["問答教學", "語音教學", "血糖教學", "影像教學"]:
-                        # 根據不同的教學選擇發送對應的詳細教學Carousel
-                        tutorial_carousels = {
-                            "問答教學": create_qa_tutorial_carousel(),
-                            "語音教學": create_voice_tutorial_carousel(),
-                            "血糖教學": create_blood_sugar_tutorial_carousel(),
-                            "影像教學": create_image_tutorial_carousel()
-                        }
-                        
-                        selected_carousel = tutorial_carousels[msg]
-                        
-                        # 發送詳細教學Carousel
-                        line_bot_api.reply_message(tk, FlexSendMessage(
-                            alt_text=selected_carousel["altText"],
-                            contents=selected_carousel["contents"]
-                        ))
-                        
-                        user_consent[user_id]["status"] = "detailed_tutorial"  # 設為詳細教學狀態
-                        save_user_data(user_consent)
-                        return
-                    else:
-                        # 其他訊息，更新狀態並繼續處理正常功能邏輯
-                        user_consent[user_id]["status"] = "agreed"
-                        save_user_data(user_consent)
-                
-                elif user_consent[user_id].get("status") == "detailed_tutorial":
-                    # 用戶看完詳細教學，任何訊息都進入正常使用狀態
-                    user_consent[user_id]["status"] = "agreed"
-                    save_user_data(user_consent)
-                    # 繼續處理正常功能邏輯
-
-                else:
-                    # 已經有狀態了
-                    if user_consent[user_id].get("status") == "agreed":
-                        # 用戶已完成引導，準備接收RAG功能
-                        if msg == "教學" or msg == "功能介紹":
-                            # 重新顯示功能介紹carousel
-                            tutorial_carousel = create_tutorial_carousel()
-                            line_bot_api.reply_message(tk, FlexSendMessage(
-                                alt_text=tutorial_carousel["altText"],
-                                contents=tutorial_carousel["contents"]
-                            ))
-                            user_consent[user_id]["status"] = "tutorial_shown"
-                            save_user_data(user_consent)
-                            return
-                        else:
-                            # 其他訊息 - 準備接收RAG功能
-                            reply = f"💬 您好！我是糖小護，您的專屬健康管理助手。\n\n🔧 RAG智能問答系統整合中，敬請期待！\n\n如需重新查看功能介紹，請輸入「教學」。"
-                    elif user_consent[user_id].get("status") == "disagreed":
-                        reply = "由於您尚未同意服務條款，目前無法使用糖小護的功能。\n\n如果您想重新開始，請輸入「重新開始」。"
-                        if msg == "重新開始":
-                            del user_consent[user_id]
-                            save_user_data(user_consent)
-                            flex_message = create_terms_flex_message()
-                            line_bot_api.reply_message(tk, FlexSendMessage(
-                                alt_text=flex_message["altText"],
-                                contents=flex_message["contents"]
-                            ))
-                            return
-            else:
-                reply = "💬 糖小護收到您的訊息！\n\n🔧 多媒體功能整合中，敬請期待！"
-        
-        else:
-            # 其他事件類型 (unfollow, postback 等)
-            return "OK"
+        with STAGE_SECONDS.time("parse"):
+            events = parse_events(body)
+    except ValueError:
+        log.warning("invalid_payload", bytes=len(body))
+        WEBHOOK_REQUESTS.inc("invalid_payload")
+        abort(400)
 
-        print("回覆:", reply)
-        line_bot_api.reply_message(tk, TextSendMessage(reply))
+    result = "ok"
+    try:
+        if event_dedup is not None:
+            with STAGE_SECONDS.time("dedup"):
+                events = [event for event in events if not is_duplicate(event)]
 
-    except Exception as e:
-        print("錯誤:", e)
-        print("收到內容:", body)
-    
+        # 一次 webhook 可能包含多個事件，全部處理
+        # (WEBHOOK_ASYNC=1 時 dispatch 只是排入佇列)
+        with STAGE_SECONDS.time("dispatch"):
+            handle = process_event if event_dedup is None else handle_webhook_event
+            event_dispatcher.dispatch(events, functools.partial(handle, clients.line_bot_api))
+
+    except Exception:
+        # 原始內容含用戶訊息，預設只記錄長度
+        log.exception("webhook_failed", body=body.decode('utf-8', 'replace'))
+        result = "error"
+
+    WEBHOOK_REQUESTS.inc(result)
+    STAGE_SECONDS.observe(time.perf_counter() - started, "request")
     return "OK"
 
+@app.route("/charts/<name>.png", methods=['GET'])
+def chart_image(name):
+    """報表趨勢圖 (LINE 依 ImageSendMessage 的網址來取圖)"""
+    data = chart_cache.get(name)
+    if data is None:
+        # 還沒繪好 (或由其他 worker 繪製中)：依工作檔在此繪製
+        args = chart_cache.get_job(name)
+        if args is None:
+            abort(404)
+        try:
+            data = render_chart(name, args).result(timeout=CHART_TIMEOUT)
+        except Exception as e:
+            log.warning("chart_failed", chart=name, error=repr(e))
+            abort(503)
+    return Response(data, mimetype="image/png", headers={"Cache-Control": "public, max-age=86400"})
+
+def admin_authorized():
+    """管理端點需帶 Authorization: Bearer <ADMIN_TOKEN>；未設定 ADMIN_TOKEN 時停用"""
+    token = os.environ.get('ADMIN_TOKEN')
+    if not token:
+        abort(404)
+    supplied = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(supplied.encode('utf-8'), f"Bearer {token}".encode('utf-8')):
+        abort(401)
+
+def request_format():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in FORMATS:
+        abort(400)
+    return fmt
+
+@app.route("/admin/users/<user_id>/blood-sugar", methods=['POST'])
+def import_blood_sugar(user_id):
+    """串流匯入血糖記錄 (請求內容為 CSV 或 NDJSON)"""
+    admin_authorized()
+    fmt = request_format()
+    chunks = iter(lambda: request.stream.read(64 * 1024), b"")
+    try:
+        result = import_readings(user_store, user_id, iter_text_lines(chunks), fmt)
+    except KeyError:
+        abort(404)
+    return jsonify(result.as_dict())
+
+@app.route("/admin/users/<user_id>/blood-sugar", methods=['GET'])
+def export_blood_sugar(user_id):
+    """串流匯出血糖記錄 (CSV 或 NDJSON)"""
+    admin_authorized()
+    fmt = request_format()
+    if user_store.get(user_id) is None:
+        abort(404)
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(
+        export_readings(user_store, user_id, fmt), mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename=blood_sugar.{fmt}"}
+    )
+
+@app.route("/voice/transcribe", methods=['POST'])
+def transcribe_voice():
+    """LIFF 錄音頁面分塊上傳語音，以 NDJSON 逐行回傳部分與最終的辨識結果
+
+    查詢參數 lang：zh-TW (國語，預設) 或 nan-TW (台語)；
+    Content-Type 為錄音的格式 (如 audio/webm;codecs=opus)，原樣交給辨識器。
+    """
+    if transcription is None or liff_verifier is None:
+        abort(404)
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    clients = get_line_clients()
+    if clients is None or not liff_verifier.verify(clients.line_bot_api, token):
+        abort(401)
+    language = request.args.get('lang', DEFAULT_LANGUAGE)
+    if language not in LANGUAGES:
+        abort(400)
+    if not transcription.acquire():
+        return Response("語音辨識忙碌中，請稍後再試", status=503, headers={"Retry-After": "5"})
+
+    stream = request.stream
+    chunks = iter(lambda: stream.read(VOICE_CHUNK_SIZE), b"")
+    events = transcription.transcribe(chunks, language, request.content_type)
+    lines = (json.dumps(event, ensure_ascii=False).encode('utf-8') + b"\n" for event in events)
+    response = Response(stream_with_context(lines), mimetype="application/x-ndjson",
+                        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"})
+    # 回應結束 (含用戶端中途斷線) 時釋放名額
+    response.call_on_close(transcription.release)
+    return response
+
+@app.route("/voice/stats", methods=['GET'])
+def voice_stats():
+    """語音辨識的同時進行數與處理量 (每個 worker 各自統計)"""
+    if transcription is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(transcription.stats(), enabled=True))
+
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 指標 (METRICS_ENABLED=1 時啟用)；本機以外的連線須帶 ADMIN_TOKEN"""
+    if not metrics.REGISTRY.enabled:
+        abort(404)
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        admin_authorized()
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route("/callback/stats", methods=['GET'])
+def callback_stats():
+    """事件分派的背壓指標 (佇列深度、等待時間、等待空位次數)、重送去重與限流的統計"""
+    stats = event_dispatcher.stats()
+    if event_dedup is not None:
+        stats["dedup"] = event_dedup.stats()
+    if rate_limiter is not None:
+        stats["rate_limit"] = rate_limiter.stats()
+    return jsonify(stats)
+
+@app.route("/logging/stats", methods=['GET'])
+def logging_stats():
+    """日誌佇列的使用量與因佇列滿而丟棄的筆數 (每個 worker 各自統計)"""
+    return jsonify(log_handler.stats())
+
+@app.route("/answers/stats", methods=['GET'])
+def answer_stats():
+    """問答快取的命中率與用量 (每個 worker 各自統計)"""
+    base = knowledge_base.current()
+    return jsonify(dict(answer_cache.stats(), passages=len(base), knowledge_version=base.version))
+
+@app.route("/images/stats", methods=['GET'])
+def image_stats():
+    """圖片分析的處理量與佇列使用量 (每個 worker 各自統計)"""
+    if image_pipeline is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(image_pipeline.stats(), enabled=True))
+
+def guess_format(path, fmt):
+    if fmt:
+        return fmt
+    return "ndjson" if path.endswith((".ndjson", ".jsonl")) else "csv"
+
+def cli_import(args):
+    fmt = guess_format(args.path, args.format)
+    if args.path == "-":
+        f = open(sys.stdin.fileno(), encoding='utf-8-sig', newline='', closefd=False)
+    else:
+        f = open(args.path, encoding='utf-8-sig', newline='')
+    start = time.perf_counter()
+    with f:
+        try:
+            result = import_readings(user_store, args.user_id, f, fmt, batch_size=args.batch_size)
+        except KeyError:
+            sys.exit(f"找不到用戶: {args.user_id}")
+    elapsed = time.perf_counter() - start
+    print(f"匯入 {result.imported} 筆，略過 {result.skipped} 筆，"
+          f"{elapsed:.1f} 秒 ({result.imported / elapsed if elapsed else 0:.0f} 筆/秒)")
+    for error in result.errors:
+        print(error)
+
+def cli_export(args):
+    fmt = guess_format(args.output or "", args.format)
+    if user_store.get(args.user_id) is None:
+        sys.exit(f"找不到用戶: {args.user_id}")
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in export_readings(user_store, args.user_id, fmt):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+
+def cli_build_knowledge(args):
+    spec = args.encoder or KNOWLEDGE_ENCODER
+    encoder = load_encoder(spec) if spec else None
+    result = build_index(args.source, args.output, encoder=encoder, encoder_name=spec, full=args.full)
+    print(result)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="糖小護")
+    sub = parser.add_subparsers(dest="command")
+
+    sub.add_parser("serve", help="啟動 webhook 伺服器 (預設)")
+
+    p = sub.add_parser("import-blood-sugar", help="匯入用戶的血糖記錄 (CSV / NDJSON)")
+    p.add_argument("user_id")
+    p.add_argument("path", help="檔案路徑，- 表示標準輸入")
+    p.add_argument("--format", choices=FORMATS, help="預設依副檔名判斷")
+    p.add_argument("--batch-size", type=int, default=10000)
+    p.set_defaults(func=cli_import)
+
+    p = sub.add_parser("export-blood-sugar", help="匯出用戶的血糖記錄")
+    p.add_argument("user_id")
+    p.add_argument("-o", "--output", help="輸出檔案，預設為標準輸出")
+    p.add_argument("--format", choices=FORMATS, help="預設依副檔名判斷")
+    p.set_defaults(func=cli_export)
+
+    p = sub.add_parser("build-knowledge", help="建立知識庫索引檔 (只重新處理有變動的文件)")
+    p.add_argument("--source", default=KNOWLEDGE_DIR, help="知識庫文件目錄")
+    p.add_argument("--output", default=KNOWLEDGE_INDEX_DIR, help="索引輸出目錄")
+    p.add_argument("--encoder", help="計算向量的函式 (模組:函式)，預設為 KNOWLEDGE_ENCODER")
+    p.add_argument("--full", action="store_true", help="不沿用快取，全部重新處理")
+    p.set_defaults(func=cli_build_knowledge)
+
+    args = parser.parse_args(argv)
+    if args.command in (None, "serve"):
+        port = int(os.environ.get('PORT', 5000))
+        app.run(host='0.0.0.0', port=port)
+        return
+    try:
+        args.func(args)
+    finally:
+        user_store.close()
+
 if __name__ == "__main__":
-    import os
-    port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+    # 繪圖行程池以 spawn 啟動子行程，子行程預設會以 __mp_main__ 重新執行主模組，
+    # 也就是重做 app.py 所有的初始化 (載入用戶數據、背景執行緒、去重表…)。
+    # 以 "__main__" 為名的 spec 讓 multiprocessing 略過這一步 (與 python -m 套件相同)
+    __spec__ = importlib.machinery.ModuleSpec("__main__", None)
+    main()
\ No newline at end of file
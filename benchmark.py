@@ -0,0 +1,697 @@
+"""效能測試工具
+
+用法：
+    python benchmark.py reply-latency [--requests 2000] [--threads 8]
+    python benchmark.py templates [--iterations 2000]
+    python benchmark.py import-export [--rows 10000000] [--backend json]
+    python benchmark.py knowledge [--scale 1] [--queries 20000]
+    python benchmark.py logging [--requests 20000] [--rate 3000] [--write-delay 0.1]
+    python benchmark.py webhook [--users 3000] [--batch 1] [--workers 2] [--concurrency 16]
+
+reply-latency：比較「每次請求都新建 LineBotApi」(舊做法) 與共用連線池
+的回覆延遲 (p50 / p99)。LINE API 以本機的假伺服器代替；若提供
+--certfile / --keyfile 則改用 HTTPS，可一併量到 TLS 交握的成本。
+
+templates：比較每次回覆都重建 Flex 訊息 (create_*() → FlexSendMessage →
+序列化) 與引用預先序列化的樣板，組出回覆內容的時間與記憶體配置量。
+
+import-export：產生 --rows 筆的 CSV，量測串流匯入與匯出的吞吐量，以及
+行程的最大常駐記憶體 (應與筆數無關)。
+
+knowledge：把知識庫文件複製 --scale 份 (模擬較大的知識庫)，比較啟動時在記憶體
+中建立索引與離線建立索引檔 (含只改一份文件的增量重建) 的時間，以及兩者單次
+檢索的延遲 (p50 / p99)。
+
+logging：模擬每個請求記錄 --events 筆日誌，輸出寫到每次 write 需時
+--write-delay 毫秒的慢速 stream (如 gunicorn 下被塞住的 stdout)，比較不記錄、
+同步 print 與背景寫出的結構化日誌的請求延遲 (p50 / p99)，並列出結構化日誌
+因佇列滿而丟棄的筆數。--rate 限制每秒的日誌筆數 (預設 3000)；--rate 0 為全速，
+超過 stream 的寫出速度時結構化日誌會丟棄紀錄而不是拖慢請求。
+
+webhook：在暫存目錄以 gunicorn 啟動本服務，LINE API (回覆、推送、取得照片)
+指向本機的假伺服器，再以簽好章的 webhook 讓 --users 位用戶走完整的流程
+(加入好友、同意條款、教學、記錄血糖、報表、問答、照片、封鎖)；--batch 大於 1
+時一個 webhook 合併多位用戶的事件。每 --round 位用戶回報吞吐量、延遲
+(p50 / p95 / p99) 與 worker 記憶體，最後列出每千位用戶的記憶體增加量。
+其他設定 (USER_STORE_BACKEND、WEBHOOK_ASYNC、IMAGE_ANALYZER、IMAGE_OCR 等) 沿用目前的
+環境變數；日誌預設只記錄 WARNING 以上 (LOG_LEVEL)。
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import resource
+import shutil
+import socket
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from linebot import LineBotApi
+from linebot.models import FlexSendMessage, TextSendMessage
+
+from blood_sugar_io import export_readings, import_readings
+from knowledge import KnowledgeBase, source_files
+from knowledge_index import build_index, current_build, open_index
+from line_client import LineClients
+from message_templates import build_reply_body
+from structured_log import configure as configure_logging, get_logger
+from user_store import create_user_store
+
+
+class FakeLineApiHandler(BaseHTTPRequestHandler):
+    """模擬 LINE Messaging API：任何 POST 都回 200 {}"""
+
+    protocol_version = "HTTP/1.1"  # 支援 keep-alive
+    disable_nagle_algorithm = True
+    wbufsize = 1 << 16             # 標頭與內容一次送出
+    latency = 0.0
+
+    def setup(self):
+        if hasattr(self.request, "do_handshake"):
+            self.request.do_handshake()
+        super().setup()
+
+    # GET (取得訊息內容) 回傳的圖片
+    content = b""
+
+    def count(self, kind):
+        with self.server.calls_lock:
+            self.server.calls[kind] = self.server.calls.get(kind, 0) + 1
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if self.latency:
+            time.sleep(self.latency)
+        self.count(self.path.rsplit("/", 1)[-1])
+        body = b"{}"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.count("content")
+        # 以訊息 ID 區分內容 (JPEG 結尾之後的資料不影響解碼)，避免被圖片快取當成重傳
+        body = self.content + self.path.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_line_api(port=0, latency=0.0, certfile=None, keyfile=None, content=b""):
+    """在背景啟動假的 LINE API，回傳 (server, endpoint)；server.calls 為各 API 的呼叫次數"""
+    handler = type("Handler", (FakeLineApiHandler,), {"latency": latency, "content": content})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.calls = {}
+    server.calls_lock = threading.Lock()
+    scheme = "http"
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        # TLS 交握移到各連線的處理執行緒，避免卡住 accept 迴圈
+        server.socket = context.wrap_socket(
+            server.socket, server_side=True, do_handshake_on_connect=False)
+        scheme = "https"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"{scheme}://127.0.0.1:{server.server_address[1]}"
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(name, latencies, elapsed):
+    ms = [x * 1000 for x in latencies]
+    print(f"{name:<10} 請求數 {len(ms):>6}  吞吐 {len(ms) / elapsed:>8.1f}/s  "
+          f"p50 {percentile(ms, 50):>7.2f}ms  p99 {percentile(ms, 99):>7.2f}ms  "
+          f"平均 {statistics.mean(ms):>7.2f}ms")
+
+
+def run_load(send, total, threads, rate=None):
+    """以 threads 個執行緒送出 total 個請求；指定 rate 時每秒最多送出 rate 個"""
+    latencies = []
+    lock = threading.Lock()
+
+    def one(i):
+        if rate:
+            delay = begin + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        start = time.perf_counter()
+        send(i)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(one, range(total)))
+    return latencies, time.perf_counter() - begin
+
+
+def bench_reply_latency(args):
+    server, endpoint = start_fake_line_api(
+        latency=args.api_latency / 1000, certfile=args.certfile, keyfile=args.keyfile)
+    message = TextSendMessage(text="回覆")
+    if args.certfile:
+        # 自簽憑證：兩種做法都略過驗證，才能公平比較
+        requests.packages.urllib3.disable_warnings()
+        original = requests.Session.request
+
+        def insecure(self, *a, **k):
+            k["verify"] = False
+            return original(self, *a, **k)
+        requests.Session.request = insecure
+
+    def per_request(i):
+        # 舊做法：每個 webhook 都建立新的 LineBotApi (新的 HTTP 連線)
+        LineBotApi("token", endpoint=endpoint).reply_message(f"tk{i}", message)
+
+    shared = LineClients("token", "secret", pool_size=args.threads, endpoint=endpoint)
+
+    def pooled(i):
+        shared.line_bot_api.reply_message(f"tk{i}", message)
+
+    print(f"LINE API 端點: {endpoint}  執行緒: {args.threads}")
+    for name, send in (("per-request", per_request), ("pooled", pooled)):
+        run_load(send, min(200, args.requests), args.threads)  # 暖機
+        latencies, elapsed = run_load(send, args.requests, args.threads)
+        summarize(name, latencies, elapsed)
+    server.shutdown()
+
+
+def measure(build, iterations):
+    """回傳 (每次耗時 µs, 單次呼叫的峰值記憶體配置 bytes)"""
+    start = time.perf_counter()
+    for i in range(iterations):
+        build(i)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    peaks = []
+    for i in range(min(iterations, 50)):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        build(i)
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+    return elapsed / iterations * 1e6, statistics.median(peaks)
+
+
+def bench_templates(args):
+    import app
+
+    builders = {
+        "terms": app.create_terms_flex_message,
+        "tutorial": app.create_tutorial_carousel,
+        "qa_tutorial": app.create_qa_tutorial_carousel,
+        "image_tutorial": app.create_image_tutorial_carousel,
+    }
+    for name, builder in builders.items():
+        def rebuild(i):
+            # 舊做法：與 SDK 的 reply_message 相同，每次重建再序列化
+            payload = builder()
+            message = FlexSendMessage(alt_text=payload["altText"], contents=payload["contents"])
+            return json.dumps({"replyToken": f"tk{i}", "messages": [message.as_json_dict()]})
+
+        template = app.templates[name]
+
+        def prebuilt(i):
+            return build_reply_body(f"tk{i}", template)
+
+        print(f"{name} ({len(template.json_bytes)} bytes)")
+        for label, build in (("rebuild", rebuild), ("prebuilt", prebuilt)):
+            build(0)  # 暖機
+            us, allocated = measure(build, args.iterations)
+            print(f"  {label:<10} {us:>9.1f}µs/次  峰值配置 {allocated / 1024:>8.1f}KiB/次")
+
+
+def max_rss_mb():
+    # Linux 上 ru_maxrss 的單位為 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_import_export(args):
+    workdir = tempfile.mkdtemp(prefix="bench-io-")
+    try:
+        path = os.path.join(workdir, "readings.csv")
+        start = time.perf_counter()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("time,value,unit,meal\n")
+            t0 = 1700000000
+            meals = ("", "空腹", "早餐後", "午餐前", "晚餐後", "睡前")
+            for i in range(args.rows):
+                f.write(f"{t0 + i * 300},{70 + i % 150},mg/dL,{meals[i % len(meals)]}\n")
+        size = os.path.getsize(path)
+        print(f"產生 {args.rows} 筆 ({size / 1e6:.0f} MB)：{time.perf_counter() - start:.1f}s  "
+              f"RSS {max_rss_mb():.0f} MB")
+
+        store = create_user_store(
+            args.backend, os.path.join(workdir, "users.json"),
+            db_path=os.path.join(workdir, "users.db"))
+        store.put("Ubench", {"status": "agreed"})
+
+        start = time.perf_counter()
+        with open(path, encoding="utf-8", newline="") as f:
+            result = import_readings(store, "Ubench", f, "csv", batch_size=args.batch_size)
+        elapsed = time.perf_counter() - start
+        print(f"匯入 {result.imported} 筆 (略過 {result.skipped})：{elapsed:.1f}s  "
+              f"{result.imported / elapsed:,.0f} 筆/s  {size / elapsed / 1e6:.1f} MB/s  "
+              f"RSS {max_rss_mb():.0f} MB")
+
+        for fmt in ("csv", "ndjson"):
+            start = time.perf_counter()
+            written = 0
+            with open(os.devnull, "wb") as out:
+                for chunk in export_readings(store, "Ubench", fmt):
+                    out.write(chunk)
+                    written += len(chunk)
+            elapsed = time.perf_counter() - start
+            print(f"匯出 {fmt:<6}：{elapsed:.1f}s  {result.imported / elapsed:,.0f} 筆/s  "
+                  f"{written / elapsed / 1e6:.1f} MB/s  RSS {max_rss_mb():.0f} MB")
+        store.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+KNOWLEDGE_QUERIES = (
+    "血糖高怎麼辦？", "糖尿病可以吃什麼？", "運動對血糖的影響", "低血糖怎麼辦",
+    "可以吃水果嗎", "HbA1c 多少算正常", "腳有傷口怎麼辦", "感冒發燒時血糖很高",
+    "什麼時候量血糖", "喝酒可以嗎", "今天天氣如何", "謝謝",
+)
+
+
+def query_latency(name, kb, queries):
+    latencies = []
+    answered = 0
+    start = time.perf_counter()
+    for i in range(queries):
+        t = time.perf_counter()
+        if kb.answer(KNOWLEDGE_QUERIES[i % len(KNOWLEDGE_QUERIES)]):
+            answered += 1
+        latencies.append(time.perf_counter() - t)
+    summarize(name, latencies, time.perf_counter() - start)
+    print(f"{'':<10} 有回答 {answered / queries:.0%}")
+
+
+def bench_knowledge(args):
+    workdir = tempfile.mkdtemp(prefix="bench-kb-")
+    try:
+        source = os.path.join(workdir, "source")
+        output = os.path.join(workdir, "index")
+        os.makedirs(source)
+        names = []
+        for i in range(args.scale):
+            for name in source_files(args.dir):
+                copy = f"{i:05d}-{name}"
+                shutil.copyfile(os.path.join(args.dir, name), os.path.join(source, copy))
+                names.append(copy)
+
+        start = time.perf_counter()
+        memory = KnowledgeBase.load(source)
+        print(f"記憶體索引：{len(memory)} 段、{len(memory.index.postings)} 筆倒排  "
+              f"{(time.perf_counter() - start) * 1000:.0f}ms")
+
+        start = time.perf_counter()
+        result = build_index(source, output)
+        print(f"離線建立：{(time.perf_counter() - start) * 1000:.0f}ms  {result}")
+        with open(os.path.join(source, names[0]), "a", encoding="utf-8") as f:
+            f.write("\n## 新增段落\n增量重建測試。\n")
+        start = time.perf_counter()
+        result = build_index(source, output)
+        print(f"增量重建：{(time.perf_counter() - start) * 1000:.0f}ms  {result}")
+
+        start = time.perf_counter()
+        mapped = open_index(current_build(output))
+        print(f"開啟索引檔：{(time.perf_counter() - start) * 1000:.2f}ms")
+
+        query_latency("記憶體", memory, args.queries)
+        query_latency("索引檔", mapped, args.queries)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class SlowStream(io.TextIOBase):
+    """每次 write 都要等 delay 秒的輸出 (同一時間只能有一個寫入者，如同 pipe)"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.lines = 0
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        with self._lock:
+            time.sleep(self.delay)
+            self.lines += text.count("\n")
+        return len(text)
+
+
+def bench_logging(args):
+    text = "早餐後血糖 140"
+    reply = "✅ 已記錄血糖 140 mg/dL（早餐後）\n\n👍 數值在一般建議範圍內，繼續保持！"
+
+    def handle(i):
+        # 請求本身的工作：組出回覆內容
+        return json.dumps({"replyToken": f"tk{i}", "messages": [{"type": "text", "text": reply}]})
+
+    def no_logging(i):
+        handle(i)
+
+    print_stream = SlowStream(args.write_delay / 1000)
+
+    def with_print(i):
+        for _ in range(args.events):
+            print_stream.write(f"收到: {text}\n")
+        handle(i)
+
+    log_stream = SlowStream(args.write_delay / 1000)
+    handler = configure_logging(redact_key=b"benchmark", stream=log_stream, queue_size=args.queue_size)
+    log = get_logger("benchmark")
+
+    def structured(i):
+        for _ in range(args.events):
+            log.info("message_received", user_id=f"U{i % 1000}", text=text)
+        handle(i)
+
+    rate = args.rate / args.events if args.rate else None
+    print(f"每個請求 {args.events} 筆日誌，每次寫出 {args.write_delay}ms，執行緒: {args.threads}，"
+          f"目標 {args.rate or '不限'} 筆/s")
+    for name, send in (("none", no_logging), ("print", with_print), ("structured", structured)):
+        run_load(send, min(200, args.requests), args.threads)  # 暖機
+        latencies, elapsed = run_load(send, args.requests, args.threads, rate)
+        summarize(name, latencies, elapsed)
+        if send is not no_logging:
+            print(f"{'':<10} 日誌 {len(latencies) * args.events / elapsed:>8.1f} 筆/s")
+    handler.flush()
+    stats = handler.stats()
+    print(f"結構化日誌：寫出 {log_stream.lines} 筆，丟棄 {stats['dropped']} 筆 (佇列 {stats['queue_size']})")
+    logging.getLogger("linebot").removeHandler(handler)
+
+
+# 壓測的用戶流程：加入好友 → 同意條款 → 教學 → 記錄血糖 → 報表 → 問答 → 照片 → 封鎖
+WEBHOOK_FLOW = (
+    ("follow", None), ("text", "同意"), ("text", "有"), ("text", "我要教學"), ("text", "血糖教學"),
+    ("text", "120"), ("text", "報表"), ("text", "早餐後血糖 140"), ("text", "血糖高怎麼辦？"),
+    ("image", None), ("unfollow", None),
+)
+WEBHOOK_SECRET = "benchmark-secret"
+
+
+def sample_jpeg():
+    """照片訊息的內容：有 Pillow 時為一張灰色 JPEG (IMAGE_OCR=1 時本機讀數辨識會走完整流程)"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return b"\xff\xd8\xff\xd9"
+    out = io.BytesIO()
+    Image.new("L", (640, 480), 128).save(out, "JPEG")
+    return out.getvalue()
+
+
+class WebhookEvents:
+    """產生 LINE webhook 事件 (每個事件有唯一的 webhookEventId 與 replyToken)"""
+
+    def __init__(self):
+        self._ids = iter(range(1, 1 << 62))
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    def event(self, user_id, kind, text):
+        n = self.next_id()
+        event = {
+            "type": "message" if kind in ("text", "image") else kind,
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "source": {"type": "user", "userId": user_id},
+            "webhookEventId": f"01BENCH{n:019d}",
+            "deliveryContext": {"isRedelivery": False},
+        }
+        if kind != "unfollow":
+            event["replyToken"] = f"bench{n:032x}"
+        if kind == "text":
+            event["message"] = {"type": "text", "id": str(n), "quoteToken": f"q{n}", "text": text}
+        elif kind == "image":
+            event["message"] = {"type": "image", "id": str(n), "quoteToken": f"q{n}",
+                                "contentProvider": {"type": "line"}}
+        return event
+
+    @staticmethod
+    def sign(events):
+        body = json.dumps({"destination": "Ubenchmark", "events": events}, ensure_ascii=False).encode("utf-8")
+        digest = hmac.new(WEBHOOK_SECRET.encode("utf-8"), body, hashlib.sha256).digest()
+        return body, base64.b64encode(digest).decode("ascii")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def worker_pids(master_pid):
+    """gunicorn master 的子行程 (各 worker)"""
+    pids = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                # 行程名稱可能含空白，ppid 在最後一個 ")" 之後的第二欄
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if int(fields[1]) == master_pid:
+            pids.append(int(name))
+    return pids
+
+
+def rss_mb(pids):
+    """各行程私有的常駐記憶體 (RssAnon) 合計
+
+    不計 mmap 的檔案 (知識庫索引、去重表)：這些頁面由各 worker 共用，
+    計入 VmRSS 會隨存取範圍變動，看不出每位用戶實際增加的記憶體。
+    """
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("RssAnon:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+
+def start_gunicorn(workdir, endpoint, args):
+    """在 workdir 啟動 gunicorn (用戶數據等檔案都寫在 workdir)，回傳 (行程, base_url)"""
+    port = free_port()
+    env = dict(os.environ)
+    env.setdefault("LOG_LEVEL", "WARNING")
+    env.update(
+        LINE_CHANNEL_SECRET=WEBHOOK_SECRET,
+        LINE_CHANNEL_ACCESS_TOKEN="benchmark-token",
+        LINE_API_ENDPOINT=endpoint,
+        LINE_API_DATA_ENDPOINT=endpoint,
+    )
+    log = open(os.path.join(workdir, "gunicorn.log"), "wb")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--workers", str(args.workers),
+         "--worker-class", "gthread", "--threads", str(args.threads),
+         "--bind", f"127.0.0.1:{port}",
+         "--pythonpath", os.path.dirname(os.path.abspath(__file__)), "app:app"],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            # 每個 worker 都載入完成才開始計時
+            if requests.get(base_url + "/callback/stats", timeout=1).ok and \
+                    len(worker_pids(process.pid)) >= args.workers:
+                return process, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    with open(os.path.join(workdir, "gunicorn.log"), encoding="utf-8", errors="replace") as f:
+        raise SystemExit("gunicorn 啟動失敗：\n" + f.read()[-2000:])
+
+
+def run_users(base_url, events, user_ids, args):
+    """以 --concurrency 個連線跑完 user_ids 的流程
+
+    回傳 (各請求延遲, 流程各步驟的延遲, 狀態碼計數, 事件數, 耗時)。
+    """
+    latencies = []
+    by_step = {step: [] for step in range(len(WEBHOOK_FLOW))}
+    statuses = {}
+    sent = [0]
+    lock = threading.Lock()
+    local = threading.local()
+
+    def post(step, batch):
+        body, signature = events.sign(batch)
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            status = session.post(base_url + "/callback", data=body, timeout=30, headers={
+                "Content-Type": "application/json", "X-Line-Signature": signature}).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            by_step[step].append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+            sent[0] += len(batch)
+
+    def group(members):
+        # 同一批的用戶各自依流程前進，每一步合成一個 webhook (LINE 會把多個事件合併送出)
+        for step, (kind, text) in enumerate(WEBHOOK_FLOW):
+            post(step, [events.event(user_id, kind, text) for user_id in members])
+
+    groups = [user_ids[i:i + args.batch] for i in range(0, len(user_ids), args.batch)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(group, groups))
+    return latencies, by_step, statuses, sent[0], time.perf_counter() - start
+
+
+def bench_webhook(args):
+    workdir = tempfile.mkdtemp(prefix="bench-webhook-")
+    server, endpoint = start_fake_line_api(latency=args.api_latency / 1000, content=sample_jpeg())
+    process = None
+    try:
+        process, base_url = start_gunicorn(workdir, endpoint, args)
+        pids = worker_pids(process.pid)
+        print(f"gunicorn: {args.workers} workers x {args.threads} threads  LINE API 端點: {endpoint}")
+        print(f"每位用戶 {len(WEBHOOK_FLOW)} 個事件，每個 webhook {args.batch} 位用戶，並行連線: {args.concurrency}")
+        events = WebhookEvents()
+        run_users(base_url, events, [f"Uwarmup{i:05d}" for i in range(min(100, args.round))], args)  # 暖機
+        baseline = rss_mb(pids)
+        print(f"暖機後 worker 記憶體 {baseline:.1f} MB")
+        all_latencies = []
+        all_steps = {step: [] for step in range(len(WEBHOOK_FLOW))}
+        total_events = 0
+        total_elapsed = 0.0
+        done = 0
+        while done < args.users:
+            size = min(args.round, args.users - done)
+            user_ids = [f"U{i:032x}" for i in range(done, done + size)]
+            latencies, by_step, statuses, sent, elapsed = run_users(base_url, events, user_ids, args)
+            done += size
+            all_latencies += latencies
+            for step, values in by_step.items():
+                all_steps[step] += values
+            total_events += sent
+            total_elapsed += elapsed
+            ms = [x * 1000 for x in latencies]
+            rss = rss_mb(pids)
+            print(f"用戶 {done:>7}  事件 {sent / elapsed:>8.1f}/s  請求 {len(ms) / elapsed:>7.1f}/s  "
+                  f"p50 {percentile(ms, 50):>7.2f}ms  p95 {percentile(ms, 95):>7.2f}ms  "
+                  f"p99 {percentile(ms, 99):>7.2f}ms  記憶體 {rss:>7.1f} MB  狀態 {statuses}")
+        ms = [x * 1000 for x in all_latencies]
+        growth = (rss_mb(pids) - baseline) / done * 1000
+        print(f"合計：{done} 位用戶、{total_events} 個事件，{total_events / total_elapsed:.1f} 事件/s；"
+              f"p50 {percentile(ms, 50):.2f}ms  p95 {percentile(ms, 95):.2f}ms  p99 {percentile(ms, 99):.2f}ms；"
+              f"每千位用戶記憶體增加 {growth:.2f} MB")
+        for step, (kind, text) in enumerate(WEBHOOK_FLOW):
+            ms = [x * 1000 for x in all_steps[step]]
+            print(f"  {kind:<8} {text or '':<10} p50 {percentile(ms, 50):>7.2f}ms  p99 {percentile(ms, 99):>7.2f}ms")
+        # 非同步處理 (WEBHOOK_ASYNC、照片推送) 可能在回應後才呼叫 LINE API
+        time.sleep(args.settle)
+        print(f"LINE API 呼叫次數：{dict(sorted(server.calls.items()))}")
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="糖小護效能測試")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("reply-latency", help="LINE 回覆延遲：新建用戶端 vs 共用連線池")
+    p.add_argument("--requests", type=int, default=2000)
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--api-latency", type=float, default=0.0, help="假 API 的處理時間 (毫秒)")
+    p.add_argument("--certfile", help="以 HTTPS 提供假 API 的憑證")
+    p.add_argument("--keyfile")
+    p.set_defaults(func=bench_reply_latency)
+
+    p = sub.add_parser("templates", help="Flex 訊息：每次重建 vs 預先序列化的樣板")
+    p.add_argument("--iterations", type=int, default=2000)
+    p.set_defaults(func=bench_templates)
+
+    p = sub.add_parser("import-export", help="血糖記錄串流匯入 / 匯出的吞吐量")
+    p.add_argument("--rows", type=int, default=10_000_000)
+    p.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    p.add_argument("--batch-size", type=int, default=10000)
+    p.set_defaults(func=bench_import_export)
+
+    p = sub.add_parser("knowledge", help="知識庫檢索延遲")
+    p.add_argument("--dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge"))
+    p.add_argument("--scale", type=int, default=1, help="段落複製的倍數")
+    p.add_argument("--queries", type=int, default=20000)
+    p.set_defaults(func=bench_knowledge)
+
+    p = sub.add_parser("logging", help="日誌對請求延遲的影響：同步 print vs 背景寫出")
+    p.add_argument("--requests", type=int, default=20000)
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--events", type=int, default=3, help="每個請求記錄的日誌筆數")
+    p.add_argument("--rate", type=float, default=3000, help="每秒的日誌筆數 (0 為全速)")
+    p.add_argument("--write-delay", type=float, default=0.1, help="每次寫出的耗時 (毫秒)")
+    p.add_argument("--queue-size", type=int, default=10000)
+    p.set_defaults(func=bench_logging)
+
+    p = sub.add_parser("webhook", help="/callback 壓測：gunicorn + 假 LINE API，走完整的用戶流程")
+    p.add_argument("--users", type=int, default=3000)
+    p.add_argument("--round", type=int, default=1000, help="每幾位用戶回報一次延遲與記憶體")
+    p.add_argument("--batch", type=int, default=1, help="每個 webhook 合併幾位用戶的事件")
+    p.add_argument("--concurrency", type=int, default=16, help="並行的連線數")
+    p.add_argument("--workers", type=int, default=2, help="gunicorn worker 數")
+    p.add_argument("--threads", type=int, default=8, help="每個 worker 的執行緒數")
+    p.add_argument("--api-latency", type=float, default=0.0, help="假 API 的處理時間 (毫秒)")
+    p.add_argument("--settle", type=float, default=2.0, help="結束前等待背景處理的秒數")
+    p.set_defaults(func=bench_webhook)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
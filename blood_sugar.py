@@ -0,0 +1,272 @@
+"""血糖記錄
+
+- parse_reading()：解析用戶輸入的血糖數值 ("120"、"150mg/dL"、"早餐後血糖 140"、"7.8 mmol/L")
+- BloodSugarSeries：單一用戶的時間序列，以 array 欄位儲存 (時間、mg/dL、餐次)
+- BloodSugarLog：JSON 後端使用的檔案儲存，每位用戶一個固定長度記錄的追加檔
+
+每筆記錄在檔案中佔 11 bytes、在記憶體中佔 11 bytes (三個 array 欄位)，
+不再以 dict 列表放進用戶記錄，user_data.json 與記憶體都不會隨記錄數膨脹。
+"""
+import os
+import re
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+
+# 餐次標記 (存為 1 byte)
+MEAL_UNKNOWN = 0
+MEAL_FASTING = 1
+MEAL_BEFORE_BREAKFAST = 2
+MEAL_AFTER_BREAKFAST = 3
+MEAL_BEFORE_LUNCH = 4
+MEAL_AFTER_LUNCH = 5
+MEAL_BEFORE_DINNER = 6
+MEAL_AFTER_DINNER = 7
+MEAL_BEDTIME = 8
+MEAL_BEFORE_MEAL = 9
+MEAL_AFTER_MEAL = 10
+
+MEAL_LABELS = (
+    "", "空腹", "早餐前", "早餐後", "午餐前", "午餐後",
+    "晚餐前", "晚餐後", "睡前", "飯前", "飯後",
+)
+
+# 可接受的數值範圍 (mg/dL)，超出視為不是血糖數值
+MIN_MG_DL = 20
+MAX_MG_DL = 600
+MMOL_TO_MG_DL = 18.0
+# 沒有單位、帶小數且小於此值時視為 mmol/L (如 "7.8")
+MMOL_MAX = 35
+
+# 說明文字 → 餐次 (移除填充字之後比對)
+_MEAL_WORDS = {
+    "空腹": MEAL_FASTING, "早上空腹": MEAL_FASTING, "起床": MEAL_FASTING,
+    "早餐前": MEAL_BEFORE_BREAKFAST, "早飯前": MEAL_BEFORE_BREAKFAST,
+    "早餐後": MEAL_AFTER_BREAKFAST, "早飯後": MEAL_AFTER_BREAKFAST,
+    "午餐前": MEAL_BEFORE_LUNCH, "中餐前": MEAL_BEFORE_LUNCH, "午飯前": MEAL_BEFORE_LUNCH,
+    "午餐後": MEAL_AFTER_LUNCH, "中餐後": MEAL_AFTER_LUNCH, "午飯後": MEAL_AFTER_LUNCH,
+    "晚餐前": MEAL_BEFORE_DINNER, "晚飯前": MEAL_BEFORE_DINNER,
+    "晚餐後": MEAL_AFTER_DINNER, "晚飯後": MEAL_AFTER_DINNER,
+    "睡前": MEAL_BEDTIME, "睡覺前": MEAL_BEDTIME,
+    "飯前": MEAL_BEFORE_MEAL, "餐前": MEAL_BEFORE_MEAL,
+    "飯後": MEAL_AFTER_MEAL, "餐後": MEAL_AFTER_MEAL,
+    "飯後兩小時": MEAL_AFTER_MEAL, "餐後兩小時": MEAL_AFTER_MEAL,
+}
+# 說明中可忽略的字 (空白、標點、「血糖」等)
+_FILLER = str.maketrans("", "", " \t　:：,，.。!！~～的是為測量值血糖")
+
+# 整段輸入只能有一個數值，前後可有說明文字與單位
+_READING = re.compile(
+    r"(?P<before>[^\d]{0,20}?)\s*"
+    r"(?P<value>\d{1,3}(?:\.\d{1,2})?)\s*"
+    r"(?P<unit>mg\s*/\s*dl|mg|mmol\s*/\s*l|mmol)?"
+    r"(?P<after>[^\d]{0,20})",
+    re.IGNORECASE
+)
+
+
+def parse_reading(text):
+    """解析血糖輸入，回傳 (mg/dL 整數, 餐次)；不是血糖數值時回傳 None"""
+    if not text or len(text) > 48:
+        return None
+    match = _READING.fullmatch(text.strip())
+    if match is None:
+        return None
+    meal = meal_tag(match.group("before") + match.group("after"))
+    if meal is None:
+        return None
+    mg_dl = to_mg_dl(match.group("value"), match.group("unit"))
+    if mg_dl is None:
+        return None
+    return mg_dl, meal
+
+
+def to_mg_dl(value, unit=None):
+    """數值字串 (與單位) → mg/dL 整數；超出範圍時回傳 None
+
+    沒有單位時，帶小數且小於 MMOL_MAX 的數值視為 mmol/L。
+    """
+    number = float(value)
+    unit = (unit or "").lower()
+    if unit.startswith("mmol") or (not unit and "." in value and number < MMOL_MAX):
+        number *= MMOL_TO_MG_DL
+    mg_dl = int(round(number))
+    if not MIN_MG_DL <= mg_dl <= MAX_MG_DL:
+        return None
+    return mg_dl
+
+
+def meal_tag(text):
+    """餐次說明 ("早餐後"、"飯前"…) → 餐次標記；空白為 MEAL_UNKNOWN，無法辨識時回傳 None"""
+    text = (text or "").translate(_FILLER)
+    if not text:
+        return MEAL_UNKNOWN
+    return _MEAL_WORDS.get(text)
+
+
+class BloodSugarSeries:
+    """單一用戶的血糖時間序列 (欄位式)
+
+    timestamps：毫秒時間戳 (int64)，mg_dl：uint16，meals：uint8
+    """
+
+    __slots__ = ("timestamps", "mg_dl", "meals", "ordered")
+
+    def __init__(self):
+        self.timestamps = array("q")
+        self.mg_dl = array("H")
+        self.meals = array("B")
+        # 時間是否依寫入順序遞增 (匯入舊記錄後可能不是)
+        self.ordered = True
+
+    def append(self, timestamp, mg_dl, meal=MEAL_UNKNOWN):
+        if self.ordered and self.timestamps and timestamp < self.timestamps[-1]:
+            self.ordered = False
+        self.timestamps.append(timestamp)
+        self.mg_dl.append(mg_dl)
+        self.meals.append(meal)
+
+    def extend_packed(self, data):
+        """加入以 RECORD 格式打包的記錄"""
+        for timestamp, mg_dl, meal in RECORD.iter_unpack(data):
+            self.append(timestamp, mg_dl, meal)
+
+    def since(self, timestamp):
+        """timestamp (含) 之後的記錄 (時間依寫入順序遞增時以二分搜尋)"""
+        if not self.ordered:
+            series = BloodSugarSeries()
+            for row in self:
+                if row[0] >= timestamp:
+                    series.append(*row)
+            return series
+        lo, hi = 0, len(self.meals)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamps[mid] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        # 以最後追加的欄位長度為準，其他執行緒同時追加時三欄仍對齊
+        end = len(self.meals)
+        series = BloodSugarSeries()
+        series.timestamps = self.timestamps[lo:end]
+        series.mg_dl = self.mg_dl[lo:end]
+        series.meals = self.meals[lo:end]
+        return series
+
+    def __len__(self):
+        return len(self.meals)
+
+    def __iter__(self):
+        """逐筆產出 (時間戳, mg/dL, 餐次)"""
+        return zip(self.timestamps, self.mg_dl, self.meals)
+
+
+# 檔案中的一筆記錄：時間戳 (int64)、mg/dL (uint16)、餐次 (uint8)
+RECORD = struct.Struct("<qHB")
+
+_SAFE_NAME = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+class BloodSugarLog:
+    """每位用戶一個追加檔的血糖儲存 (JSON 後端使用)
+
+    寫入以 O_APPEND 追加固定長度的記錄；讀取時只讀取上次之後新增的
+    部分，其他 worker 寫入的記錄也會被讀到。最近使用的序列保留在記憶體
+    (最多 cache_size 位用戶)。
+    呼叫端須持有該用戶的鎖 (UserStore.lock)。
+    """
+
+    def __init__(self, directory, cache_size=1024):
+        self.directory = directory
+        self.cache_size = cache_size
+        self._cache = OrderedDict()   # userId → (序列, 已讀取的檔案長度, inode)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, user_id):
+        if not _SAFE_NAME.fullmatch(user_id):
+            raise ValueError(f"不合法的 userId: {user_id!r}")
+        return os.path.join(self.directory, user_id + ".bin")
+
+    def append(self, user_id, timestamp, mg_dl, meal=MEAL_UNKNOWN):
+        fd = os.open(self.path(user_id), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if size % RECORD.size:
+                # 上次寫入中斷留下的殘缺記錄，截掉以免後續記錄錯位
+                os.ftruncate(fd, size - size % RECORD.size)
+            os.write(fd, RECORD.pack(timestamp, mg_dl, meal))
+        finally:
+            os.close(fd)
+
+    def append_many(self, user_id, rows):
+        """一次追加多筆 (時間戳, mg/dL, 餐次)"""
+        data = b"".join(RECORD.pack(*row) for row in rows)
+        if not data:
+            return
+        fd = os.open(self.path(user_id), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if size % RECORD.size:
+                os.ftruncate(fd, size - size % RECORD.size)
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+    def iter_rows(self, user_id, batch_size=8192):
+        """逐批讀取檔案中的記錄，每批為 [(時間戳, mg/dL, 餐次), ...]，不載入整個序列"""
+        try:
+            f = open(self.path(user_id), "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            while True:
+                chunk = f.read(batch_size * RECORD.size)
+                usable = len(chunk) - len(chunk) % RECORD.size
+                if not usable:
+                    return
+                yield list(RECORD.iter_unpack(chunk[:usable]))
+
+    def get(self, user_id):
+        """取得用戶的完整序列
+
+        序列只會在尾端追加：快取中的序列有新記錄時直接延伸，不重新讀取。
+        """
+        path = self.path(user_id)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            self.forget(user_id)
+            return BloodSugarSeries()
+        try:
+            st = os.fstat(fd)
+            size = st.st_size - st.st_size % RECORD.size
+            with self._lock:
+                series, offset, ino = self._cache.get(user_id, (None, 0, None))
+                if series is None or offset > size or ino != st.st_ino:
+                    # 首次讀取，或檔案被 (其他 worker) 刪除後重建
+                    series, offset = BloodSugarSeries(), 0
+                if offset < size:
+                    series.extend_packed(os.pread(fd, size - offset, offset))
+                self._cache[user_id] = (series, size, st.st_ino)
+                self._cache.move_to_end(user_id, last=True)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        finally:
+            os.close(fd)
+        return series
+
+    def delete(self, user_id):
+        try:
+            os.remove(self.path(user_id))
+        except FileNotFoundError:
+            pass
+        self.forget(user_id)
+
+    def forget(self, user_id):
+        with self._lock:
+            self._cache.pop(user_id, None)
@@ -0,0 +1,219 @@
+"""血糖記錄的匯入與匯出
+
+全程以產生器串流處理：匯入時逐行解析、每 batch_size 筆批次寫入一次；
+匯出時逐批讀取記錄並產出約 64 KB 的區塊。任何時候記憶體中只有一批記錄，
+與歷史記錄的總筆數無關。
+
+支援格式：
+- CSV：第一列可為標題 (time/timestamp/時間、value/mg_dl/血糖、unit/單位、meal/餐次)，
+  沒有標題時依序為 時間, 數值[, 單位[, 餐次]]
+- NDJSON：每行一個物件，{"time": ..., "mg_dl": ...} 或 {"time": ..., "value": ..., "unit": ...}
+
+時間可為 ISO 8601 字串 (沒有時區時視為 REPORT_UTC_OFFSET_HOURS 的當地時間)、
+或 epoch 秒 / 毫秒。
+"""
+import codecs
+import csv
+import json
+from datetime import datetime, timedelta, timezone
+
+from blood_sugar import MEAL_LABELS, meal_tag, to_mg_dl
+from reports import UTC_OFFSET_MS
+
+DEFAULT_BATCH_SIZE = 10000
+EXPORT_CHUNK_BYTES = 64 * 1024
+FORMATS = ("csv", "ndjson")
+
+LOCAL_TZ = timezone(timedelta(milliseconds=UTC_OFFSET_MS))
+
+_HEADER_NAMES = {
+    "time": "time", "timestamp": "time", "datetime": "time", "date": "time", "時間": "time",
+    "value": "value", "mg_dl": "value", "mg/dl": "value", "glucose": "value", "血糖": "value",
+    "unit": "unit", "單位": "unit",
+    "meal": "meal", "餐次": "meal",
+}
+# 沒有標題時的欄位順序
+_POSITIONAL = ("time", "value", "unit", "meal")
+
+# epoch 數值大於此值視為毫秒
+_EPOCH_MS_THRESHOLD = 10 ** 11
+
+
+class ImportResult:
+    """匯入結果：寫入筆數、略過筆數與前幾個錯誤"""
+
+    __slots__ = ("imported", "skipped", "errors")
+
+    MAX_ERRORS = 20
+
+    def __init__(self):
+        self.imported = 0
+        self.skipped = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.skipped += 1
+        if len(self.errors) < self.MAX_ERRORS:
+            self.errors.append(f"第 {line} 行：{message}")
+
+    def as_dict(self):
+        return {"imported": self.imported, "skipped": self.skipped, "errors": self.errors}
+
+
+def parse_time(value):
+    """時間欄位 → 毫秒時間戳"""
+    value = value.strip()
+    if value.isdigit():
+        number = int(value)
+        return number if number >= _EPOCH_MS_THRESHOLD else number * 1000
+    moment = datetime.fromisoformat(value.replace("/", "-"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=LOCAL_TZ)
+    return int(moment.timestamp() * 1000)
+
+
+def to_row(time_value, value, unit=None, meal=None):
+    """欄位 → (時間戳, mg/dL, 餐次)；無法解析時丟出 ValueError"""
+    timestamp = parse_time(str(time_value))
+    mg_dl = to_mg_dl(str(value), unit)
+    if mg_dl is None:
+        raise ValueError(f"血糖數值超出範圍: {value}")
+    tag = meal_tag(meal)
+    if tag is None:
+        raise ValueError(f"無法辨識的餐次: {meal}")
+    return timestamp, mg_dl, tag
+
+
+def iter_text_lines(chunks, encoding="utf-8-sig"):
+    """把位元組區塊 (如 HTTP 請求內容串流) 轉成逐行的文字"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ""
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        yield from lines
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+def iter_csv_rows(lines, result):
+    """解析 CSV 行，產出 (時間戳, mg/dL, 餐次)；錯誤的行記錄在 result 並略過"""
+    columns = None
+    for number, fields in enumerate(csv.reader(lines), 1):
+        if not fields or not any(fields):
+            continue
+        if columns is None:
+            names = [_HEADER_NAMES.get(field.strip().lower()) for field in fields]
+            if "time" in names and "value" in names:
+                columns = {name: i for i, name in enumerate(names) if name}
+                continue
+            columns = {name: i for i, name in enumerate(_POSITIONAL)}
+        try:
+            yield to_row(
+                fields[columns["time"]],
+                fields[columns["value"]],
+                fields[columns["unit"]] if "unit" in columns and columns["unit"] < len(fields) else None,
+                fields[columns["meal"]] if "meal" in columns and columns["meal"] < len(fields) else None,
+            )
+        except (ValueError, IndexError) as e:
+            result.error(number, e)
+
+
+def iter_ndjson_rows(lines, result):
+    """解析 NDJSON 行，產出 (時間戳, mg/dL, 餐次)"""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            if "mg_dl" in item:
+                value, unit = item["mg_dl"], "mg/dl"
+            else:
+                value, unit = item["value"], item.get("unit")
+            yield to_row(item["time"], value, unit, item.get("meal"))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            result.error(number, e)
+
+
+def batched(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_readings(store, user_id, lines, fmt="csv", batch_size=DEFAULT_BATCH_SIZE):
+    """把逐行的文字匯入 store，回傳 ImportResult；用戶不存在時丟出 KeyError
+
+    每批寫入時才取得該用戶的鎖，長時間的匯入不會擋住用戶的對話。
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"不支援的格式: {fmt}")
+    if store.get(user_id) is None:
+        raise KeyError(user_id)
+    result = ImportResult()
+    parse = iter_csv_rows if fmt == "csv" else iter_ndjson_rows
+    for batch in batched(parse(lines, result), batch_size):
+        with store.lock(user_id):
+            result.imported += store.append_blood_sugar_many(user_id, batch)
+    return result
+
+
+class TimeFormatter:
+    """毫秒時間戳 → 當地時間的 ISO 8601 字串 (到秒)
+
+    日期部分依日快取，每筆只需整數運算，不必建立 datetime。
+    """
+
+    def __init__(self):
+        offset = UTC_OFFSET_MS // 1000
+        self.offset = offset
+        sign = "+" if offset >= 0 else "-"
+        hours, minutes = divmod(abs(offset) // 60, 60)
+        self.suffix = f"{sign}{hours:02d}:{minutes:02d}"
+        self._day = None
+        self._date = None
+
+    def __call__(self, timestamp):
+        day, seconds = divmod(timestamp // 1000 + self.offset, 86400)
+        if day != self._day:
+            self._day = day
+            self._date = datetime.fromtimestamp(day * 86400, timezone.utc).strftime("%Y-%m-%d")
+        hours, seconds = divmod(seconds, 3600)
+        minutes, seconds = divmod(seconds, 60)
+        return f"{self._date}T{hours:02d}:{minutes:02d}:{seconds:02d}{self.suffix}"
+
+
+def export_readings(store, user_id, fmt="csv"):
+    """逐塊產出匯出內容 (bytes)，依寫入順序"""
+    if fmt not in FORMATS:
+        raise ValueError(f"不支援的格式: {fmt}")
+    format_time = TimeFormatter()
+    if fmt == "csv":
+        header = "time,mg_dl,meal\n"
+        template = "{},{},{}\n"
+        labels = MEAL_LABELS
+    else:
+        header = ""
+        template = '{{"time":"{}","mg_dl":{},"meal":{}}}\n'
+        # 餐次標籤預先編碼成 JSON 字串
+        labels = [json.dumps(label, ensure_ascii=False) for label in MEAL_LABELS]
+    buffer = [header]
+    size = len(header)
+    for rows in store.iter_blood_sugar(user_id):
+        lines = [template.format(format_time(timestamp), mg_dl, labels[meal])
+                 for timestamp, mg_dl, meal in rows]
+        buffer.extend(lines)
+        size += sum(map(len, lines))
+        if size >= EXPORT_CHUNK_BYTES:
+            yield "".join(buffer).encode("utf-8")
+            buffer = []
+            size = 0
+    if size:
+        yield "".join(buffer).encode("utf-8")
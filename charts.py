@@ -0,0 +1,335 @@
+"""血糖趨勢圖
+
+- render_trend_png()：以純 Python 繪製趨勢圖並編碼成 PNG (不需額外套件)
+- ChartRenderer：在行程池中繪圖，不佔用 webhook worker 的 GIL
+- ChartCache：記憶體 LRU + 磁碟快取，以 (用戶, 日期範圍, 記錄版本) 為鍵
+
+LINE 取圖時可能連到任何一個 gunicorn worker，因此繪好的圖會同時寫入
+磁碟；記憶體只保留最近使用的部分 (超過上限時由磁碟提供)。回覆報表時
+不等待繪圖：先把繪圖參數寫成工作檔 (put_job) 並在背景繪圖，LINE 取圖時
+若圖還沒繪好，任何 worker 都能依工作檔當場繪製。
+"""
+import json
+import hashlib
+import multiprocessing
+import os
+import re
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+WIDTH = 1040
+HEIGHT = 585
+# 繪圖區的邊界 (左、上、右、下)
+MARGIN = (90, 30, 30, 70)
+
+WHITE = (255, 255, 255)
+GRID = (225, 228, 232)
+AXIS = (110, 110, 110)
+TARGET_BAND = (226, 244, 230)
+MEAN_LINE = (46, 134, 171)
+POINT_LOW = (214, 69, 65)
+POINT_HIGH = (240, 150, 40)
+POINT_IN_RANGE = (90, 159, 212)
+
+LOW_MG_DL = 70
+HIGH_MG_DL = 180
+DAY_MS = 86400 * 1000
+
+# 5x7 點陣字型 (座標軸標籤只需要數字與 "/")
+FONT = {
+    "0": ("01110", "10001", "10011", "10101", "11001", "10001", "01110"),
+    "1": ("00100", "01100", "00100", "00100", "00100", "00100", "01110"),
+    "2": ("01110", "10001", "00001", "00010", "00100", "01000", "11111"),
+    "3": ("11110", "00001", "00001", "01110", "00001", "00001", "11110"),
+    "4": ("00010", "00110", "01010", "10010", "11111", "00010", "00010"),
+    "5": ("11111", "10000", "11110", "00001", "00001", "10001", "01110"),
+    "6": ("00110", "01000", "10000", "11110", "10001", "10001", "01110"),
+    "7": ("11111", "00001", "00010", "00100", "01000", "01000", "01000"),
+    "8": ("01110", "10001", "10001", "01110", "10001", "10001", "01110"),
+    "9": ("01110", "10001", "10001", "01111", "00001", "00010", "01100"),
+    "/": ("00001", "00010", "00010", "00100", "01000", "01000", "10000"),
+}
+
+
+class Canvas:
+    """RGB 點陣畫布"""
+
+    def __init__(self, width, height, background=WHITE):
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(bytes(background) * (width * height))
+
+    def set(self, x, y, color):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            i = (y * self.width + x) * 3
+            self.pixels[i:i + 3] = bytes(color)
+
+    def fill_rect(self, x0, y0, x1, y1, color):
+        x0, x1 = max(0, min(x0, x1)), min(self.width, max(x0, x1))
+        y0, y1 = max(0, min(y0, y1)), min(self.height, max(y0, y1))
+        if x0 >= x1:
+            return
+        row = bytes(color) * (x1 - x0)
+        for y in range(y0, y1):
+            i = (y * self.width + x0) * 3
+            self.pixels[i:i + len(row)] = row
+
+    def line(self, x0, y0, x1, y1, color, width=1):
+        """Bresenham 直線 (width 為線寬)"""
+        half = width // 2
+        dx, dy = abs(x1 - x0), -abs(y1 - y0)
+        sx = 1 if x0 < x1 else -1
+        sy = 1 if y0 < y1 else -1
+        err = dx + dy
+        while True:
+            if width > 1:
+                self.fill_rect(x0 - half, y0 - half, x0 - half + width, y0 - half + width, color)
+            else:
+                self.set(x0, y0, color)
+            if x0 == x1 and y0 == y1:
+                return
+            e2 = 2 * err
+            if e2 >= dy:
+                err += dy
+                x0 += sx
+            if e2 <= dx:
+                err += dx
+                y0 += sy
+
+    def dot(self, cx, cy, radius, color):
+        r2 = radius * radius
+        for y in range(-radius, radius + 1):
+            span = int((r2 - y * y) ** 0.5)
+            self.fill_rect(cx - span, cy + y, cx + span + 1, cy + y + 1, color)
+
+    def text(self, x, y, text, color, scale=2):
+        """以點陣字型寫字，(x, y) 為左上角"""
+        for char in text:
+            glyph = FONT.get(char)
+            if glyph is not None:
+                for row, bits in enumerate(glyph):
+                    for col, bit in enumerate(bits):
+                        if bit == "1":
+                            self.fill_rect(x + col * scale, y + row * scale,
+                                           x + (col + 1) * scale, y + (row + 1) * scale, color)
+            x += 6 * scale
+
+    def png(self):
+        """編碼成 PNG (8-bit RGB，不使用濾波)"""
+        stride = self.width * 3
+        raw = bytearray()
+        for y in range(self.height):
+            raw.append(0)
+            raw += self.pixels[y * stride:(y + 1) * stride]
+
+        def chunk(kind, data):
+            body = kind + data
+            return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+        header = struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0)
+        return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+                + chunk(b"IDAT", zlib.compress(bytes(raw), 6)) + chunk(b"IEND", b""))
+
+
+def render_trend_png(readings, daily_means, start_day, end_day, utc_offset_ms=0):
+    """繪製血糖趨勢圖
+
+    readings：[(毫秒時間戳, mg/dL), ...]；daily_means：[(日序號, 平均), ...]
+    start_day / end_day：日序號 (含)，與 reports.day_of 相同的定義
+    """
+    canvas = Canvas(WIDTH, HEIGHT)
+    left, top, right, bottom = MARGIN[0], MARGIN[1], WIDTH - MARGIN[2], HEIGHT - MARGIN[3]
+    x_start = start_day * DAY_MS
+    x_span = (end_day + 1 - start_day) * DAY_MS
+    readings = [(timestamp + utc_offset_ms, mg_dl) for timestamp, mg_dl in readings
+                if 0 <= timestamp + utc_offset_ms - x_start < x_span]
+    values = [mg_dl for _, mg_dl in readings]
+    y_min = min([40, *values])
+    y_max = max([300, *values])
+
+    def x_of(local_ms):
+        return left + (local_ms - x_start) * (right - left) // x_span
+
+    def y_of(mg_dl):
+        return bottom - (mg_dl - y_min) * (bottom - top) // (y_max - y_min)
+
+    # 目標範圍 70–180 與格線
+    canvas.fill_rect(left, y_of(HIGH_MG_DL), right, y_of(LOW_MG_DL), TARGET_BAND)
+    for mg_dl in range((y_min // 50 + 1) * 50, y_max + 1, 50):
+        y = y_of(mg_dl)
+        canvas.line(left, y, right, y, GRID)
+        canvas.text(left - 12 - 6 * 2 * len(str(mg_dl)), y - 7, str(mg_dl), AXIS)
+    for mg_dl in (LOW_MG_DL, HIGH_MG_DL):
+        y = y_of(mg_dl)
+        for x in range(left, right, 12):
+            canvas.line(x, y, min(x + 6, right), y, POINT_IN_RANGE)
+    days = end_day + 1 - start_day
+    label_every = max(1, days // 7)
+    for i in range(days + 1):
+        x = left + i * (right - left) // days
+        canvas.line(x, top, x, bottom, GRID)
+        if i < days and i % label_every == 0:
+            label = datetime.fromtimestamp((start_day + i) * 86400, timezone.utc).strftime("%m/%d")
+            center = x + (right - left) // days // 2
+            canvas.text(center - len(label) * 6, bottom + 14, label, AXIS)
+    canvas.line(left, top, left, bottom, AXIS, 2)
+    canvas.line(left, bottom, right, bottom, AXIS, 2)
+
+    # 每日平均折線 (畫在當天中午)
+    previous = None
+    for day, mean in daily_means:
+        point = (x_of(day * DAY_MS + DAY_MS // 2), y_of(int(round(mean))))
+        if previous is not None:
+            canvas.line(*previous, *point, MEAN_LINE, 3)
+        previous = point
+    # 各筆記錄 (已換算成當地時間)
+    for timestamp, mg_dl in readings:
+        color = POINT_LOW if mg_dl < LOW_MG_DL else POINT_HIGH if mg_dl > HIGH_MG_DL else POINT_IN_RANGE
+        canvas.dot(x_of(timestamp), y_of(mg_dl), 4, color)
+    for day, mean in daily_means:
+        canvas.dot(x_of(day * DAY_MS + DAY_MS // 2), y_of(int(round(mean))), 5, MEAN_LINE)
+    return canvas.png()
+
+
+class ChartRenderer:
+    """在行程池中繪圖
+
+    行程池以 spawn 啟動：webhook worker 是多執行緒行程，fork 後子行程
+    可能繼承被其他執行緒持有的鎖。行程池不可跨 fork 共用，各 worker
+    首次使用時各自建立。子行程只需要本模組 (render_trend_png)；以
+    python app.py 啟動時，app.py 會標示主模組不必在子行程重新執行。
+    """
+
+    def __init__(self, processes=2):
+        self.processes = processes
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    def _executor(self):
+        if self._pool is None or self._pool_pid != os.getpid():
+            with self._pool_lock:
+                if self._pool is None or self._pool_pid != os.getpid():
+                    self._pool = ProcessPoolExecutor(
+                        self.processes, mp_context=multiprocessing.get_context("spawn"))
+                    self._pool_pid = os.getpid()
+        return self._pool
+
+    def submit(self, *args):
+        """送出繪圖工作 (參數同 render_trend_png)，回傳 Future"""
+        return self._executor().submit(render_trend_png, *args)
+
+    def shutdown(self):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.shutdown(wait=True)
+
+
+_NAME = re.compile(r"[0-9a-f]{64}")
+
+
+class ChartCache:
+    """圖檔快取：記憶體 LRU (max_bytes) + 磁碟 (最多 max_files 個檔案)"""
+
+    def __init__(self, directory, secret, max_bytes=32 << 20, max_files=5000):
+        self.directory = directory
+        self.secret = secret
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self._memory = OrderedDict()   # 名稱 → PNG bytes
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def name(self, user_id, start_day, end_day, version):
+        """快取鍵 → 檔名 (也是圖片網址的一部分，加入密鑰避免被猜出)"""
+        key = f"{user_id}:{start_day}:{end_day}:{version}".encode('utf-8')
+        return hashlib.sha256(self.secret + key).hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + ".png")
+
+    def get(self, name):
+        """取得圖檔；不存在時回傳 None"""
+        if not _NAME.fullmatch(name):
+            return None
+        with self._lock:
+            data = self._memory.get(name)
+            if data is not None:
+                self._memory.move_to_end(name)
+                return data
+        try:
+            with open(self._path(name), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self._remember(name, data)
+        return data
+
+    def _write(self, path, data):
+        # 先寫暫存檔再原子替換，其他 worker 不會讀到寫到一半的檔案
+        tmp = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def put_job(self, name, args):
+        """記錄繪圖參數 (同 render_trend_png)，供尚未繪好時依名稱繪製"""
+        self._write(self._job_path(name), json.dumps(args).encode('utf-8'))
+
+    def get_job(self, name):
+        """取得繪圖參數；不存在時回傳 None"""
+        if not _NAME.fullmatch(name):
+            return None
+        try:
+            with open(self._job_path(name), "rb") as f:
+                return json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _job_path(self, name):
+        return os.path.join(self.directory, name + ".job")
+
+    def put(self, name, data):
+        self._write(self._path(name), data)
+        try:
+            os.remove(self._job_path(name))
+        except FileNotFoundError:
+            pass
+        self._remember(name, data)
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % 100 == 0
+        if prune:
+            self._prune_disk()
+
+    def _remember(self, name, data):
+        with self._lock:
+            old = self._memory.pop(name, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._memory[name] = data
+            self._bytes += len(data)
+            # 超過上限時丟掉最久未用的，之後改由磁碟提供
+            while self._bytes > self.max_bytes and len(self._memory) > 1:
+                _, evicted = self._memory.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def _prune_disk(self):
+        """磁碟上的圖檔 (含未繪製的工作檔) 超過 max_files 時，刪除最舊的"""
+        try:
+            entries = [e for e in os.scandir(self.directory) if e.name.endswith((".png", ".job"))]
+        except FileNotFoundError:
+            return
+        if len(entries) <= self.max_files:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_files]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,223 @@
+"""Webhook 事件分派
+
+LINE 一次 webhook 可能帶多個事件 (webhook.WebhookEvent)。分派時依來源用戶分組：
+同一用戶的事件依原順序逐一處理，不同用戶則並行處理。
+
+兩種分派器提供相同的 dispatch(events, handle) 介面：
+- EventDispatcher：同步處理，整批完成後 /callback 才回應
+- QueuedDispatcher：放入有界佇列後立即回應，由背景 worker 處理
+"""
+import os
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from structured_log import get_logger
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_QUEUE_SIZE = 1000
+# 佇列滿時等待超過此秒數即記錄警告 (仍繼續等待)
+DEFAULT_ENQUEUE_TIMEOUT = 2.0
+
+log = get_logger("dispatcher")
+
+
+def run_events(events, handle):
+    """依序處理同一來源的事件；單一事件失敗只記錄錯誤"""
+    for event in events:
+        try:
+            handle(event)
+        except Exception:
+            # 事件內容含用戶訊息，不寫進日誌
+            log.exception("event_failed", user_id=getattr(event, "user_id", None),
+                          event_type=getattr(event, "type", None))
+
+
+def group_events_by_user(events):
+    """依來源分組並保留各組內的原始順序 (dict 保留插入順序)"""
+    groups = {}
+    for event in events:
+        groups.setdefault(event.source_key, []).append(event)
+    return groups
+
+
+class EventDispatcher:
+    """把一批事件分派給 handle(event)
+
+    單一事件失敗只會記錄錯誤，不影響同批次的其他事件。
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    def _executor(self):
+        # 執行緒池不可跨 fork 使用，每個 worker 各自建立
+        if self._pool is None or self._pool_pid != os.getpid():
+            with self._pool_lock:
+                if self._pool is None or self._pool_pid != os.getpid():
+                    self._pool = ThreadPoolExecutor(
+                        self.max_workers, thread_name_prefix="event")
+                    self._pool_pid = os.getpid()
+        return self._pool
+
+    def dispatch(self, events, handle):
+        """處理整批事件，全部完成後才返回"""
+        groups = list(group_events_by_user(events).values())
+        if len(groups) == 1:
+            # 只有一位用戶時直接在目前執行緒處理，省下排程成本
+            run_events(groups[0], handle)
+            return
+        pool = self._executor()
+        futures = [pool.submit(run_events, group, handle) for group in groups]
+        for future in futures:
+            future.result()
+
+    def stats(self):
+        return {"mode": "sync"}
+
+    def shutdown(self, timeout=None):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.shutdown(wait=True)
+
+
+class QueuedDispatcher:
+    """非同步分派：事件放入有界佇列後立即返回
+
+    用戶依雜湊固定對應到一個分片 (一個佇列 + 一個執行緒)，同一用戶
+    跨多次 webhook 的事件仍由同一個執行緒依序處理。
+    佇列滿時請求執行緒等到該分片有空位為止 (背壓)，超過 enqueue_timeout 秒
+    記錄警告。事件一律由所屬分片處理：若改在請求執行緒處理，該用戶仍在分片
+    中排隊的較早事件會晚於新事件 (如「同意」先於加好友被處理)。
+    """
+
+    def __init__(self, workers=DEFAULT_MAX_WORKERS, queue_size=DEFAULT_QUEUE_SIZE,
+                 enqueue_timeout=DEFAULT_ENQUEUE_TIMEOUT):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.enqueue_timeout = enqueue_timeout
+        self._shards = None
+        self._threads = []
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._enqueued = 0
+        self._processed = 0
+        self._stalled = 0
+        self._blocked = 0
+        self._max_depth = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _ensure_started(self):
+        # 背景執行緒不會跨 fork 保留，每個 worker 各自啟動
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            per_shard = max(1, self.queue_size // self.workers)
+            self._shards = [queue.Queue(per_shard) for _ in range(self.workers)]
+            self._threads = []
+            for i, shard in enumerate(self._shards):
+                thread = threading.Thread(
+                    target=self._worker, args=(shard,),
+                    name=f"event-queue-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def dispatch(self, events, handle):
+        self._ensure_started()
+        for key, group in group_events_by_user(events).items():
+            # 關閉中仍放進分片：shutdown() 會依序處理分片中剩下的事件
+            shard = self._shards[zlib.crc32((key or "").encode('utf-8')) % self.workers]
+            item = (time.monotonic(), group, handle)
+            try:
+                shard.put_nowait(item)
+            except queue.Full:
+                with self._stats_lock:
+                    self._blocked += 1
+                try:
+                    shard.put(item, timeout=self.enqueue_timeout)
+                except queue.Full:
+                    with self._stats_lock:
+                        self._stalled += 1
+                    log.warning("event_queue_stalled", waited=self.enqueue_timeout,
+                                depth=shard.qsize(), events=len(group))
+                    shard.put(item)
+            with self._stats_lock:
+                self._enqueued += len(group)
+                depth = shard.qsize()
+                if depth > self._max_depth:
+                    self._max_depth = depth
+
+    def _worker(self, shard):
+        while True:
+            item = shard.get()
+            try:
+                if item is None:
+                    return
+                enqueued_at, group, handle = item
+                wait = time.monotonic() - enqueued_at
+                run_events(group, handle)
+                with self._stats_lock:
+                    self._processed += len(group)
+                    self._wait_total += wait
+                    if wait > self._wait_max:
+                        self._wait_max = wait
+            finally:
+                shard.task_done()
+
+    def stats(self):
+        """背壓指標：佇列深度、等待時間與等待空位的次數"""
+        shards = self._shards if self._pid == os.getpid() else []
+        with self._stats_lock:
+            done = self._processed
+            return {
+                "mode": "queued",
+                "workers": self.workers,
+                "capacity": self.queue_size,
+                "depth": sum(shard.qsize() for shard in shards),
+                "max_depth": self._max_depth,
+                "enqueued": self._enqueued,
+                "processed": done,
+                "blocked": self._blocked,
+                "stalled": self._stalled,
+                "wait_avg_ms": round(self._wait_total / done * 1000, 2) if done else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 2),
+            }
+
+    def shutdown(self, timeout=30):
+        """等佇列中的事件處理完 (最多 timeout 秒)"""
+        if self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        for shard in self._shards:
+            try:
+                shard.put(None, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                pass
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        remaining = 0
+        for shard in self._shards:
+            # 關閉前一刻才放進佇列的事件，在目前執行緒補做
+            while True:
+                try:
+                    item = shard.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    continue
+                if time.monotonic() < deadline:
+                    run_events(item[1], item[2])
+                else:
+                    remaining += len(item[1])
+        if remaining:
+            log.warning("shutdown_dropped", events=remaining)
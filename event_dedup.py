@@ -0,0 +1,208 @@
+"""重送事件的去重 (webhookEventId)
+
+/callback 回應太慢時 LINE 會重送同一批事件 (deliveryContext.isRedelivery 為
+true，webhookEventId 不變)；重跑「重新開始」、follow 等轉移會刪除資料或重複
+送出條款。EventDeduplicator 記錄時間窗內收過的 webhookEventId 與處理狀態：
+
+- 收到時記為「處理中」，處理完成後改為「已完成」；處理失敗時移除紀錄，
+  之後的重送會再處理一次
+- 「處理中」超過 lease 秒仍未完成 (例如 worker 在處理途中被終止) 時，重送的
+  事件可以接手處理；lease 內的重送視為另一個 worker 正在處理而略過
+- 固定大小的雜湊表放在檔案中並以 mmap 共用，所有 gunicorn worker 看到同一份，
+  記憶體用量 (slots × 16 bytes) 不隨流量成長；檔案在第一次使用時才建立
+- 表分成每 8 格一組的 bucket；事件 ID 的 64 位元雜湊決定 bucket，查詢與寫入
+  只掃描該組的 8 格 (O(1))。每格存 (雜湊, 時間 | 完成旗標)，超過時間窗即視為
+  空格；整組都在時間窗內時覆蓋最舊的一格 (計入 evicted，表示時間窗實際上變短了)
+- 鎖：行程內為分段 threading.Lock，跨行程為鎖檔上同一分段位元組的 lockf 鎖
+  (與 user_store 相同)
+
+只有標記為重送的事件會被略過；首次送達的事件只記錄，不會因雜湊碰撞被誤刪。
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from lockfile import LockFile
+
+SLOT = struct.Struct("<QQ")
+BUCKET_SLOTS = 8
+BUCKET = struct.Struct(f"<{BUCKET_SLOTS * 2}Q")
+DEFAULT_SLOTS = 1 << 20
+DEFAULT_WINDOW = 24 * 3600
+DEFAULT_LEASE = 60
+DEFAULT_LOCK_STRIPES = 1024
+# 鎖檔中的位元組配置：第 0 位元組用於建立 / 調整表的大小
+INIT_LOCK_BYTE = 0
+BUCKET_LOCK_BASE = 1
+# 時間欄位的最高位元：事件已處理完成 (未設定表示處理中)
+DONE = 1 << 63
+
+# claim() 的結果
+CLAIMED = "claimed"
+PROCESSED = "processed"
+IN_PROGRESS = "in_progress"
+
+
+def fingerprint(event_id):
+    """事件 ID → 非 0 的 64 位元雜湊 (0 代表空格)"""
+    value = int.from_bytes(hashlib.blake2b(event_id.encode('utf-8'), digest_size=8).digest(), "little")
+    return value or 1
+
+
+class EventDeduplicator:
+    """以 webhookEventId 判斷事件是否在 window 秒內已處理或正在處理 (跨 worker 共用)"""
+
+    def __init__(self, path, slots=DEFAULT_SLOTS, window=DEFAULT_WINDOW, lease=DEFAULT_LEASE,
+                 stripes=DEFAULT_LOCK_STRIPES):
+        self.path = path
+        self.buckets = max(1, slots // BUCKET_SLOTS)
+        self.window_ms = int(window * 1000)
+        self.lease_ms = int(lease * 1000)
+        self._lock_file = LockFile(path + ".lock")
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._open_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._checked = 0
+        self._duplicates = 0
+        self._in_progress = 0
+        self._released = 0
+        self._evicted = 0
+        self._map = None
+
+    def _open(self):
+        size = self.buckets * BUCKET.size
+        with self._lock_file.hold(INIT_LOCK_BYTE):
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size != size:
+                    # 大小設定變更時清空重建 (只會損失時間窗內的去重紀錄)
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+                return mmap.mmap(fd, size)
+            finally:
+                # mmap 保有自己的參照，關閉 fd 不影響對應
+                os.close(fd)
+
+    def _table(self):
+        # 第一次使用時才建立檔案 (匯入模組、執行 CLI 指令時不會產生)
+        if self._map is None:
+            with self._open_lock:
+                if self._map is None:
+                    self._map = self._open()
+        return self._map
+
+    def _update(self, event_id, now, change):
+        """在事件所屬的 bucket 上執行 change(values, match, target, key, now)，回傳其結果
+
+        match 為相同雜湊且仍在時間窗內的格 (沒有時為 None)；target 為可寫入的格
+        (空格，沒有空格時為最舊的一格)。change 回傳 (結果, 要寫入的 (雜湊, 時間)
+        或 None, 寫入的格)。
+        """
+        key = fingerprint(event_id)
+        now = int((time.time() if now is None else now) * 1000)
+        table = self._table()
+        bucket = key % self.buckets
+        offset = bucket * BUCKET.size
+        stripe = bucket % len(self._locks)
+        evicted = False
+        with self._locks[stripe], self._lock_file.hold(BUCKET_LOCK_BASE + stripe):
+            values = BUCKET.unpack_from(table, offset)
+            match = free = None
+            oldest = 0
+            for slot in range(BUCKET_SLOTS):
+                stored, seen = values[2 * slot], values[2 * slot + 1] & ~DONE
+                live = stored != 0 and now - seen < self.window_ms
+                if live and stored == key:
+                    match = slot
+                    break
+                if not live:
+                    if free is None:
+                        free = slot
+                elif seen < values[2 * oldest + 1] & ~DONE:
+                    oldest = slot
+            target = oldest if free is None else free
+            result, entry, written = change(values, match, target, key, now)
+            if entry is not None:
+                SLOT.pack_into(table, offset + written * SLOT.size, *entry)
+                evicted = match is None and written == target and free is None
+        if evicted:
+            with self._stats_lock:
+                self._evicted += 1
+        return result
+
+    def claim(self, event_id, now=None):
+        """開始處理 event_id：回傳 CLAIMED (記為處理中)、PROCESSED 或 IN_PROGRESS"""
+        lease_ms = self.lease_ms
+
+        def change(values, match, target, key, now):
+            if match is None:
+                return CLAIMED, (key, now), target
+            seen = values[2 * match + 1]
+            if seen & DONE:
+                return PROCESSED, None, None
+            if now - seen < lease_ms:
+                return IN_PROGRESS, None, None
+            # 處理中的 worker 超過 lease 仍未完成 (可能已被終止)：接手
+            return CLAIMED, (key, now), match
+
+        return self._update(event_id, now, change)
+
+    def finish(self, event_id, now=None):
+        """event_id 已處理完成 (紀錄已被擠出時重新寫入)"""
+        def change(values, match, target, key, now):
+            return None, (key, now | DONE), target if match is None else match
+
+        self._update(event_id, now, change)
+
+    def discard(self, event_id, now=None):
+        """移除 event_id 的紀錄 (處理失敗，讓之後的重送再處理)"""
+        def change(values, match, target, key, now):
+            if match is None:
+                return None, None, None
+            return None, (0, 0), match
+
+        self._update(event_id, now, change)
+
+    def is_duplicate(self, event):
+        """WebhookEvent 是否為已處理過 (或正在處理) 的重送；其餘事件記為處理中
+
+        沒有 webhookEventId 的事件一律處理。回傳 False 的事件處理後須呼叫
+        complete() 或 release()。
+        """
+        if not event.webhook_event_id:
+            return False
+        state = self.claim(event.webhook_event_id)
+        duplicate = state != CLAIMED and event.is_redelivery
+        with self._stats_lock:
+            self._checked += 1
+            self._duplicates += duplicate and state == PROCESSED
+            self._in_progress += duplicate and state == IN_PROGRESS
+        return duplicate
+
+    def complete(self, event):
+        """事件處理成功"""
+        if event.webhook_event_id:
+            self.finish(event.webhook_event_id)
+
+    def release(self, event):
+        """事件處理失敗：移除紀錄，LINE 重送時會再處理"""
+        if event.webhook_event_id:
+            self.discard(event.webhook_event_id)
+            with self._stats_lock:
+                self._released += 1
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "slots": self.buckets * BUCKET_SLOTS,
+                "window": self.window_ms / 1000,
+                "lease": self.lease_ms / 1000,
+                "checked": self._checked,
+                "duplicates": self._duplicates,
+                "in_progress": self._in_progress,
+                "released": self._released,
+                "evicted": self._evicted,
+            }
@@ -0,0 +1,497 @@
+"""血糖機螢幕的七段顯示器數字辨識 (本機快速路徑)
+
+大部分照片是血糖機的螢幕，需要的只是一個 2~3 位數。read_display() 在本機
+以簡單的影像處理讀出七段顯示器上的數字，不必呼叫外部的影像辨識服務：
+
+1. 解碼成灰階並縮小 (JPEG 以 draft 模式在解碼時直接縮小)
+2. Otsu 二值化；深色字與淺色字兩種極性都試，取信心較高者
+3. 膨脹後以列程 (run) 標記連通區域，把同一個數字分開的各段連成一塊；
+   各機型段間的縫隙不同，膨脹半徑由小到大都試，取數字最高的結果
+4. 找出高度相近、上緣對齊、左右相鄰的 2~3 塊 (取最高的一組，即主要讀數)；
+   「1」的上下兩段沒連起來時先合併成一塊
+5. 每個數字取樣七段的填滿比例後查表；數字之間有小數點時視為 mmol/L
+
+信心值取所有段判斷中最不確定的一個。只讀到兩位數、左右一個數字寬內卻還有
+字時 (例如沒讀到開頭的「1」)，不回傳讀數，避免 156 被記成 56。
+
+GlucometerAnalyzer 在信心足夠時直接回傳讀數，否則交給完整的分析器。辨識在
+獨立的行程池中進行 (與 charts 的繪圖相同)，不與 webhook 執行緒搶同一個 GIL。
+需要 Pillow 與 numpy，未安裝時 available() 為 False。
+"""
+import io
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+from blood_sugar import to_mg_dl
+from image_pipeline import GLUCOMETER, UNKNOWN, AnalysisResult, Analyzer
+from structured_log import get_logger
+
+# 縮小後的最長邊 (像素)
+MAX_SIDE = 320
+# 膨脹半徑：連起七段之間的縫隙，但不連到相鄰的數字
+DILATE_RADII = (1, 2, 3, 4)
+MIN_DIGIT_HEIGHT = 12
+# 數字高度 / 寬度的範圍 (「1」只有一段寬，特別窄)
+MIN_ASPECT = 1.2
+MAX_ASPECT = 8.0
+# 寬度 / 高度小於此值的數字視為「1」
+ONE_MAX_WIDTH = 0.4
+# 沒有左側兩段的數字 (3、7) 框較窄；比最寬的數字窄太多時視為辨識錯誤
+MIN_WIDTH_RATIO = 0.6
+# 段的填滿比例超過此值視為亮起；超過 SEGMENT_FULL 時完全確定
+SEGMENT_ON = 0.35
+SEGMENT_FULL = 0.65
+DEFAULT_MIN_CONFIDENCE = 0.5
+DEFAULT_PROCESSES = 1
+# 辨識子行程的 nice 值：CPU 不足時讓 webhook worker 優先
+OCR_NICENESS = 10
+
+# 各段在數字框中的取樣區域 (上, 下, 左, 右)，以數字框的比例表示
+#  aaa
+# f   b
+#  ggg
+# e   c
+#  ddd
+_REGIONS = (
+    ("a", 0.00, 0.18, 0.25, 0.75),
+    ("b", 0.15, 0.45, 0.70, 1.00),
+    ("c", 0.55, 0.85, 0.70, 1.00),
+    ("d", 0.82, 1.00, 0.25, 0.75),
+    ("e", 0.55, 0.85, 0.00, 0.30),
+    ("f", 0.15, 0.45, 0.00, 0.30),
+    ("g", 0.41, 0.59, 0.25, 0.75),
+)
+# 上下兩個「洞」(a/g、g/d 之間) 一定是暗的；實心的色塊會在這裡被排除
+_HOLES = (
+    (0.22, 0.37, 0.35, 0.65),
+    (0.63, 0.78, 0.35, 0.65),
+)
+
+# 亮起的段 → 數字
+_DIGITS = {
+    "abcdef": "0", "bc": "1", "abdeg": "2", "abcdg": "3", "bcfg": "4",
+    "acdfg": "5", "acdefg": "6", "abc": "7", "abcdefg": "8", "abcdfg": "9",
+    # 部分機型的 6、7、9 少一段或多一段
+    "cdefg": "6", "abcf": "7", "abcfg": "9",
+}
+
+LOW_CONFIDENCE_REPLY = (
+    "📷 無法從照片辨識出血糖數值。\n\n"
+    "請對準血糖機螢幕重新拍攝，或直接輸入數值，例如：120 或 早餐後血糖 140"
+)
+
+log = get_logger("ocr")
+
+
+def available():
+    return numpy is not None and Image is not None
+
+
+class DisplayReading:
+    """螢幕上讀到的數值
+
+    - text：顯示的數字 ("123"、"6.8")
+    - mg_dl：換算後的 mg/dL 整數
+    - confidence：0 ~ 1
+    """
+
+    __slots__ = ("text", "mg_dl", "confidence")
+
+    def __init__(self, text, mg_dl, confidence):
+        self.text = text
+        self.mg_dl = mg_dl
+        self.confidence = confidence
+
+    def __repr__(self):
+        return f"DisplayReading({self.text!r}, mg_dl={self.mg_dl}, confidence={self.confidence:.2f})"
+
+
+def load_gray(data, max_side=MAX_SIDE):
+    """圖片 bytes → 縮小後的灰階 numpy 陣列 (依 EXIF 轉正)"""
+    image = Image.open(io.BytesIO(data))
+    image.draft("L", (max_side, max_side))
+    image = ImageOps.exif_transpose(image).convert("L")
+    image.thumbnail((max_side, max_side))
+    return numpy.asarray(image)
+
+
+def otsu_threshold(gray):
+    """Otsu 法求二值化門檻 (類間變異最大的灰階值)"""
+    histogram = numpy.bincount(gray.ravel(), minlength=256).astype(numpy.float64)
+    levels = numpy.arange(256)
+    weight = numpy.cumsum(histogram)
+    total = weight[-1]
+    mean = numpy.cumsum(histogram * levels)
+    background = weight[:-1]
+    foreground = total - background
+    valid = (background > 0) & (foreground > 0)
+    between = numpy.zeros(255)
+    mu_b = mean[:-1][valid] / background[valid]
+    mu_f = (mean[-1] - mean[:-1][valid]) / foreground[valid]
+    between[valid] = background[valid] * foreground[valid] * (mu_b - mu_f) ** 2
+    return int(numpy.argmax(between))
+
+
+def dilate(mask, radius):
+    """十字形膨脹 radius 次"""
+    for _ in range(radius):
+        grown = mask.copy()
+        grown[1:] |= mask[:-1]
+        grown[:-1] |= mask[1:]
+        grown[:, 1:] |= mask[:, :-1]
+        grown[:, :-1] |= mask[:, 1:]
+        mask = grown
+    return mask
+
+
+def components(mask):
+    """以列程標記 4 連通區域，回傳 [(上, 下, 左, 右)]，下與右不含
+
+    每列先以 numpy 找出連續的前景區段，再與上一列重疊的區段合併
+    (union-find)，Python 迴圈只走訪區段而非像素。
+    """
+    parent = []
+    boxes = []
+
+    def find(label):
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]
+            label = parent[label]
+        return label
+
+    previous = []
+    for y, row in enumerate(mask):
+        edges = numpy.flatnonzero(numpy.diff(row.view(numpy.int8), prepend=0, append=0))
+        current = []
+        j = 0
+        for start, end in zip(edges[0::2].tolist(), edges[1::2].tolist()):
+            while j < len(previous) and previous[j][1] <= start:
+                j += 1
+            label = None
+            k = j
+            while k < len(previous) and previous[k][0] < end:
+                other = find(previous[k][2])
+                if label is None:
+                    label = other
+                elif other != label:
+                    parent[other] = label
+                    top, bottom, left, right = boxes[other]
+                    box = boxes[label]
+                    box[0] = min(box[0], top)
+                    box[1] = max(box[1], bottom)
+                    box[2] = min(box[2], left)
+                    box[3] = max(box[3], right)
+                k += 1
+            if label is None:
+                label = len(parent)
+                parent.append(label)
+                boxes.append([y, y + 1, start, end])
+            else:
+                box = boxes[label]
+                box[1] = y + 1
+                box[2] = min(box[2], start)
+                box[3] = max(box[3], end)
+            current.append((start, end, label))
+        previous = current
+    return [tuple(box) for label, box in enumerate(boxes) if parent[label] == label]
+
+
+def _segment_confidence(fill, on):
+    if on:
+        return min(1.0, (fill - SEGMENT_ON) / (SEGMENT_FULL - SEGMENT_ON))
+    return (SEGMENT_ON - fill) / SEGMENT_ON
+
+
+def _fill(cell, y0, y1, x0, x1):
+    """數字框中一塊區域 (以比例表示) 的前景比例"""
+    height, width = cell.shape
+    top, left = int(y0 * height), int(x0 * width)
+    return float(cell[top:max(int(y1 * height), top + 1), left:max(int(x1 * width), left + 1)].mean())
+
+
+def decode_digit(mask, box):
+    """數字框 → (數字, 信心)；無法對應到數字時回傳 (None, 0)"""
+    top, bottom, left, right = box
+    cell = mask[top:bottom, left:right]
+    height, width = cell.shape
+    if width < ONE_MAX_WIDTH * height:
+        # 「1」：整個框就是一直條
+        fill = float(cell.mean())
+        return "1", max(0.0, min(1.0, (fill - SEGMENT_ON) / (SEGMENT_FULL - SEGMENT_ON)))
+    lit = []
+    confidence = 1.0
+    for name, y0, y1, x0, x1 in _REGIONS:
+        fill = _fill(cell, y0, y1, x0, x1)
+        on = fill > SEGMENT_ON
+        if on:
+            lit.append(name)
+        confidence = min(confidence, _segment_confidence(fill, on))
+    for y0, y1, x0, x1 in _HOLES:
+        fill = _fill(cell, y0, y1, x0, x1)
+        if fill > SEGMENT_ON:
+            return None, 0.0
+        confidence = min(confidence, _segment_confidence(fill, False))
+    digit = _DIGITS.get("".join(lit))
+    if digit is None:
+        return None, 0.0
+    return digit, confidence
+
+
+def _is_narrow(box):
+    return box[3] - box[2] < ONE_MAX_WIDTH * (box[1] - box[0])
+
+
+def stacked_ones(boxes):
+    """上下兩段 (b、c) 分開的「1」→ 合併後的數字框
+
+    兩個窄框左右重疊、上下只隔一道縫、高度相近，且左右兩側沒有緊鄰的橫段
+    (那是沒連起來的 8、0 等數字的 b/c 或 f/e 兩段) 時，視為單獨的「1」。
+    """
+    narrow = sorted((box for box in boxes if _is_narrow(box)), key=lambda box: box[0])
+    bars = [box for box in boxes if box[3] - box[2] >= box[1] - box[0]]
+    ones = []
+    for i, upper in enumerate(narrow):
+        height = upper[1] - upper[0]
+        for lower in narrow[i + 1:]:
+            if lower[0] - upper[1] > 0.25 * height:
+                break
+            if (abs((lower[1] - lower[0]) - height) > 0.3 * height
+                    or min(upper[3], lower[3]) - max(upper[2], lower[2])
+                    < 0.5 * min(upper[3] - upper[2], lower[3] - lower[2])):
+                continue
+            box = (upper[0], lower[1], min(upper[2], lower[2]), max(upper[3], lower[3]))
+            reach = 0.25 * height
+            if not any(bar[0] >= box[0] and bar[1] <= box[1]
+                       and bar[2] - reach <= box[3] and bar[3] + reach >= box[2] for bar in bars):
+                ones.append(box)
+            break
+    return ones
+
+
+def find_digit_row(boxes, image_height):
+    """找出主要讀數的數字框：高度相近、上緣對齊、左右相鄰的 2~3 個，取最高的一組
+
+    合併而成的「1」可能比 MAX_ASPECT 更細長，不受寬高比限制。
+    """
+    ones = stacked_ones(boxes)
+    candidates = sorted(
+        [box for box in boxes
+         if MIN_DIGIT_HEIGHT <= box[1] - box[0] <= 0.9 * image_height
+         and MIN_ASPECT <= (box[1] - box[0]) / (box[3] - box[2]) <= MAX_ASPECT]
+        + [box for box in ones if MIN_DIGIT_HEIGHT <= box[1] - box[0] <= 0.9 * image_height],
+        key=lambda box: box[2]
+    )
+    best = None
+    for i, first in enumerate(candidates):
+        height = first[1] - first[0]
+        row = [first]
+        for box in candidates[i + 1:]:
+            last = row[-1]
+            gap = box[2] - last[3]
+            if gap > 0.8 * height:
+                break
+            if (abs((box[1] - box[0]) - height) <= 0.2 * height
+                    and abs(box[0] - first[0]) <= 0.2 * height and gap >= -0.1 * height):
+                row.append(box)
+        if 2 <= len(row) <= 3 and (best is None or (height, len(row)) > (best[0][1] - best[0][0], len(best))):
+            best = row
+    return best
+
+
+def unread_digit_beside(boxes, row):
+    """兩位數的左右一個數字寬內、數字的高度範圍中還有字 (可能是沒讀到的開頭或結尾數字)"""
+    if len(row) != 2:
+        return False
+    top, bottom, left, right = row[0][0], row[0][1], row[0][2], row[-1][3]
+    height = bottom - top
+    pitch = row[1][2] - left
+    for box in boxes:
+        if box in row or box[1] - box[0] < 0.4 * height:
+            continue
+        if box[0] < top - 0.2 * height or box[1] > bottom + 0.2 * height:
+            continue
+        if left - pitch <= box[3] <= left or right <= box[2] <= right + pitch:
+            return True
+    return False
+
+
+def find_decimal_point(boxes, row, radius):
+    """數字之間、靠近底線的小點 → 小數點後的位數；沒有時回傳 None"""
+    height = row[0][1] - row[0][0]
+    baseline = max(box[1] for box in row)
+    for top, bottom, left, right in boxes:
+        if bottom - top > 0.25 * height or right - left > 0.25 * height:
+            continue
+        if abs(bottom - baseline) > 0.15 * height:
+            continue
+        center = (left + right) / 2
+        for i in range(len(row) - 1):
+            if row[i][3] - radius <= center <= row[i + 1][2] + radius:
+                return len(row) - 1 - i
+    return None
+
+
+def _read_mask(mask, radius):
+    """以指定的膨脹半徑讀取，回傳 (數字高度, DisplayReading)；讀不到時回傳 None"""
+    boxes = components(dilate(mask, radius))
+    row = find_digit_row(boxes, mask.shape[0])
+    if row is None or unread_digit_beside(boxes, row):
+        return None
+    # 還原膨脹前的範圍
+    boxes_in_row = [(top + radius, bottom - radius, left + radius, right - radius)
+                    for top, bottom, left, right in row]
+    widths = [box[3] - box[2] for box in boxes_in_row if not _is_narrow(box)]
+    widest = max(widths, default=0)
+    if widths and min(widths) < MIN_WIDTH_RATIO * widest:
+        return None
+    digits = []
+    confidence = 1.0
+    for top, bottom, left, right in boxes_in_row:
+        if not _is_narrow((top, bottom, left, right)):
+            # 七段數字靠右對齊：較窄的數字往左補齊到同樣寬度
+            left = max(0, right - widest)
+        digit, digit_confidence = decode_digit(mask, (top, bottom, left, right))
+        if digit is None:
+            return None
+        digits.append(digit)
+        confidence = min(confidence, digit_confidence)
+    if all(digit == "1" for digit in digits):
+        # 幾條直線也會被讀成 1，單獨出現時不可靠
+        confidence *= 0.5
+    decimals = find_decimal_point(boxes, row, radius)
+    if decimals is None:
+        text = "".join(digits)
+        mg_dl = to_mg_dl(text, "mg/dl")
+    else:
+        text = "".join(digits[:-decimals]) + "." + "".join(digits[-decimals:])
+        mg_dl = to_mg_dl(text, "mmol/l")
+    if mg_dl is None:
+        return None
+    return row[0][1] - row[0][0] - 2 * radius, DisplayReading(text, mg_dl, confidence)
+
+
+def read_display(data):
+    """圖片 bytes → DisplayReading；找不到七段數字時回傳 None
+
+    半徑太小時一個數字會斷成數段 (各段只有數字一半高) 或漏掉沒連起來的
+    數字，因此各種極性與膨脹半徑中取數字最高、位數最多的結果，再取信心較高者。
+    """
+    gray = load_gray(data)
+    threshold = otsu_threshold(gray)
+    best = None
+    best_key = None
+    for mask in (gray <= threshold, gray > threshold):
+        for radius in DILATE_RADII:
+            found = _read_mask(mask, radius)
+            if found is None:
+                continue
+            height, reading = found
+            key = (height, len(reading.text), reading.confidence)
+            if best_key is None or key > best_key:
+                best, best_key = reading, key
+    return best
+
+
+def _lower_priority():
+    if hasattr(os, "nice"):
+        os.nice(OCR_NICENESS)
+
+
+class GlucometerAnalyzer(Analyzer):
+    """先以七段顯示器辨識讀取血糖機螢幕，信心不足時才交給 fallback 分析器
+
+    fallback 為 None 時，辨識不出數值的照片回覆請用戶重拍或直接輸入。
+
+    辨識的 Python 迴圈會持有 GIL，在 webhook worker 的執行緒中進行時會拖慢
+    同一行程的所有請求。因此辨識交給最多 processes 個較低優先權的子行程 (以
+    spawn 啟動、各 worker 首次使用時各自建立，理由同 charts.ChartRenderer)，
+    分析執行緒只等待結果；processes 為 0 時在呼叫端的執行緒中辨識。
+    """
+
+    def __init__(self, fallback=None, min_confidence=DEFAULT_MIN_CONFIDENCE,
+                 processes=DEFAULT_PROCESSES):
+        self.fallback = fallback
+        self.min_confidence = min_confidence
+        self.processes = processes
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._read = 0
+        self._escalated = 0
+        self._elapsed_total = 0.0
+
+    def _executor(self):
+        if self._pool is None or self._pool_pid != os.getpid():
+            with self._pool_lock:
+                if self._pool is None or self._pool_pid != os.getpid():
+                    self._pool = ProcessPoolExecutor(
+                        self.processes, mp_context=multiprocessing.get_context("spawn"),
+                        initializer=_lower_priority)
+                    self._pool_pid = os.getpid()
+        return self._pool
+
+    def _read_display(self, data):
+        if not self.processes:
+            return read_display(data)
+        pool = self._executor()
+        try:
+            return pool.submit(read_display, data).result()
+        except BrokenProcessPool:
+            # 子行程異常結束 (例如被 OOM killer 終止)：下一張照片重建行程池
+            with self._pool_lock:
+                if self._pool is pool:
+                    self._pool = None
+            raise
+
+    def analyze(self, chunks, content_type):
+        data = b"".join(chunks)
+        started = time.perf_counter()
+        try:
+            reading = self._read_display(data)
+        except Exception:
+            log.exception("ocr_failed")
+            reading = None
+        elapsed = time.perf_counter() - started
+        confident = reading is not None and reading.confidence >= self.min_confidence
+        with self._lock:
+            self._elapsed_total += elapsed
+            if confident:
+                self._read += 1
+            else:
+                self._escalated += 1
+        if confident:
+            return AnalysisResult(
+                GLUCOMETER, f"📷 從照片讀到血糖 {reading.mg_dl} mg/dL", reading=reading.mg_dl
+            )
+        if self.fallback is not None:
+            return self.fallback.analyze(iter((data,)), content_type)
+        return AnalysisResult(UNKNOWN, LOW_CONFIDENCE_REPLY)
+
+    def shutdown(self):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            total = self._read + self._escalated
+            return {
+                "read": self._read,
+                "escalated": self._escalated,
+                "fast_path_rate": round(self._read / total, 4) if total else 0.0,
+                "fast_path_avg_ms": round(self._elapsed_total / total * 1000, 2) if total else 0.0,
+            }
@@ -0,0 +1,360 @@
+"""圖片訊息的非同步分析
+
+webhook 收到圖片時只做兩件事：把工作交給 ImagePipeline、用 reply token
+回覆「分析中」。下載與分析在有界的執行緒池中進行，完成後以 push 推送結果，
+幾 MB 的照片不會佔住 webhook 執行緒，也不會等到 reply token 過期。
+
+- iter_message_content()：以串流逐塊讀取 LINE 的訊息內容，超過上限即中止
+- Analyzer：分析器介面，analyze(chunks, content_type) → AnalysisResult
+- StubAnalyzer：本機測試用，不需額外套件，只讀出圖片格式與尺寸
+- ImagePipeline：有界佇列 + 執行緒池，佇列滿時 submit() 回傳 False
+- ResultCache：以 (用戶, 圖片內容的 SHA-256) 快取分析結果，同一用戶重傳的照片不再分析
+
+IMAGE_ANALYZER 設定分析器："stub" 或 "模組:函式" (回傳 Analyzer 的工廠函式)。
+"""
+import hashlib
+import importlib
+import os
+import struct
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+
+from answer_cache import AnswerCache
+from message_templates import check_response, push_message
+from structured_log import get_logger
+
+CONTENT_PATH = '/v2/bot/message/{message_id}/content'
+CHUNK_SIZE = 64 * 1024
+# LINE 圖片訊息的上限為 10 MB
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 50
+DEFAULT_FETCH_TIMEOUT = (3.05, 20)
+
+# 分析結果的類型
+GLUCOMETER = "glucometer"
+DRUG_LABEL = "drug_label"
+NUTRITION = "nutrition"
+UNKNOWN = "unknown"
+
+ANALYSIS_FAILED_REPLY = "😥 照片分析失敗，請稍後再傳一次，或直接輸入血糖數值。"
+TOO_LARGE_REPLY = "😥 照片太大了，請重新拍攝或壓縮後再傳一次。"
+
+log = get_logger("image")
+
+
+class ImageTooLarge(Exception):
+    """圖片超過大小上限"""
+
+
+class AnalysisResult:
+    """分析結果
+
+    - kind：GLUCOMETER / DRUG_LABEL / NUTRITION / UNKNOWN
+    - text：要推送給用戶的文字
+    - reading：辨識出的血糖數值 (mg/dL)，沒有時為 None
+    - duplicate：內容與先前分析過的圖片相同 (取自快取)
+    """
+
+    __slots__ = ("kind", "text", "reading", "duplicate")
+
+    def __init__(self, kind, text, reading=None, duplicate=False):
+        self.kind = kind
+        self.text = text
+        self.reading = reading
+        self.duplicate = duplicate
+
+    def __repr__(self):
+        return f"AnalysisResult(kind={self.kind!r}, reading={self.reading!r})"
+
+
+class Analyzer:
+    """分析器介面
+
+    analyze() 在背景執行緒中呼叫；chunks 為圖片內容的 bytes 區塊 (只能走訪一次)，
+    分析器可邊讀邊處理，不必先組成完整的 bytes。
+    """
+
+    def analyze(self, chunks, content_type):
+        raise NotImplementedError
+
+
+def image_size(header):
+    """由檔頭讀出 (格式, 寬, 高)；無法辨識時回傳 (None, None, None)"""
+    if header.startswith(b"\x89PNG\r\n\x1a\n") and len(header) >= 24:
+        width, height = struct.unpack(">II", header[16:24])
+        return "PNG", width, height
+    if header.startswith(b"\xff\xd8"):
+        # JPEG：找到 SOF 區段讀出尺寸
+        i = 2
+        while i + 9 < len(header):
+            if header[i] != 0xFF:
+                i += 1
+                continue
+            marker = header[i + 1]
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                i += 2
+                continue
+            length = struct.unpack(">H", header[i + 2:i + 4])[0]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", header[i + 5:i + 9])
+                return "JPEG", width, height
+            i += 2 + length
+        return "JPEG", None, None
+    return None, None, None
+
+
+class StubAnalyzer(Analyzer):
+    """本機測試用的分析器：只讀出圖片格式、尺寸與大小"""
+
+    HEADER_BYTES = 64 * 1024
+
+    def analyze(self, chunks, content_type):
+        header = b""
+        size = 0
+        for chunk in chunks:
+            if len(header) < self.HEADER_BYTES:
+                header += chunk[:self.HEADER_BYTES - len(header)]
+            size += len(chunk)
+        fmt, width, height = image_size(header)
+        dimension = f"{width}×{height}，" if width else ""
+        return AnalysisResult(
+            UNKNOWN,
+            f"📷 已收到您的照片 ({fmt or content_type or '未知格式'}，{dimension}{size / 1024:.0f} KB)。\n\n"
+            "🔧 影像辨識服務尚未設定，目前無法分析照片內容。"
+        )
+
+
+def load_analyzer(spec):
+    """IMAGE_ANALYZER 設定 → Analyzer；未設定時回傳 None"""
+    if not spec:
+        return None
+    if spec == "stub":
+        return StubAnalyzer()
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name or "create_analyzer")()
+
+
+def iter_message_content(line_bot_api, message_id, max_bytes=DEFAULT_MAX_BYTES,
+                         chunk_size=CHUNK_SIZE, timeout=DEFAULT_FETCH_TIMEOUT):
+    """逐塊產出訊息內容 (bytes)；超過 max_bytes 時丟出 ImageTooLarge
+
+    回傳 (content_type, 區塊產生器)。產生器結束 (或中途關閉) 時釋放連線。
+    """
+    response = line_bot_api.http_client.get(
+        line_bot_api.data_endpoint + CONTENT_PATH.format(message_id=message_id),
+        headers=line_bot_api.headers, stream=True, timeout=timeout
+    )
+    check_response(response)
+    length = response.headers.get('Content-Length')
+    if length is not None and length.isdigit() and int(length) > max_bytes:
+        response.response.close()
+        raise ImageTooLarge(int(length))
+
+    def chunks():
+        received = 0
+        try:
+            for chunk in response.iter_content(chunk_size):
+                received += len(chunk)
+                if received > max_bytes:
+                    raise ImageTooLarge(received)
+                yield chunk
+        finally:
+            response.response.close()
+
+    return response.headers.get('Content-Type'), chunks()
+
+
+class ResultCache(AnswerCache):
+    """以用戶與圖片內容雜湊為鍵的分析結果快取 (LRU + TTL，限制筆數與記憶體用量)
+
+    用戶常重傳同一張血糖機照片；LINE 的 webhook 不附內容雜湊，仍須下載才能
+    比對，但命中時可省下整個分析。鍵包含用戶，命中的回覆 (「先前已辨識過」)
+    不會透露其他用戶傳過同一張照片。
+    """
+
+    def sizeof(self, key, value):
+        return sys.getsizeof(key) + sys.getsizeof(value) + sys.getsizeof(value.text)
+
+
+class ImagePipeline:
+    """圖片分析的有界工作池
+
+    同時進行 (含排隊) 的工作最多 workers + queue_size 件，超過時 submit()
+    回傳 False，由呼叫端回覆「忙碌中」。結果以 deliver(line_bot_api, user_id,
+    result, timestamp) 交回 (timestamp 為事件時間，毫秒)；預設為推送文字訊息。
+
+    有 cache (ResultCache) 時，下載的同時計算 SHA-256 並暫存各區塊 (不另外
+    組成完整的 bytes)，雜湊命中就直接使用快取的結果；沒有 cache 時邊下載邊分析。
+    """
+
+    def __init__(self, analyzer, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE,
+                 max_bytes=DEFAULT_MAX_BYTES, deliver=None, cache=None):
+        self.analyzer = analyzer
+        self.cache = cache
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_bytes = max_bytes
+        self.deliver = deliver or (lambda line_bot_api, user_id, result, timestamp:
+                                   push_result(line_bot_api, user_id, result))
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._submitted = 0
+        self._in_flight = 0
+        self._rejected = 0
+        self._completed = 0
+        self._failed = 0
+        self._too_large = 0
+        self._bytes = 0
+        self._elapsed_total = 0.0
+        self._deduplicated = 0
+        self._bytes_saved = 0
+
+    def _executor(self):
+        # 執行緒池不可跨 fork 使用，每個 worker 各自建立
+        if self._pool is None or self._pool_pid != os.getpid():
+            with self._pool_lock:
+                if self._pool is None or self._pool_pid != os.getpid():
+                    self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="image")
+                    self._pool_pid = os.getpid()
+        return self._pool
+
+    def submit(self, line_bot_api, user_id, message_id, timestamp=None):
+        """排入分析工作；佇列已滿時回傳 False
+
+        timestamp 為事件時間 (毫秒)，原樣交給 deliver；讀到的血糖以此時間記錄，
+        而不是排隊、分析完成的時間。
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._stats_lock:
+                self._rejected += 1
+            return False
+        try:
+            self._executor().submit(self._run, line_bot_api, user_id, message_id, timestamp)
+        except RuntimeError:
+            # 關閉中
+            self._slots.release()
+            return False
+        with self._stats_lock:
+            self._submitted += 1
+            self._in_flight += 1
+        return True
+
+    def _run(self, line_bot_api, user_id, message_id, timestamp):
+        try:
+            result = self.process(line_bot_api, user_id, message_id)
+            self.deliver(line_bot_api, user_id, result, timestamp)
+        except Exception:
+            log.exception("image_delivery_failed", user_id=user_id, message_id=message_id)
+        finally:
+            with self._stats_lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+    def process(self, line_bot_api, user_id, message_id):
+        """下載並分析一張圖片 (邊下載邊分析)，回傳 AnalysisResult (失敗時為說明錯誤的結果)"""
+        received = 0
+        started = time.perf_counter()
+
+        def counting(chunks):
+            nonlocal received
+            for chunk in chunks:
+                received += len(chunk)
+                yield chunk
+
+        try:
+            content_type, chunks = iter_message_content(line_bot_api, message_id, self.max_bytes)
+            if self.cache is None:
+                result = self.analyzer.analyze(counting(chunks), content_type)
+            else:
+                digest = hashlib.sha256()
+                buffered = []
+                for chunk in counting(chunks):
+                    digest.update(chunk)
+                    buffered.append(chunk)
+                key = f"{user_id}:{digest.hexdigest()}"
+                result = self.cache.get(key)
+                if result is not None:
+                    result = AnalysisResult(result.kind, result.text, result.reading, duplicate=True)
+                    with self._stats_lock:
+                        self._deduplicated += 1
+                        self._bytes_saved += received
+                        self._completed += 1
+                        self._bytes += received
+                        self._elapsed_total += time.perf_counter() - started
+                    return result
+                result = self.analyzer.analyze(iter(buffered), content_type)
+                self.cache.put(key, result)
+        except ImageTooLarge:
+            with self._stats_lock:
+                self._too_large += 1
+            return AnalysisResult(UNKNOWN, TOO_LARGE_REPLY)
+        except Exception:
+            log.exception("image_analysis_failed", message_id=message_id)
+            with self._stats_lock:
+                self._failed += 1
+            return AnalysisResult(UNKNOWN, ANALYSIS_FAILED_REPLY)
+        with self._stats_lock:
+            self._completed += 1
+            self._bytes += received
+            self._elapsed_total += time.perf_counter() - started
+        return result
+
+    def stats(self):
+        with self._stats_lock:
+            done = self._completed
+            return {
+                "workers": self.workers,
+                "capacity": self.workers + self.queue_size,
+                "submitted": self._submitted,
+                "rejected": self._rejected,
+                "completed": done,
+                "failed": self._failed,
+                "too_large": self._too_large,
+                "bytes": self._bytes,
+                "in_flight": self._in_flight,
+                "process_avg_ms": round(self._elapsed_total / done * 1000, 2) if done else 0.0,
+                "deduplicated": self._deduplicated,
+                "bytes_saved": self._bytes_saved,
+                "cache": self.cache.stats() if self.cache is not None else None,
+                "analyzer": self.analyzer.stats() if hasattr(self.analyzer, "stats") else None,
+            }
+
+    def shutdown(self, wait=True):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.shutdown(wait=wait)
+
+
+PUSH_ATTEMPTS = 3
+
+
+def push_result(line_bot_api, user_id, result):
+    """以 push 推送分析結果
+
+    連線錯誤與 5xx 時重試；同一個 retry key 的請求 LINE 只會送出一次
+    (已送出時回應 409)，重試不會重複推送。
+    """
+    retry_key = str(uuid.uuid4())
+    for attempt in range(1, PUSH_ATTEMPTS + 1):
+        try:
+            push_message(line_bot_api, user_id, TextSendMessage(result.text), retry_key=retry_key)
+            return
+        except LineBotApiError as e:
+            if e.status_code == 409:
+                return
+            if e.status_code < 500 or attempt == PUSH_ATTEMPTS:
+                raise
+        except requests.RequestException:
+            if attempt == PUSH_ATTEMPTS:
+                raise
+        time.sleep(0.5 * 2 ** (attempt - 1))
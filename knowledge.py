@@ -0,0 +1,413 @@
+"""糖尿病知識庫檢索 (問答的檢索部分)
+
+- tokenize()：繁體中文以字元 unigram + bigram 切詞，英文與數字以詞為單位
+- load_passages()：讀取知識庫目錄中的 Markdown，每個「## 標題」為一個段落，
+  過長的段落再依行切成不超過 MAX_PASSAGE_CHARS 字的片段
+- BM25Index：倒排索引，詞 → 連續存放的 (段落編號, BM25 權重)
+- KnowledgeBase：BM25 檢索，另可加上稠密向量 (numpy 記憶體映射矩陣) 做混合排序
+
+BM25 權重在建立索引時就算好，查詢只需把各詞的權重加總。
+索引唯讀，倒排串列放在連續的緩衝區中：可以是記憶體中的 array
+(KnowledgeBase.build)，也可以是離線建好的索引檔的 mmap (見 knowledge_index)，
+後者所有 worker 共用頁面快取、開啟時不必複製。
+"""
+import bisect
+import heapq
+import importlib
+import math
+import os
+import re
+import unicodedata
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from structured_log import get_logger
+
+# BM25 參數
+K1 = 1.2
+B = 0.75
+
+# 混合排序 (reciprocal rank fusion) 的常數
+RRF_K = 60
+# 稠密向量從 BM25 前 k * DENSE_CANDIDATES 筆以外也可以補入的候選數
+DENSE_CANDIDATES = 4
+
+# 命中的倒排筆數超過此值時以 numpy 加總分數
+NUMPY_MIN_POSTINGS = 2000
+
+# 段落超過此字數時切成多個片段
+MAX_PASSAGE_CHARS = 600
+
+# 最佳段落至少要涵蓋查詢中這個比例的 IDF 權重才算相關
+MIN_COVERAGE = 0.2
+
+# 中文字 (含擴充 A 區與相容字)
+_CJK = r"㐀-䶿一-鿿豈-﫿"
+_TOKEN = re.compile(rf"[{_CJK}]+|[a-z0-9]+(?:\.[0-9]+)?")
+
+# 單字時略過的虛字；仍會出現在 bigram 中 (如「可以」、「什麼」)
+_STOP_CHARS = frozenset("的了是嗎呢吧啊呀喔哦嘛我你他她它們在和與及或也都就很還要會能可以這那個")
+
+_HEADING = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+
+log = get_logger("knowledge")
+
+
+def normalize(text):
+    """全形 → 半形、英文小寫 (NFKC)"""
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def tokenize(text):
+    """切詞：中文連續字串產生單字與相鄰兩字，英數字整個詞為一個詞"""
+    tokens = []
+    for match in _TOKEN.finditer(normalize(text)):
+        word = match.group()
+        if word[0] > "\x7f":
+            tokens.extend(char for char in word if char not in _STOP_CHARS)
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    return tokens
+
+
+class Passage:
+    """知識庫中的一個段落"""
+
+    __slots__ = ("doc", "title", "text")
+
+    def __init__(self, doc, title, text):
+        self.doc = doc        # 所屬文件的標題
+        self.title = title    # 段落標題
+        self.text = text
+
+    def __repr__(self):
+        return f"Passage(doc={self.doc!r}, title={self.title!r})"
+
+
+def parse_markdown(doc, text):
+    """Markdown → 段落列表；「# 標題」為文件標題，「## 標題」開始新段落"""
+    passages = []
+    title = None
+    lines = []
+
+    def flush():
+        body = "\n".join(lines).strip()
+        if body:
+            passages.append(Passage(doc, title or doc, body))
+        lines.clear()
+
+    for line in text.splitlines():
+        match = _HEADING.match(line)
+        if match is None:
+            lines.append(line)
+            continue
+        if len(match.group(1)) == 1:
+            flush()
+            doc = match.group(2)
+            title = None
+        else:
+            flush()
+            title = match.group(2)
+    flush()
+    return passages
+
+
+def split_passage(passage, max_chars=MAX_PASSAGE_CHARS):
+    """過長的段落依行切成不超過 max_chars 字的片段 (沿用同一個標題)"""
+    if len(passage.text) <= max_chars:
+        return [passage]
+    chunks = []
+    lines = []
+    size = 0
+    for line in passage.text.splitlines():
+        if lines and size + len(line) > max_chars:
+            chunks.append("\n".join(lines))
+            lines = []
+            size = 0
+        lines.append(line)
+        size += len(line) + 1
+    if lines:
+        chunks.append("\n".join(lines))
+    return [Passage(passage.doc, passage.title, chunk) for chunk in chunks]
+
+
+def source_files(directory):
+    """目錄中的 .md / .txt 檔名 (依檔名排序)；目錄不存在時回傳空列表"""
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return []
+    return [name for name in names if os.path.splitext(name)[1].lower() in (".md", ".txt")]
+
+
+def parse_document(name, text):
+    """一份文件 → 切好的段落列表 (文件標題預設為檔名)"""
+    stem = os.path.splitext(name)[0]
+    return [chunk for passage in parse_markdown(stem, text) for chunk in split_passage(passage)]
+
+
+def load_passages(directory):
+    """讀取目錄中所有 .md / .txt 檔 (依檔名排序)"""
+    passages = []
+    for name in source_files(directory):
+        with open(os.path.join(directory, name), encoding="utf-8") as f:
+            passages.extend(parse_document(name, f.read()))
+    return passages
+
+
+def unknown_term_idf(idf):
+    """沒出現過的詞在涵蓋率中的權重：視同罕見的詞 (IDF 的第 90 百分位)
+
+    不用最大值，以免新增一個只出現一次的詞就改變所有問題的涵蓋率。
+    """
+    if not len(idf):
+        return 0.0
+    values = sorted(idf)
+    return values[int((len(values) - 1) * 0.9)]
+
+
+class BM25Index:
+    """BM25 倒排索引 (唯讀)
+
+    - terms：詞 → 詞編號 (有 get() 的對照表)
+    - offsets[t]:offsets[t + 1]：詞 t 在 postings / weights 中的範圍
+    - postings：段落編號 (uint32，同一詞內遞增)；weights：該詞在該段落的 BM25 權重 (float32)
+    - idf：各詞的 IDF
+    - size：段落數
+
+    各欄位可以是 array 或 mmap 的 memoryview。
+    """
+
+    __slots__ = ("terms", "offsets", "postings", "weights", "idf", "unknown_idf", "size")
+
+    def __init__(self, terms, offsets, postings, weights, idf, size, unknown_idf=None):
+        self.terms = terms
+        self.offsets = offsets
+        self.postings = postings
+        self.weights = weights
+        self.idf = idf
+        self.size = size
+        if unknown_idf is None:
+            unknown_idf = unknown_term_idf(idf)
+        self.unknown_idf = unknown_idf
+
+    @classmethod
+    def build(cls, documents, k1=K1, b=B):
+        """documents：每個段落的詞列表"""
+        counts = []
+        lengths = []
+        postings_of = {}
+        for doc_id, tokens in enumerate(documents):
+            tf = {}
+            for token in tokens:
+                tf[token] = tf.get(token, 0) + 1
+            counts.append(tf)
+            lengths.append(len(tokens))
+            for token in tf:
+                postings_of.setdefault(token, []).append(doc_id)
+        n = len(documents)
+        avgdl = sum(lengths) / n if n else 0.0
+        terms = {}
+        offsets = array("I", [0])
+        postings = array("I")
+        weights = array("f")
+        idfs = array("d")
+        for term_id, (term, doc_ids) in enumerate(sorted(postings_of.items())):
+            terms[term] = term_id
+            idf = math.log(1 + (n - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            idfs.append(idf)
+            for doc_id in doc_ids:
+                tf = counts[doc_id][term]
+                norm = k1 * (1 - b + b * lengths[doc_id] / avgdl)
+                postings.append(doc_id)
+                weights.append(idf * tf * (k1 + 1) / (tf + norm))
+            offsets.append(len(postings))
+        return cls(terms, offsets, postings, weights, idfs, n)
+
+    def top(self, tokens, k):
+        """分數最高的 k 個 (段落編號, 分數)，只包含有命中的段落
+
+        命中的倒排筆數多時 (且有 numpy)，直接以 bincount 對 array 的緩衝區加總。
+        """
+        ranges = []
+        hits = 0
+        for token in set(tokens):
+            term_id = self.terms.get(token)
+            if term_id is not None:
+                start, end = self.offsets[term_id], self.offsets[term_id + 1]
+                ranges.append((start, end))
+                hits += end - start
+        if not ranges:
+            return []
+        if numpy is not None and hits > NUMPY_MIN_POSTINGS:
+            return self._top_numpy(ranges, k)
+        scores = {}
+        postings = self.postings
+        weights = self.weights
+        for start, end in ranges:
+            for i in range(start, end):
+                doc_id = postings[i]
+                scores[doc_id] = scores.get(doc_id, 0.0) + weights[i]
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def _top_numpy(self, ranges, k):
+        postings = numpy.frombuffer(self.postings, dtype=numpy.uint32)
+        weights = numpy.frombuffer(self.weights, dtype=numpy.float32)
+        doc_ids = numpy.concatenate([postings[start:end] for start, end in ranges])
+        doc_weights = numpy.concatenate([weights[start:end] for start, end in ranges])
+        scores = numpy.bincount(doc_ids, weights=doc_weights, minlength=self.size)
+        if k < self.size:
+            best = numpy.argpartition(-scores, k)[:k]
+        else:
+            best = numpy.arange(self.size)
+        best = best[numpy.argsort(-scores[best], kind="stable")]
+        return [(doc_id, score) for doc_id, score in zip(best.tolist(), scores[best].tolist())
+                if score > 0]
+
+    def contains(self, term_id, doc_id):
+        """段落是否含有該詞 (在該詞的倒排串列中二分搜尋)"""
+        end = self.offsets[term_id + 1]
+        i = bisect.bisect_left(self.postings, doc_id, self.offsets[term_id], end)
+        return i < end and self.postings[i] == doc_id
+
+    def coverage(self, tokens, doc_id):
+        """段落涵蓋的查詢 IDF 權重比例 (0–1)
+
+        只計算兩字以上的詞：單字幾乎出現在每個段落，會讓無關的問題也看似相關。
+        """
+        total = matched = 0.0
+        for token in set(tokens):
+            if len(token) < 2 and not token.isascii():
+                continue
+            term_id = self.terms.get(token)
+            if term_id is None:
+                total += self.unknown_idf
+                continue
+            idf = self.idf[term_id]
+            total += idf
+            if self.contains(term_id, doc_id):
+                matched += idf
+        return matched / total if total else 0.0
+
+
+class Hit:
+    """檢索結果：段落、分數與查詢涵蓋率"""
+
+    __slots__ = ("passage", "score", "coverage")
+
+    def __init__(self, passage, score, coverage):
+        self.passage = passage
+        self.score = score
+        self.coverage = coverage
+
+    def __repr__(self):
+        return f"Hit({self.passage.title!r}, score={self.score:.3f}, coverage={self.coverage:.2f})"
+
+
+def passage_tokens(passage):
+    """段落建立索引用的詞 (標題 + 內容)"""
+    return tokenize(f"{passage.title}\n{passage.text}")
+
+
+class KnowledgeBase:
+    """知識庫檢索
+
+    passages：段落序列 (列表，或索引檔的 PassageTable)；index：對應的 BM25Index
+    vectors：與段落同順序、每列已正規化的矩陣 (可為 numpy.load(..., mmap_mode="r"))
+    encoder：文字 → 向量的函式，兩者都有時才做混合排序。
+    version：索引版本 (離線建立的索引為建置編號)
+    """
+
+    def __init__(self, passages, index, vectors=None, encoder=None, version=None):
+        self.passages = passages
+        self.index = index
+        if vectors is not None and len(vectors) != len(passages):
+            log.warning("knowledge_vectors_mismatch", vectors=len(vectors), passages=len(passages))
+            vectors = None
+        self.vectors = vectors if encoder is not None else None
+        self.encoder = encoder
+        self.version = version
+
+    @classmethod
+    def build(cls, passages, vectors=None, encoder=None):
+        """在記憶體中建立索引"""
+        passages = list(passages)
+        return cls(passages, BM25Index.build([passage_tokens(p) for p in passages]),
+                   vectors, encoder)
+
+    @classmethod
+    def load(cls, directory, vectors_path=None, encoder=None):
+        """讀取知識庫目錄並在記憶體中建立索引；vectors_path 為 .npy 時以記憶體映射開啟"""
+        vectors = None
+        if vectors_path and encoder is not None:
+            if numpy is None:
+                log.warning("knowledge_vectors_ignored", reason="numpy_missing")
+            else:
+                vectors = numpy.load(vectors_path, mmap_mode="r")
+        return cls.build(load_passages(directory), vectors, encoder)
+
+    def __len__(self):
+        return len(self.passages)
+
+    def search(self, query, k=3):
+        """回傳最相關的 k 個 Hit (依相關度排序)"""
+        tokens = tokenize(query)
+        if not tokens or not self.passages:
+            return []
+        if self.vectors is None:
+            ranked = self.index.top(tokens, k)
+        else:
+            ranked = self._fuse(query, tokens, k)
+        return [
+            Hit(self.passages[doc_id], score, self.index.coverage(tokens, doc_id))
+            for doc_id, score in ranked
+        ]
+
+    def _fuse(self, query, tokens, k):
+        """BM25 與稠密向量的排名以 reciprocal rank fusion 合併"""
+        depth = k * DENSE_CANDIDATES
+        lexical = [doc_id for doc_id, _ in self.index.top(tokens, depth)]
+        query_vector = numpy.asarray(self.encoder(query), dtype=numpy.float32)
+        norm = numpy.linalg.norm(query_vector)
+        if norm:
+            query_vector /= norm
+        similarity = self.vectors @ query_vector
+        dense = numpy.argsort(-similarity)[:depth].tolist()
+        fused = {}
+        for ranking in (lexical, dense):
+            for rank, doc_id in enumerate(ranking):
+                fused[doc_id] = fused.get(doc_id, 0.0) + 1 / (RRF_K + rank + 1)
+        return heapq.nlargest(k, fused.items(), key=lambda item: item[1])
+
+    def answer(self, query, k=3, min_coverage=MIN_COVERAGE):
+        """回覆用的檢索：最佳段落涵蓋率不足時回傳空列表"""
+        hits = self.search(query, k)
+        if not hits or hits[0].coverage < min_coverage:
+            return []
+        return hits
+
+
+def load_encoder(spec):
+    """"模組:函式" → 文字轉向量的函式 (如 "my_embeddings:encode")"""
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name or "encode")
+
+
+def format_answer(hits):
+    """檢索結果 → 回覆文字：最相關的段落全文，其餘列為相關主題"""
+    best = hits[0].passage
+    lines = [f"📚 {best.title}", "", best.text]
+    related = []
+    for hit in hits[1:]:
+        title = hit.passage.title
+        if title != best.title and title not in related:
+            related.append(title)
+    if related:
+        lines += ["", "🔎 相關主題：" + "、".join(f"「{title}」" for title in related)]
+    lines += ["", f"資料來源：糖小護知識庫《{best.doc}》。以上僅供參考，個人狀況請與醫療團隊討論。"]
+    return "\n".join(lines)
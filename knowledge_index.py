@@ -0,0 +1,401 @@
+"""知識庫索引檔：離線建立、webhook worker 以 mmap 開啟
+
+build_index() 把來源目錄的文件切段、切詞、建立 BM25 倒排索引 (與選用的
+向量矩陣)，寫成一個版本目錄：
+
+    <輸出目錄>/
+        CURRENT                  目前使用的版本名稱 (以 os.replace 原子切換)
+        <版本>/manifest.json     格式版本、段落 / 詞數、各文件的雜湊
+        <版本>/terms.bin         排序後的詞 (UTF-8 相接) 與 terms.idx (起訖位置)
+        <版本>/offsets.u32       各詞在倒排串列中的範圍
+        <版本>/postings.u32      段落編號
+        <版本>/weights.f32       BM25 權重
+        <版本>/idf.f64
+        <版本>/passages.bin      段落 (文件\x1f標題\x1f內容) 與 passages.idx
+        <版本>/vectors.npy       (選用) 每列已正規化的向量
+        cache/<文件雜湊>.json    各文件切好的段落與詞，重建時沒有變動的文件直接沿用
+        cache/<文件雜湊>-<編碼器>.npy  各文件段落的向量
+
+open_index() 以 mmap 開啟各檔並直接當成 memoryview 使用，不複製、不解析；
+詞表以二分搜尋查詢，段落在取用時才解碼。多個 worker 開啟同一版本時共用頁面快取。
+"""
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sys
+import threading
+import time
+from array import array
+
+from knowledge import (
+    MAX_PASSAGE_CHARS, BM25Index, KnowledgeBase, Passage, numpy, parse_document, passage_tokens,
+    source_files
+)
+from structured_log import get_logger
+
+FORMAT_VERSION = 1
+CURRENT_FILE = "CURRENT"
+CACHE_DIR = "cache"
+MANIFEST = "manifest.json"
+# 保留的舊版本數 (正在使用舊版本的 worker 切換前仍可讀取)
+KEEP_BUILDS = 3
+
+_SEPARATOR = "\x1f"
+
+log = get_logger("knowledge")
+
+
+def _map(path, typecode):
+    """以 mmap 開啟檔案並轉成指定型別的 memoryview (空檔案回傳空 array)"""
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return array(typecode)
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    return view if typecode == "B" else view.cast(typecode)
+
+
+class TermTable:
+    """排序後的詞表 (mmap)：get() 以二分搜尋查出詞編號"""
+
+    def __init__(self, blob, bounds):
+        self._blob = blob        # 所有詞的 UTF-8 相接
+        self._bounds = bounds    # 第 i 個詞為 blob[bounds[i]:bounds[i + 1]]
+
+    def __len__(self):
+        return len(self._bounds) - 1
+
+    def __getitem__(self, i):
+        return bytes(self._blob[self._bounds[i]:self._bounds[i + 1]])
+
+    def get(self, term, default=None):
+        key = term.encode("utf-8")
+        i = bisect.bisect_left(self, key)
+        if i < len(self) and self[i] == key:
+            return i
+        return default
+
+
+class PassageTable:
+    """段落表 (mmap)：取用時才解碼"""
+
+    def __init__(self, blob, bounds):
+        self._blob = blob
+        self._bounds = bounds
+
+    def __len__(self):
+        return len(self._bounds) - 1
+
+    def __getitem__(self, i):
+        raw = bytes(self._blob[self._bounds[i]:self._bounds[i + 1]])
+        return Passage(*raw.decode("utf-8").split(_SEPARATOR, 2))
+
+
+def _write_array(path, typecode, values):
+    with open(path, "wb") as f:
+        array(typecode, values).tofile(f)
+
+
+def _write_strings(directory, name, strings):
+    """字串相接寫入 <name>.bin，起訖位置 (uint64) 寫入 <name>.idx"""
+    bounds = array("Q", [0])
+    with open(os.path.join(directory, name + ".bin"), "wb") as f:
+        for text in strings:
+            data = text.encode("utf-8")
+            f.write(data)
+            bounds.append(bounds[-1] + len(data))
+    with open(os.path.join(directory, name + ".idx"), "wb") as f:
+        bounds.tofile(f)
+
+
+def document_hash(name, data):
+    """文件的快取鍵：格式版本、切段方式、檔名與內容"""
+    digest = hashlib.sha256()
+    digest.update(f"{FORMAT_VERSION}\0{MAX_PASSAGE_CHARS}\0{name}\0".encode("utf-8"))
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def current_build(output_dir):
+    """CURRENT 指向的版本目錄；尚未建立索引時回傳 None"""
+    try:
+        with open(os.path.join(output_dir, CURRENT_FILE), encoding="utf-8") as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(output_dir, name) if name else None
+
+
+def _read_manifest(build_dir):
+    with open(os.path.join(build_dir, MANIFEST), encoding="utf-8") as f:
+        return json.load(f)
+
+
+class BuildResult:
+    """建立索引的結果"""
+
+    __slots__ = ("version", "documents", "reused", "passages", "terms", "postings", "changed")
+
+    def __init__(self, version, documents, reused, passages, terms, postings, changed):
+        self.version = version
+        self.documents = documents
+        self.reused = reused
+        self.passages = passages
+        self.terms = terms
+        self.postings = postings
+        self.changed = changed
+
+    def __str__(self):
+        if not self.changed:
+            return f"索引已是最新 ({self.version})"
+        return (f"已建立索引 {self.version}：{self.documents} 份文件 (沿用 {self.reused} 份)、"
+                f"{self.passages} 段、{self.terms} 詞、{self.postings} 筆倒排")
+
+
+def _load_document(cache_dir, name, path, digest, reuse):
+    """文件 → [(段落, 詞列表)]；沒有變動的文件從快取讀取。回傳 (結果, 是否沿用)"""
+    cache_path = os.path.join(cache_dir, digest + ".json")
+    if reuse:
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                cached = json.load(f)
+            return [(Passage(*item["passage"]), item["tokens"]) for item in cached], True
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            pass
+    with open(path, encoding="utf-8") as f:
+        passages = parse_document(name, f.read())
+    items = [(passage, passage_tokens(passage)) for passage in passages]
+    tmp = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump([{"passage": [p.doc, p.title, p.text], "tokens": tokens} for p, tokens in items],
+                  f, ensure_ascii=False)
+    os.replace(tmp, cache_path)
+    return items, False
+
+
+def _document_vectors(cache_dir, digest, encoder, encoder_name, passages, reuse):
+    """文件各段落的向量 (已正規化)，依文件雜湊與編碼器名稱快取"""
+    tag = hashlib.sha256(encoder_name.encode("utf-8")).hexdigest()[:12]
+    cache_path = os.path.join(cache_dir, f"{digest}-{tag}.npy")
+    if reuse and os.path.exists(cache_path):
+        return numpy.load(cache_path)
+    vectors = numpy.array(
+        [numpy.asarray(encoder(f"{p.title}\n{p.text}"), dtype=numpy.float32) for p in passages],
+        dtype=numpy.float32,
+    )
+    if len(vectors):
+        norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= numpy.where(norms == 0, 1, norms)
+    tmp = f"{cache_path}.{os.getpid()}.tmp.npy"
+    numpy.save(tmp, vectors)
+    os.replace(tmp, cache_path)
+    return vectors
+
+
+def build_index(source_dir, output_dir, encoder=None, encoder_name=None, full=False):
+    """建立 (或增量重建) 索引並切換 CURRENT，回傳 BuildResult
+
+    只有內容變動的文件會重新切段、切詞與計算向量；BM25 權重依整體統計重新計算。
+    所有文件都沒有變動、且編碼器相同時不建立新版本。full=True 時不使用快取。
+    """
+    if encoder is not None and numpy is None:
+        raise RuntimeError("計算向量需要 numpy")
+    cache_dir = os.path.join(output_dir, CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    names = source_files(source_dir)
+    digests = []
+    for name in names:
+        with open(os.path.join(source_dir, name), "rb") as f:
+            digests.append(document_hash(name, f.read()))
+    encoder_name = encoder_name or (getattr(encoder, "__qualname__", "encoder") if encoder else None)
+    fingerprint = hashlib.sha256(
+        json.dumps([digests, encoder_name]).encode("utf-8")).hexdigest()
+
+    current = current_build(output_dir)
+    if current is not None and not full:
+        try:
+            manifest = _read_manifest(current)
+        except (FileNotFoundError, ValueError):
+            manifest = {}
+        if manifest.get("format") == FORMAT_VERSION and manifest.get("fingerprint") == fingerprint:
+            return BuildResult(os.path.basename(current), len(names), len(names),
+                               manifest.get("passages", 0), manifest.get("terms", 0),
+                               manifest.get("postings", 0), False)
+
+    passages = []
+    documents = []
+    vectors = []
+    reused = 0
+    records = []
+    for name, digest in zip(names, digests):
+        items, hit = _load_document(cache_dir, name, os.path.join(source_dir, name), digest, not full)
+        reused += hit
+        records.append({"name": name, "sha256": digest, "passages": len(items)})
+        passages.extend(passage for passage, _ in items)
+        documents.extend(tokens for _, tokens in items)
+        if encoder is not None:
+            vectors.append(_document_vectors(
+                cache_dir, digest, encoder, encoder_name, [p for p, _ in items], not full))
+
+    index = BM25Index.build(documents)
+    version = time.strftime("%Y%m%d-%H%M%S") + "-" + fingerprint[:8]
+    build_dir = os.path.join(output_dir, version)
+    tmp_dir = f"{build_dir}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir)
+    try:
+        _write_strings(tmp_dir, "terms", sorted(index.terms, key=index.terms.get))
+        _write_array(os.path.join(tmp_dir, "offsets.u32"), "I", index.offsets)
+        _write_array(os.path.join(tmp_dir, "postings.u32"), "I", index.postings)
+        _write_array(os.path.join(tmp_dir, "weights.f32"), "f", index.weights)
+        _write_array(os.path.join(tmp_dir, "idf.f64"), "d", index.idf)
+        _write_strings(tmp_dir, "passages", (
+            _SEPARATOR.join((p.doc, p.title, p.text)) for p in passages))
+        if encoder is not None:
+            dimension = vectors[0].shape[1] if vectors and vectors[0].ndim == 2 else 0
+            matrix = (numpy.concatenate([v for v in vectors if len(v)])
+                      if any(len(v) for v in vectors)
+                      else numpy.zeros((0, dimension), dtype=numpy.float32))
+            numpy.save(os.path.join(tmp_dir, "vectors.npy"), matrix)
+        manifest = {
+            "format": FORMAT_VERSION,
+            "version": version,
+            "fingerprint": fingerprint,
+            "byteorder": sys.byteorder,
+            "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "passages": len(passages),
+            "terms": len(index.terms),
+            "postings": len(index.postings),
+            "unknown_idf": index.unknown_idf,
+            "encoder": encoder_name,
+            "documents": records,
+        }
+        with open(os.path.join(tmp_dir, MANIFEST), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.rename(tmp_dir, build_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    pointer = os.path.join(output_dir, CURRENT_FILE)
+    with open(pointer + ".tmp", "w", encoding="utf-8") as f:
+        f.write(version + "\n")
+    os.replace(pointer + ".tmp", pointer)
+    _prune(output_dir, version, {digest for digest in digests})
+    return BuildResult(version, len(names), reused, len(passages), len(index.terms),
+                       len(index.postings), True)
+
+
+def _prune(output_dir, current, live_digests):
+    """只保留最新的 KEEP_BUILDS 個版本，並刪除已不存在的文件的快取"""
+    builds = sorted(
+        name for name in os.listdir(output_dir)
+        if not name.endswith(".tmp") and os.path.isfile(os.path.join(output_dir, name, MANIFEST))
+    )
+    for name in builds[:-KEEP_BUILDS]:
+        if name != current:
+            shutil.rmtree(os.path.join(output_dir, name), ignore_errors=True)
+    cache_dir = os.path.join(output_dir, CACHE_DIR)
+    for name in os.listdir(cache_dir):
+        if name.split(".")[0].split("-")[0] not in live_digests:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+
+def open_index(build_dir, encoder=None):
+    """以 mmap 開啟版本目錄，回傳 KnowledgeBase (不複製索引內容)"""
+    manifest = _read_manifest(build_dir)
+    if manifest.get("format") != FORMAT_VERSION:
+        raise ValueError(f"不支援的索引格式: {manifest.get('format')!r}")
+    if manifest.get("byteorder") != sys.byteorder:
+        raise ValueError("索引檔的位元組順序與本機不同，請重新建立")
+
+    def path(name):
+        return os.path.join(build_dir, name)
+
+    terms = TermTable(_map(path("terms.bin"), "B"), _map(path("terms.idx"), "Q"))
+    index = BM25Index(
+        terms,
+        _map(path("offsets.u32"), "I"),
+        _map(path("postings.u32"), "I"),
+        _map(path("weights.f32"), "f"),
+        _map(path("idf.f64"), "d"),
+        manifest["passages"],
+        manifest["unknown_idf"],
+    )
+    passages = PassageTable(_map(path("passages.bin"), "B"), _map(path("passages.idx"), "Q"))
+    vectors = None
+    if encoder is not None and os.path.exists(path("vectors.npy")):
+        if numpy is None:
+            log.warning("knowledge_vectors_ignored", reason="numpy_missing")
+        else:
+            vectors = numpy.load(path("vectors.npy"), mmap_mode="r")
+    return KnowledgeBase(passages, index, vectors, encoder, version=manifest["version"])
+
+
+class KnowledgeIndex:
+    """webhook 使用的知識庫：第一次查詢時才開啟，之後每 check_interval 秒
+    檢查 CURRENT，有新版本時切換 (不必重新啟動)
+
+    尚未建立索引檔時，改為讀取 source_dir 在記憶體中建立索引。
+    on_reload：切換版本後呼叫 (如清除問答快取)。
+    """
+
+    def __init__(self, index_dir, source_dir=None, encoder=None, check_interval=30, on_reload=None):
+        self.index_dir = index_dir
+        self.source_dir = source_dir
+        self.encoder = encoder
+        self.check_interval = check_interval
+        self.on_reload = on_reload
+        self._base = None
+        self._build_dir = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def current(self):
+        """目前的 KnowledgeBase"""
+        now = time.monotonic()
+        if self._base is not None and now - self._checked < self.check_interval:
+            return self._base
+        with self._lock:
+            if self._base is None or now - self._checked >= self.check_interval:
+                self._checked = now
+                self._refresh()
+            return self._base
+
+    def _refresh(self):
+        build_dir = current_build(self.index_dir)
+        if build_dir is not None and build_dir != self._build_dir:
+            try:
+                base = open_index(build_dir, self.encoder)
+            except (OSError, ValueError, KeyError) as e:
+                log.error("knowledge_index_open_failed", build=build_dir, error=repr(e))
+            else:
+                reloaded = self._base is not None
+                self._base, self._build_dir = base, build_dir
+                log.info("knowledge_index_loaded", version=base.version, passages=len(base))
+                if reloaded and self.on_reload is not None:
+                    self.on_reload()
+                return
+        if self._base is None:
+            # 沒有索引檔：讀取來源目錄在記憶體中建立
+            log.warning("knowledge_index_missing", index_dir=self.index_dir, source_dir=self.source_dir,
+                        hint="python app.py build-knowledge")
+            self._base = KnowledgeBase.load(self.source_dir or "")
+
+    def __len__(self):
+        return len(self.current())
+
+    @property
+    def version(self):
+        return self.current().version
+
+    def search(self, query, k=3):
+        return self.current().search(query, k)
+
+    def answer(self, query, *args, **kwargs):
+        return self.current().answer(query, *args, **kwargs)
@@ -0,0 +1,121 @@
+"""LINE API 用戶端
+
+LineBotApi 在每個 worker 只建立一次，所有回覆路徑共用。
+HTTP 連線改用 requests.Session 連線池 (keep-alive)，避免每次回覆都重新
+建立連線與 TLS 交握。
+
+環境變數：
+- LINE_CHANNEL_ACCESS_TOKEN / LINE_CHANNEL_SECRET
+- LINE_HTTP_POOL_SIZE：連線池大小 (預設 10，建議不小於 worker 執行緒數)
+- LINE_HTTP_CONNECT_TIMEOUT / LINE_HTTP_READ_TIMEOUT：逾時秒數
+- LINE_API_ENDPOINT：API 端點 (預設 https://api.line.me，壓測時可指向本機)
+- LINE_API_DATA_ENDPOINT：取得訊息內容 (圖片等) 的端點 (預設 https://api-data.line.me)
+"""
+import functools
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from linebot import LineBotApi
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 10
+
+
+class PooledHttpClient(RequestsHttpClient):
+    """以 requests.Session 連線池實作的 HttpClient"""
+
+    def __init__(self, timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT),
+                 pool_size=DEFAULT_POOL_SIZE):
+        super().__init__(timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self.session.get(
+            url, headers=headers, params=params, stream=stream,
+            timeout=self.timeout if timeout is None else timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self.session.post(
+            url, headers=headers, data=data,
+            timeout=self.timeout if timeout is None else timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self.session.delete(
+            url, headers=headers, data=data,
+            timeout=self.timeout if timeout is None else timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = self.session.put(
+            url, headers=headers, data=data,
+            timeout=self.timeout if timeout is None else timeout
+        )
+        return RequestsHttpResponse(response)
+
+
+class LineClients:
+    """每個 worker 共用的 LineBotApi 與簽章驗證金鑰"""
+
+    def __init__(self, access_token, secret, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT),
+                 endpoint=LineBotApi.DEFAULT_API_ENDPOINT,
+                 data_endpoint=LineBotApi.DEFAULT_API_DATA_ENDPOINT):
+        self.line_bot_api = LineBotApi(
+            access_token,
+            endpoint=endpoint,
+            data_endpoint=data_endpoint,
+            timeout=timeout,
+            http_client=functools.partial(PooledHttpClient, pool_size=pool_size)
+        )
+        self.channel_secret = secret.encode('utf-8')
+
+    @classmethod
+    def from_env(cls):
+        """依環境變數建立；必要的金鑰未設定時回傳 None"""
+        access_token = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
+        secret = os.environ.get('LINE_CHANNEL_SECRET')
+        if not access_token or not secret:
+            return None
+        return cls(
+            access_token, secret,
+            pool_size=int(os.environ.get('LINE_HTTP_POOL_SIZE', DEFAULT_POOL_SIZE)),
+            timeout=(
+                float(os.environ.get('LINE_HTTP_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT)),
+                float(os.environ.get('LINE_HTTP_READ_TIMEOUT', DEFAULT_READ_TIMEOUT)),
+            ),
+            endpoint=os.environ.get('LINE_API_ENDPOINT', LineBotApi.DEFAULT_API_ENDPOINT),
+            data_endpoint=os.environ.get('LINE_API_DATA_ENDPOINT', LineBotApi.DEFAULT_API_DATA_ENDPOINT)
+        )
+
+
+_clients = None
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def get_line_clients():
+    """取得目前 worker 的共用用戶端 (首次呼叫時建立)
+
+    連線池不可跨 fork 共用，gunicorn --preload 時每個 worker 會各自建立。
+    環境變數未設定時回傳 None。
+    """
+    global _clients, _clients_pid
+    if _clients is not None and _clients_pid == os.getpid():
+        return _clients
+    with _clients_lock:
+        if _clients is None or _clients_pid != os.getpid():
+            _clients = LineClients.from_env()
+            _clients_pid = os.getpid()
+        return _clients
@@ -0,0 +1,68 @@
+"""跨行程的位元組範圍鎖
+
+user_store (用戶鎖、日誌輪替)、event_dedup (去重表) 與 metrics (合併已結束
+的 worker) 共用。沒有 fcntl 的平台 (Windows 等) 只保證行程內安全。
+"""
+import errno
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows 等平台：只保證行程內安全
+    fcntl = None
+
+
+class LockFile:
+    """跨行程的位元組範圍鎖 (fcntl.lockf)
+
+    POSIX 記錄鎖屬於整個行程，關閉同一檔案的任何 fd 都會釋放該行程的
+    所有鎖，因此同一個鎖檔在行程內只開一個 fd，由各元件共用。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    def _fileno(self):
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        return self._fd
+
+    @contextmanager
+    def hold(self, byte, exclusive=True, blocking=True):
+        """鎖住第 byte 個位元組；blocking=False 時取不到鎖會產出 False"""
+        if fcntl is None:
+            yield True
+            return
+        fd = self._fileno()
+        cmd = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if not blocking:
+            cmd |= fcntl.LOCK_NB
+        delay = 0.001
+        while True:
+            try:
+                fcntl.lockf(fd, cmd, 1, byte)
+                break
+            except OSError as e:
+                if not blocking:
+                    yield False
+                    return
+                if e.errno != errno.EDEADLK:
+                    raise
+                # 核心以「行程」為單位偵測死結，多執行緒同時等待不同分段時
+                # 會誤判；各元件的加鎖順序固定不會真正死結，稍後重試即可
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+        try:
+            yield True
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, 1, byte)
+
+    def close(self):
+        if self._fd is not None and self._pid == os.getpid():
+            os.close(self._fd)
+        self._fd = None
@@ -0,0 +1,179 @@
+"""訊息樣板
+
+條款、教學 Carousel 等固定內容的訊息在啟動時建立一次：
+- 轉成 SDK 訊息物件 (同時完成格式驗證)
+- 檢查 LINE 的長度與大小限制
+- 預先序列化成 JSON bytes
+
+回覆時只交出樣板的參照，reply_message() / push_message() 直接把預先序列化
+好的 bytes 拼進請求內容，不必每次重建巢狀 dict、轉換 Flex 物件再序列化。
+"""
+import json
+import time
+
+from linebot.exceptions import LineBotApiError
+from linebot.models import FlexSendMessage, SendMessage
+from linebot.models.error import Error
+
+import metrics
+
+# LINE Messaging API 的限制
+MAX_ALT_TEXT_LENGTH = 1500
+MAX_CAROUSEL_BUBBLES = 12
+MAX_BUBBLE_BYTES = 30 * 1024
+MAX_CAROUSEL_BYTES = 50 * 1024
+MAX_QUICK_REPLY_ITEMS = 13
+MAX_MESSAGES_PER_REPLY = 5
+
+REPLY_PATH = '/v2/bot/message/reply'
+PUSH_PATH = '/v2/bot/message/push'
+
+
+LINE_API_SECONDS = metrics.histogram(
+    "line_api_request_seconds", "LINE Messaging API 請求耗時 (秒)", ("endpoint", "status"))
+
+
+def _dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class MessageTemplate:
+    """建立後不再變動的訊息樣板"""
+
+    __slots__ = ("name", "message", "json_bytes")
+
+    def __init__(self, name, message):
+        self.name = name
+        self.message = message
+        self.json_bytes = _dumps(message.as_json_dict())
+
+    def __repr__(self):
+        return f"MessageTemplate({self.name!r}, {len(self.json_bytes)} bytes)"
+
+
+def flex_message(payload):
+    """把 create_*_message() 產生的 dict 轉成 FlexSendMessage"""
+    return FlexSendMessage(alt_text=payload["altText"], contents=payload["contents"])
+
+
+def validate_message(name, message):
+    """檢查 LINE 的格式限制，不符時丟出 ValueError"""
+    data = message.as_json_dict()
+    if data.get("type") == "flex":
+        if len(data.get("altText", "")) > MAX_ALT_TEXT_LENGTH:
+            raise ValueError(f"樣板 {name} 的 altText 超過 {MAX_ALT_TEXT_LENGTH} 字")
+        contents = data["contents"]
+        if contents.get("type") == "carousel":
+            bubbles = contents.get("contents", [])
+            if len(bubbles) > MAX_CAROUSEL_BUBBLES:
+                raise ValueError(f"樣板 {name} 的 carousel 超過 {MAX_CAROUSEL_BUBBLES} 頁")
+            if len(_dumps(contents)) > MAX_CAROUSEL_BYTES:
+                raise ValueError(f"樣板 {name} 的 carousel 超過 {MAX_CAROUSEL_BYTES} bytes")
+        else:
+            bubbles = [contents]
+        for bubble in bubbles:
+            if len(_dumps(bubble)) > MAX_BUBBLE_BYTES:
+                raise ValueError(f"樣板 {name} 的 bubble 超過 {MAX_BUBBLE_BYTES} bytes")
+    quick_reply = data.get("quickReply")
+    if quick_reply and len(quick_reply.get("items", [])) > MAX_QUICK_REPLY_ITEMS:
+        raise ValueError(f"樣板 {name} 的快速回覆超過 {MAX_QUICK_REPLY_ITEMS} 個")
+
+
+class TemplateRegistry:
+    """名稱 → MessageTemplate"""
+
+    def __init__(self):
+        self._templates = {}
+
+    def register(self, name, builder):
+        """呼叫 builder() 建立訊息並登記；builder 可回傳 Flex dict 或 SDK 訊息"""
+        message = builder()
+        if isinstance(message, dict):
+            message = flex_message(message)
+        validate_message(name, message)
+        template = MessageTemplate(name, message)
+        self._templates[name] = template
+        return template
+
+    def __getitem__(self, name):
+        return self._templates[name]
+
+    def __contains__(self, name):
+        return name in self._templates
+
+    def names(self):
+        return list(self._templates)
+
+
+def serialize_message(message):
+    """單則訊息的 JSON bytes；樣板直接使用預先序列化的結果"""
+    if isinstance(message, MessageTemplate):
+        return message.json_bytes
+    if isinstance(message, SendMessage):
+        return _dumps(message.as_json_dict())
+    raise TypeError(f"不支援的訊息類型: {type(message).__name__}")
+
+
+def _messages_json(messages):
+    if not isinstance(messages, (list, tuple)):
+        messages = [messages]
+    if len(messages) > MAX_MESSAGES_PER_REPLY:
+        raise ValueError(f"一次最多送出 {MAX_MESSAGES_PER_REPLY} 則訊息")
+    return b'[' + b",".join(serialize_message(message) for message in messages) + b']'
+
+
+def build_reply_body(reply_token, messages):
+    """組出 reply API 的請求內容 (bytes)"""
+    return b'{"replyToken":' + _dumps(reply_token) + b',"messages":' + _messages_json(messages) + b'}'
+
+
+def build_push_body(to, messages):
+    """組出 push API 的請求內容 (bytes)"""
+    return b'{"to":' + _dumps(to) + b',"messages":' + _messages_json(messages) + b'}'
+
+
+def check_response(response):
+    """非 2xx 的回應丟出 LineBotApiError (與 SDK 相同)"""
+    if not 200 <= response.status_code < 300:
+        raise LineBotApiError(
+            status_code=response.status_code,
+            headers=dict(response.headers.items()),
+            request_id=response.headers.get('X-Line-Request-Id'),
+            accepted_request_id=response.headers.get('X-Line-Accepted-Request-Id'),
+            error=Error.new_from_json_dict(response.json)
+        )
+    return response
+
+
+def _post(line_bot_api, path, body, timeout=None, extra_headers=None):
+    headers = {'Content-Type': 'application/json'}
+    headers.update(line_bot_api.headers)
+    if extra_headers:
+        headers.update(extra_headers)
+    started = time.perf_counter()
+    status = "error"
+    try:
+        response = line_bot_api.http_client.post(
+            line_bot_api.endpoint + path, headers=headers, data=body, timeout=timeout
+        )
+        status = str(response.status_code)
+    finally:
+        LINE_API_SECONDS.observe(time.perf_counter() - started, path.rsplit('/', 1)[-1], status)
+    return check_response(response)
+
+
+def reply_message(line_bot_api, reply_token, messages, timeout=None):
+    """回覆訊息 (可混用 MessageTemplate 與一般 SDK 訊息)
+
+    透過 line_bot_api 共用的連線池送出，錯誤處理與 SDK 的 reply_message 相同。
+    """
+    return _post(line_bot_api, REPLY_PATH, build_reply_body(reply_token, messages), timeout)
+
+
+def push_message(line_bot_api, to, messages, timeout=None, retry_key=None):
+    """主動推送訊息 (reply token 已用掉或過期時使用，會計入訊息額度)
+
+    retry_key (UUID) 相同的請求 LINE 只會送出一次，重試時不會重複推送。
+    """
+    extra = {'X-Line-Retry-Key': retry_key} if retry_key else None
+    return _post(line_bot_api, PUSH_PATH, build_push_body(to, messages), timeout, extra)
@@ -0,0 +1,334 @@
+"""Prometheus 文字格式的指標 (計數器與直方圖)
+
+- Counter / Histogram：以標籤值的 tuple 為鍵，數值放在 dict 中
+- Registry：收集指標並輸出 Prometheus 文字格式 (text/plain; version=0.0.4)
+- REGISTRY：預設的 Registry，各模組以 counter() / histogram() 在其中宣告指標
+
+REGISTRY 預設停用：停用時 inc() / observe() 只檢查一個旗標就返回，熱路徑上
+幾乎沒有額外負擔。app.py 依 METRICS_ENABLED 啟用。
+
+gunicorn 有多個 worker 時，每個 worker 各自計數；設定 directory 後，各 worker
+每隔 flush_interval 秒把自己的數值寫到 directory/<pid>.json，輸出時合併目錄中
+所有 worker 的檔案。worker 結束時 (或輸出時發現該 pid 已不存在，例如 worker
+被強制終止) 把它的數值併入 directory/retired.json 並刪除 <pid>.json：檔案數
+不隨 worker 重啟累積，已結束的 worker 數值仍計入，計數器不會倒退。目錄應在
+服務啟動前清空。
+"""
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from structured_log import get_logger
+from lockfile import LockFile
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# 已結束的 worker 合併後的數值
+RETIRED_FILE = "retired.json"
+
+log = get_logger("metrics")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _label_text(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """只增不減的計數器"""
+
+    kind = "counter"
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return {json.dumps(labels): value for labels, value in self._values.items()}
+
+    @staticmethod
+    def merge(total, values):
+        for key, value in values.items():
+            total[key] = total.get(key, 0) + value
+
+    def render(self, values):
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_label_text(self.labelnames, json.loads(key))} {_format_number(value)}"
+
+
+class Histogram:
+    """直方圖：各區間的次數、總和與總次數"""
+
+    kind = "histogram"
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # 標籤 → [各區間次數 (最後一格為 +Inf)..., 總和]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        if not self.registry.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    def time(self, *labels):
+        """with histogram.time("stage"): ... 量測區塊的耗時"""
+        return _Timer(self, labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {json.dumps(labels): list(entry) for labels, entry in self._values.items()}
+
+    @staticmethod
+    def merge(total, values):
+        for key, entry in values.items():
+            current = total.get(key)
+            if current is None:
+                total[key] = list(entry)
+            else:
+                for i, value in enumerate(entry):
+                    current[i] += value
+
+    def render(self, values):
+        bounds = self.buckets + (float("inf"),)
+        for key, entry in sorted(values.items()):
+            labels = json.loads(key)
+            cumulative = 0
+            for bound, count in zip(bounds, entry):
+                cumulative += count
+                le = f'le="{_format_number(bound)}"'
+                yield f"{self.name}_bucket{_label_text(self.labelnames, labels, le)} {cumulative}"
+            label_text = _label_text(self.labelnames, labels)
+            yield f"{self.name}_sum{label_text} {_format_number(entry[-1])}"
+            yield f"{self.name}_count{label_text} {cumulative}"
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Registry:
+    def __init__(self, enabled=False, directory=None, flush_interval=5.0):
+        self.enabled = enabled
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._metrics = []
+        self._flusher_pid = None
+        self._flusher = None
+        self._flusher_lock = threading.Lock()
+        self._stop_flushing = threading.Event()
+        # 合併已結束的 worker：行程內的執行緒鎖 + 跨行程的鎖檔
+        self._retire_lock = threading.Lock()
+        self._lock_file = None
+
+    def configure(self, enabled, directory=None, flush_interval=5.0):
+        self.enabled = enabled
+        self.directory = directory
+        self.flush_interval = flush_interval
+        if enabled and directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(self, name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(self, name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def start_flusher(self):
+        """啟動本 worker 的定期寫檔執行緒 (fork 後的 worker 各自啟動一次)"""
+        if not self.enabled or not self.directory or self._flusher_pid == os.getpid():
+            return
+        with self._flusher_lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+            # fork 前的父行程可能已設定過停止旗標
+            self._stop_flushing = threading.Event()
+            self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+            self._flusher.start()
+            atexit.register(self._exit)
+
+    def _flush_loop(self):
+        stop = self._stop_flushing
+        while not stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError as e:
+                log.warning("metrics_flush_failed", error=repr(e))
+
+    def _exit(self):
+        # fork 出的子行程也會繼承 atexit，只在啟動寫檔的 worker 本身執行
+        if self._flusher_pid != os.getpid():
+            return
+        self._flusher_pid = None
+        # 先停止並等待寫檔執行緒：否則併入 retired.json 之後它仍可能再寫一次
+        # <pid>.json，這份數值會在輸出時被當成已結束的 worker 再併入一次
+        self._stop_flushing.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        try:
+            self.flush()
+            with self._locked():
+                self._retire(os.getpid())
+        except OSError as e:
+            log.warning("metrics_flush_failed", error=repr(e))
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _write(self, name, snapshot):
+        """先寫暫存檔再改名"""
+        path = self._path(name)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, path)
+
+    def _read(self, name):
+        try:
+            with open(self._path(name), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def flush(self):
+        """把本 worker 的數值寫到 directory/<pid>.json"""
+        self._write(f"{os.getpid()}.json", self.snapshot())
+
+    def _retire(self, pid):
+        """把已結束的 worker 的數值併入 retired.json 並刪除它的檔案 (呼叫端須持有鎖)"""
+        name = f"{pid}.json"
+        snapshot = self._read(name)
+        if snapshot is None:
+            return
+        by_name = {metric.name: metric for metric in self._metrics}
+        retired = self._read(RETIRED_FILE) or {}
+        for metric_name, values in snapshot.items():
+            metric = by_name.get(metric_name)
+            if metric is not None:
+                metric.merge(retired.setdefault(metric_name, {}), values)
+        self._write(RETIRED_FILE, retired)
+        os.unlink(self._path(name))
+
+    @contextmanager
+    def _locked(self):
+        """合併 / 讀取目錄時的鎖：行程內的執行緒鎖 + 跨行程的鎖檔"""
+        with self._retire_lock:
+            if self._lock_file is None:
+                self._lock_file = LockFile(self._path("retired.lock"))
+            with self._lock_file.hold(0):
+                yield
+
+    def collect(self):
+        """合併後的數值 {指標名稱: {標籤 JSON: 數值}}
+
+        讀取期間持有鎖，不會讀到其他 worker 併入一半的結果 (同一份數值
+        同時在 <pid>.json 與 retired.json，或兩者都沒有)。
+        """
+        if not self.directory:
+            return self.snapshot()
+        self.flush()
+        totals = {metric.name: {} for metric in self._metrics}
+        by_name = {metric.name: metric for metric in self._metrics}
+        with self._locked():
+            names = [entry.name for entry in os.scandir(self.directory) if entry.name.endswith(".json")]
+            for name in names:
+                pid = name[:-len(".json")]
+                if pid.isdigit() and not _alive(int(pid)):
+                    self._retire(pid)
+            for name in set(names + [RETIRED_FILE]):
+                snapshot = self._read(name)
+                if snapshot is None:
+                    continue
+                for metric_name, values in snapshot.items():
+                    metric = by_name.get(metric_name)
+                    if metric is not None:
+                        metric.merge(totals[metric_name], values)
+        return totals
+
+    def render(self):
+        """Prometheus 文字格式"""
+        values = self.collect()
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render(values.get(metric.name, {})))
+        return "\n".join(lines) + "\n"
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.counter(name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.histogram(name, documentation, labelnames, buckets)
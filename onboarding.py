@@ -0,0 +1,225 @@
+"""引導流程狀態機
+
+條款同意 → 按鈕確認 → 教學選擇 → 教學 → 正常使用 的流程以轉移表描述：
+(狀態, 輸入) → Transition(回覆, 下一個狀態, 附帶動作)
+
+查表是兩次 dict 查詢：先看不分狀態的輸入 (加好友、多媒體訊息)，
+再看 狀態 → {輸入: 轉移}，找不到時使用該狀態的預設轉移。
+新增狀態只是多幾筆資料，不會拉長處理路徑。
+"""
+
+# 用戶狀態 (存於用戶記錄的 status 欄位)；NEW 代表尚無用戶記錄
+NEW = None
+PENDING = "pending"
+AWAITING_BUTTON_RESPONSE = "awaiting_button_response"
+AWAITING_TUTORIAL_CHOICE = "awaiting_tutorial_choice"
+TUTORIAL_SHOWN = "tutorial_shown"
+DETAILED_TUTORIAL = "detailed_tutorial"
+AGREED = "agreed"
+DISAGREED = "disagreed"
+
+# 附帶動作
+CREATE_USER = "create_user"
+DELETE_USER = "delete_user"
+
+
+class Signal:
+    """非文字的輸入 (不會與用戶輸入的文字相同)"""
+
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"<{self.name}>"
+
+
+FOLLOW = Signal("follow")
+MEDIA = Signal("media")
+IMAGE = Signal("image")
+# 代表「轉移表中沒有列出的其他輸入」(只用於檢查，不會被查到)
+OTHER = Signal("other")
+
+
+class Transition:
+    """一筆轉移
+
+    - templates：要回覆的樣板名稱 (依序)
+    - text：要回覆的文字 (與 templates 擇一)
+    - next_state：下一個狀態，None 表示不變
+    - stamp：切換狀態時一併寫入目前時間的欄位名稱
+    - action：CREATE_USER / DELETE_USER
+    - redispatch：切換狀態後，以新狀態重新處理同一個輸入
+    - handler：先交給此名稱的處理函式 (如解析血糖數值)，處理函式
+      未處理時才使用 templates / text 回覆
+    """
+
+    __slots__ = ("templates", "text", "next_state", "stamp", "action", "redispatch",
+                 "handler")
+
+    def __init__(self, templates=(), text=None, next_state=None, stamp=None,
+                 action=None, redispatch=False, handler=None):
+        if isinstance(templates, str):
+            templates = (templates,)
+        self.templates = tuple(templates)
+        self.text = text
+        self.next_state = next_state
+        self.stamp = stamp
+        self.action = action
+        self.redispatch = redispatch
+        self.handler = handler
+
+    def __repr__(self):
+        return (f"Transition(templates={self.templates!r}, text={self.text!r}, "
+                f"next_state={self.next_state!r}, action={self.action!r})")
+
+
+class StateMachine:
+    """以轉移表驅動的狀態機"""
+
+    def __init__(self, any_state, transitions, defaults):
+        self.any_state = any_state
+        self.transitions = transitions
+        self.defaults = defaults
+
+    def inputs(self):
+        """轉移表中列出的所有輸入；其他輸入都與 OTHER 的結果相同"""
+        inputs = list(self.any_state)
+        for table in self.transitions.values():
+            inputs.extend(signal for signal in table if signal not in inputs)
+        return inputs
+
+    def global_transition(self, signal):
+        """不分狀態的轉移；沒有時回傳 None (呼叫端才需要讀取用戶狀態)"""
+        return self.any_state.get(signal)
+
+    def lookup(self, state, signal):
+        """查出 (狀態, 輸入) 的轉移；未知狀態回傳 None"""
+        table = self.transitions.get(state)
+        if table is not None:
+            transition = table.get(signal)
+            if transition is not None:
+                return transition
+        return self.defaults.get(state)
+
+    def resolve(self, state, signal):
+        """回傳 (最終轉移, 最終狀態)；最終狀態與原狀態相同時為 None
+
+        redispatch 的轉移只改變狀態，不回覆，最多跟隨 len(狀態數) 次。
+        """
+        new_state = None
+        for _ in range(len(self.defaults) + 1):
+            transition = self.global_transition(signal) or self.lookup(state, signal)
+            if transition is None or not transition.redispatch:
+                if transition is not None and transition.next_state is not None:
+                    new_state = transition.next_state
+                return transition, new_state
+            state = new_state = transition.next_state
+        raise RuntimeError(f"狀態 {state!r} 的 redispatch 形成循環")
+
+    def validate(self, template_names=(), handler_names=()):
+        """檢查轉移表：目標狀態都有定義、樣板與處理函式都已登記、redispatch 不形成循環"""
+        states = set(self.defaults)
+        tables = [self.any_state, self.defaults, *self.transitions.values()]
+        for table in tables:
+            for transition in table.values():
+                if transition.next_state is not None and transition.next_state not in states:
+                    raise ValueError(f"未定義的狀態: {transition.next_state!r}")
+                if transition.redispatch and transition.next_state is None:
+                    raise ValueError(f"redispatch 的轉移必須指定下一個狀態: {transition!r}")
+                for name in transition.templates:
+                    if template_names and name not in template_names:
+                        raise ValueError(f"未登記的樣板: {name!r}")
+                if transition.handler is not None and transition.handler not in handler_names:
+                    raise ValueError(f"未登記的處理函式: {transition.handler!r}")
+        for state in self.transitions:
+            if state not in states:
+                raise ValueError(f"狀態 {state!r} 沒有預設轉移")
+        # 每個狀態對每一類輸入都解析一次：redispatch 的循環可能經過非預設的轉移
+        for state in states:
+            for signal in [*self.inputs(), OTHER]:
+                try:
+                    self.resolve(state, signal)
+                except RuntimeError:
+                    raise ValueError(f"狀態 {state!r} 收到 {signal!r} 時 redispatch 形成循環") from None
+
+
+AGREED_REPLY = "💬 您好！我是糖小護，您的專屬健康管理助手。\n\n目前的知識庫中找不到與您的問題相關的資料，可以換個說法再問一次，例如：「血糖高怎麼辦？」、「糖尿病可以吃什麼？」\n\n直接輸入血糖數值即可記錄，輸入「報表」查看記錄；如需重新查看功能介紹，請輸入「教學」。"
+MEDIA_REPLY = "💬 糖小護收到您的訊息！\n\n🔧 多媒體功能整合中，敬請期待！"
+IMAGE_BUSY_REPLY = "📷 目前照片分析的人數較多，請稍後再傳一次。"
+
+TERMS = Transition("terms", next_state=PENDING, action=CREATE_USER)
+REPORT = Transition(handler="blood_sugar_report")
+# 圖片只在正常使用狀態分析；其他狀態與其他多媒體訊息相同，只回覆、不改變狀態也不建立用戶
+IMAGE_MEDIA = Transition(text=MEDIA_REPLY)
+
+ONBOARDING = StateMachine(
+    any_state={
+        # 加好友 → 發送條款頁面並建立 (或重設) 用戶記錄
+        FOLLOW: TERMS,
+        MEDIA: Transition(text=MEDIA_REPLY),
+    },
+    transitions={
+        NEW: {
+            IMAGE: IMAGE_MEDIA,
+        },
+        PENDING: {
+            # 條款完成 + 按鈕確認，直接設為等待按鈕回應
+            "同意": Transition(("welcome", "button_check"),
+                             next_state=AWAITING_BUTTON_RESPONSE, stamp="agreed_time"),
+            "不同意": Transition(
+                text="感謝您的回覆。如果您改變心意，歡迎隨時重新開始對話。\n\n為了保護您的隱私，我們將不會保存任何資料。",
+                next_state=DISAGREED, stamp="disagreed_time"),
+            IMAGE: IMAGE_MEDIA,
+        },
+        AWAITING_BUTTON_RESPONSE: {
+            "有": Transition("tutorial_choice", next_state=AWAITING_TUTORIAL_CHOICE),
+            "沒有": Transition(
+                text="沒關係！我們來說明一下：\n\n在我的訊息下方，您會看到一些按鈕，這些按鈕可以幫助您快速選擇回應。\n\n如果您現在看到了，請回覆「有」；如果還是沒看到，請回覆「沒有」。"),
+            IMAGE: IMAGE_MEDIA,
+        },
+        AWAITING_TUTORIAL_CHOICE: {
+            "我要教學": Transition("tutorial", next_state=TUTORIAL_SHOWN),
+            "我不要教學": Transition("skip_tutorial", next_state=AGREED),
+            IMAGE: IMAGE_MEDIA,
+        },
+        TUTORIAL_SHOWN: {
+            "問答教學": Transition("qa_tutorial", next_state=DETAILED_TUTORIAL),
+            "語音教學": Transition("voice_tutorial", next_state=DETAILED_TUTORIAL),
+            "血糖教學": Transition("blood_sugar_tutorial", next_state=DETAILED_TUTORIAL),
+            "影像教學": Transition("image_tutorial", next_state=DETAILED_TUTORIAL),
+            # 教學中傳的圖片不會結束教學 (其他訊息才進入正常使用狀態)
+            IMAGE: IMAGE_MEDIA,
+        },
+        DETAILED_TUTORIAL: {
+            IMAGE: IMAGE_MEDIA,
+        },
+        AGREED: {
+            "教學": Transition("tutorial", next_state=TUTORIAL_SHOWN),
+            "功能介紹": Transition("tutorial", next_state=TUTORIAL_SHOWN),
+            "報表": REPORT,
+            "歷史": REPORT,
+            "記錄": REPORT,
+            # 圖片 → 背景分析；未啟用圖片分析時回覆多媒體訊息
+            IMAGE: Transition(text=MEDIA_REPLY, handler="image_message"),
+        },
+        DISAGREED: {
+            "重新開始": Transition("terms", action=DELETE_USER),
+            IMAGE: IMAGE_MEDIA,
+        },
+    },
+    defaults={
+        # 新用戶 → 發送條款頁面
+        NEW: TERMS,
+        PENDING: Transition(text="請點選條款頁面中的「同意並開始使用」或「暫不同意」按鈕，或直接回覆「同意」或「不同意」。"),
+        AWAITING_BUTTON_RESPONSE: Transition(text="請回覆「有」或「沒有」，讓我知道您是否看到下面的按鈕。"),
+        AWAITING_TUTORIAL_CHOICE: Transition(text="請回覆「我要教學」或「我不要教學」，讓我知道您的選擇。"),
+        # 看完教學後的其他訊息：進入正常使用狀態並照正常功能處理
+        TUTORIAL_SHOWN: Transition(next_state=AGREED, redispatch=True),
+        DETAILED_TUTORIAL: Transition(next_state=AGREED, redispatch=True),
+        # 血糖數值 → 記錄；其他訊息 → 知識庫問答，找不到相關資料時一般回覆
+        AGREED: Transition(text=AGREED_REPLY, handler="agreed_message"),
+        DISAGREED: Transition(text="由於您尚未同意服務條款，目前無法使用糖小護的功能。\n\n如果您想重新開始，請輸入「重新開始」。"),
+    },
+)
@@ -0,0 +1,121 @@
+"""每位用戶的訊息限流與重複訊息合併
+
+短時間內大量傳訊的用戶 (連點、洗版或有問題的自動化程式) 每則訊息都會查詢
+知識庫、寫入用戶數據並回覆一次。RateLimiter 在處理文字訊息之前先判斷 (呼叫端
+只對正常使用狀態的文字訊息呼叫 check()，引導流程的快速回覆、貼圖等不計)：
+
+- 合併：同一用戶在 coalesce 秒內重複傳送相同的文字，只處理第一則
+- 限流：每位用戶一個 token bucket (每秒補 rate 個，最多累積 burst 個)；
+  用完時略過訊息，只在開始被限流時回覆一次提醒
+
+表格為 userId → _Bucket 的 OrderedDict，依最後使用時間排序。閒置超過
+idle 秒 (token 已補滿、也超過合併時間窗) 的用戶與新用戶沒有差別，插入時
+從最舊的一端移除；用戶數超過 max_users 時也移除最舊的。每個 worker 各自
+計數，gunicorn 有 N 個 worker 時單一用戶的實際上限最多為 N 倍。
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# check() 的結果
+ALLOW = "allow"
+COALESCED = "coalesced"
+LIMITED = "limited"
+# 剛開始被限流：略過訊息，但回覆一次提醒
+LIMITED_NOTICE = "limited_notice"
+
+DEFAULT_PER_MINUTE = 30
+DEFAULT_BURST = 10
+DEFAULT_COALESCE = 10.0
+DEFAULT_MAX_USERS = 100000
+
+RATE_LIMITED_REPLY = "⏳ 訊息有點多，糖小護處理不過來了，請稍等一下再傳送。"
+
+
+def text_digest(text):
+    """文字的 64 位元摘要 (與 hash() 不同，不隨行程的雜湊種子改變)"""
+    return hashlib.blake2b(text.strip().encode('utf-8'), digest_size=8).digest()
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "last_digest", "last_time", "notified")
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.last_digest = None
+        self.last_time = 0.0
+        self.notified = False
+
+
+class RateLimiter:
+    """每位用戶的 token bucket 與相同文字的合併 (執行緒安全，每個 worker 各自計數)"""
+
+    def __init__(self, per_minute=DEFAULT_PER_MINUTE, burst=DEFAULT_BURST,
+                 coalesce=DEFAULT_COALESCE, max_users=DEFAULT_MAX_USERS):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.coalesce = coalesce
+        self.max_users = max_users
+        # 閒置這麼久之後 bucket 與新建的完全相同，可以移除
+        self.idle = max(burst / self.rate, coalesce)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._allowed = 0
+        self._coalesced = 0
+        self._limited = 0
+        self._evicted = 0
+
+    def check(self, user_id, text=None, now=None):
+        """判斷這則訊息是否處理；text 為文字訊息的內容 (None 時不合併)"""
+        now = time.monotonic() if now is None else now
+        # 只保留文字的摘要，每位用戶佔用的記憶體與訊息長度無關
+        key = text_digest(text) if text else None
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                self._evict(now)
+                bucket = self._buckets[user_id] = _Bucket(self.burst, now)
+            else:
+                self._buckets.move_to_end(user_id)
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+                bucket.updated = now
+            if key is not None and key == bucket.last_digest and now - bucket.last_time < self.coalesce:
+                # 連續重複時以最後一則起算，持續洗版的相同訊息都會被合併
+                bucket.last_time = now
+                self._coalesced += 1
+                return COALESCED
+            if bucket.tokens < 1:
+                self._limited += 1
+                if bucket.notified:
+                    return LIMITED
+                bucket.notified = True
+                return LIMITED_NOTICE
+            bucket.tokens -= 1
+            bucket.notified = False
+            bucket.last_digest = key
+            bucket.last_time = now
+            self._allowed += 1
+            return ALLOW
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while buckets:
+            user_id, oldest = next(iter(buckets.items()))
+            if now - oldest.updated < self.idle and len(buckets) < self.max_users:
+                break
+            del buckets[user_id]
+            self._evicted += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "per_minute": self.rate * 60,
+                "burst": self.burst,
+                "users": len(self._buckets),
+                "allowed": self._allowed,
+                "coalesced": self._coalesced,
+                "limited": self._limited,
+                "evicted": self._evicted,
+            }
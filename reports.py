@@ -0,0 +1,300 @@
+"""血糖報表
+
+每位用戶維護一份「每日彙總」(筆數、總和、平方和、最小 / 最大值、
+低 / 高 / 目標範圍內筆數、各餐次筆數與總和)。新記錄只需併入所屬的那一天，
+產生報表時只走訪彙總的天數，不必重新掃描所有記錄。
+
+彙總以 BloodSugarSeries 已處理的筆數為游標：序列只會在尾端追加，
+每次只併入游標之後的新記錄 (包含其他 worker 寫入的)。
+有安裝 numpy 時，整批新記錄以 bincount 一次分組加總。
+
+彙總只存在各 worker 記憶體中的 LRU (ReportEngine)，不寫入磁碟：只走訪天數
+的成本僅在快取命中時成立。重新啟動後、被擠出快取或由另一個 worker 處理時，
+第一次報表會重新併入該用戶的所有記錄 (報表的趨勢圖本來就需要載入完整序列，
+持久化彙總也省不掉讀取記錄的 O(筆數) 成本)。
+"""
+import math
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from blood_sugar import MEAL_LABELS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# 目標範圍 (mg/dL)
+LOW_MG_DL = 70
+HIGH_MG_DL = 180
+# 血糖變異係數 (CV) 的穩定標準 (%)
+STABLE_CV = 36
+
+DAY_MS = 86400 * 1000
+# 以此時區的日期彙總 (預設台灣時間 UTC+8)
+UTC_OFFSET_MS = int(float(os.environ.get('REPORT_UTC_OFFSET_HOURS', 8)) * 3600 * 1000)
+
+MEAL_COUNT = len(MEAL_LABELS)
+
+
+def day_of(timestamp):
+    """毫秒時間戳 → 日序號 (自 1970-01-01 起的天數，依 UTC_OFFSET_MS 的當地日期)"""
+    return (timestamp + UTC_OFFSET_MS) // DAY_MS
+
+
+class DayStats:
+    """單日彙總"""
+
+    __slots__ = ("count", "total", "sumsq", "low", "high", "min", "max",
+                 "meal_count", "meal_total")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.sumsq = 0
+        self.low = 0
+        self.high = 0
+        self.min = None
+        self.max = None
+        self.meal_count = [0] * MEAL_COUNT
+        self.meal_total = [0] * MEAL_COUNT
+
+    def add(self, mg_dl, meal):
+        self.count += 1
+        self.total += mg_dl
+        self.sumsq += mg_dl * mg_dl
+        if mg_dl < LOW_MG_DL:
+            self.low += 1
+        elif mg_dl > HIGH_MG_DL:
+            self.high += 1
+        if self.min is None or mg_dl < self.min:
+            self.min = mg_dl
+        if self.max is None or mg_dl > self.max:
+            self.max = mg_dl
+        self.meal_count[meal] += 1
+        self.meal_total[meal] += mg_dl
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class DailyRollup:
+    """單一用戶的每日彙總"""
+
+    __slots__ = ("days", "processed", "first_timestamp")
+
+    def __init__(self):
+        self.days = {}                # 日序號 → DayStats
+        self.processed = 0            # 已併入的記錄筆數 (序列游標)
+        self.first_timestamp = None   # 用來辨識序列是否已被替換 (用戶刪除後重建)
+
+    def matches(self, series):
+        if len(series) < self.processed:
+            return False
+        return not self.processed or series.timestamps[0] == self.first_timestamp
+
+    def fold(self, series):
+        """併入序列中尚未處理的記錄"""
+        end = len(series)
+        start = self.processed
+        if start >= end:
+            return
+        if not start:
+            self.first_timestamp = series.timestamps[0]
+        if numpy is not None and end - start > 64:
+            self._fold_batch(series, start, end)
+        else:
+            days = self.days
+            for i in range(start, end):
+                day = day_of(series.timestamps[i])
+                stats = days.get(day)
+                if stats is None:
+                    stats = days[day] = DayStats()
+                stats.add(series.mg_dl[i], series.meals[i])
+        self.processed = end
+
+    def _fold_batch(self, series, start, end):
+        # array 欄位直接以 frombuffer 轉成 numpy 陣列 (不複製)
+        timestamps = numpy.frombuffer(series.timestamps, dtype=numpy.int64)[start:end]
+        values = numpy.frombuffer(series.mg_dl, dtype=numpy.uint16)[start:end].astype(numpy.int64)
+        meals = numpy.frombuffer(series.meals, dtype=numpy.uint8)[start:end].astype(numpy.int64)
+        day_index = (timestamps + UTC_OFFSET_MS) // DAY_MS
+        unique_days, inverse = numpy.unique(day_index, return_inverse=True)
+        n = len(unique_days)
+        count = numpy.bincount(inverse, minlength=n)
+        total = numpy.bincount(inverse, weights=values, minlength=n)
+        sumsq = numpy.bincount(inverse, weights=values * values, minlength=n)
+        low = numpy.bincount(inverse, weights=values < LOW_MG_DL, minlength=n)
+        high = numpy.bincount(inverse, weights=values > HIGH_MG_DL, minlength=n)
+        lows = numpy.full(n, numpy.iinfo(numpy.int64).max)
+        highs = numpy.full(n, numpy.iinfo(numpy.int64).min)
+        numpy.minimum.at(lows, inverse, values)
+        numpy.maximum.at(highs, inverse, values)
+        cell = inverse * MEAL_COUNT + meals
+        meal_count = numpy.bincount(cell, minlength=n * MEAL_COUNT).reshape(n, MEAL_COUNT)
+        meal_total = numpy.bincount(
+            cell, weights=values, minlength=n * MEAL_COUNT).reshape(n, MEAL_COUNT)
+        for j, day in enumerate(unique_days.tolist()):
+            stats = self.days.get(day)
+            if stats is None:
+                stats = self.days[day] = DayStats()
+            stats.count += int(count[j])
+            stats.total += int(total[j])
+            stats.sumsq += int(sumsq[j])
+            stats.low += int(low[j])
+            stats.high += int(high[j])
+            day_min, day_max = int(lows[j]), int(highs[j])
+            stats.min = day_min if stats.min is None else min(stats.min, day_min)
+            stats.max = day_max if stats.max is None else max(stats.max, day_max)
+            for meal in range(MEAL_COUNT):
+                stats.meal_count[meal] += int(meal_count[j, meal])
+                stats.meal_total[meal] += int(meal_total[j, meal])
+
+
+class WindowStats:
+    """一段期間 (數天) 的彙總結果"""
+
+    __slots__ = ("count", "mean", "sd", "cv", "min", "max",
+                 "low_pct", "high_pct", "in_range_pct", "gmi", "meals")
+
+    def __init__(self, days):
+        count = total = sumsq = low = high = 0
+        lo = hi = None
+        meal_count = [0] * MEAL_COUNT
+        meal_total = [0] * MEAL_COUNT
+        for stats in days:
+            count += stats.count
+            total += stats.total
+            sumsq += stats.sumsq
+            low += stats.low
+            high += stats.high
+            lo = stats.min if lo is None else min(lo, stats.min)
+            hi = stats.max if hi is None else max(hi, stats.max)
+            for meal in range(MEAL_COUNT):
+                meal_count[meal] += stats.meal_count[meal]
+                meal_total[meal] += stats.meal_total[meal]
+        self.count = count
+        self.min = lo
+        self.max = hi
+        if not count:
+            self.mean = self.sd = self.cv = self.gmi = 0.0
+            self.low_pct = self.high_pct = self.in_range_pct = 0.0
+            self.meals = {}
+            return
+        self.mean = total / count
+        self.sd = math.sqrt(max(0.0, sumsq / count - self.mean * self.mean))
+        self.cv = self.sd / self.mean * 100 if self.mean else 0.0
+        self.low_pct = low / count * 100
+        self.high_pct = high / count * 100
+        self.in_range_pct = 100 - self.low_pct - self.high_pct
+        # 血糖管理指標 (GMI，估算的糖化血色素 %)
+        self.gmi = 3.31 + 0.02392 * self.mean
+        self.meals = {
+            meal: meal_total[meal] / meal_count[meal]
+            for meal in range(1, MEAL_COUNT) if meal_count[meal]
+        }
+
+
+class Report:
+    """報表內容：近 7 / 30 天統計、每日平均與每週平均"""
+
+    __slots__ = ("week", "month", "daily", "weekly")
+
+    def __init__(self, rollup, today):
+        days = rollup.days
+        self.week = WindowStats(days[d] for d in range(today - 6, today + 1) if d in days)
+        self.month = WindowStats(days[d] for d in range(today - 29, today + 1) if d in days)
+        # (日序號, 平均)
+        self.daily = [(d, days[d].mean) for d in range(today - 6, today + 1) if d in days]
+        # (週次 0=本週 … 3, WindowStats)
+        self.weekly = [
+            (w, WindowStats(days[d] for d in range(today - 7 * w - 6, today - 7 * w + 1) if d in days))
+            for w in range(4)
+        ]
+
+
+class ReportEngine:
+    """各用戶的每日彙總快取 (最多 cache_size 位用戶，每個 worker 各自一份)
+
+    未命中時重新併入整個序列 (O(筆數))，之後的報表只併入新記錄。
+    """
+
+    def __init__(self, cache_size=1024):
+        self.cache_size = cache_size
+        self._rollups = OrderedDict()
+        self._lock = threading.Lock()
+
+    def rollup(self, user_id, series):
+        """取得已併入序列所有記錄的每日彙總 (呼叫端須持有該用戶的鎖)"""
+        with self._lock:
+            rollup = self._rollups.get(user_id)
+            if rollup is not None:
+                self._rollups.move_to_end(user_id)
+        if rollup is None or not rollup.matches(series):
+            rollup = DailyRollup()
+        rollup.fold(series)
+        with self._lock:
+            self._rollups[user_id] = rollup
+            while len(self._rollups) > self.cache_size:
+                self._rollups.popitem(last=False)
+        return rollup
+
+    def forget(self, user_id):
+        with self._lock:
+            self._rollups.pop(user_id, None)
+
+
+def format_day(day):
+    """日序號 → "MM/DD" """
+    return datetime.fromtimestamp(day * 86400, timezone.utc).strftime("%m/%d")
+
+
+def assess(stats):
+    """依目標範圍內時間、低血糖比例與變異係數給出簡短評估"""
+    notes = []
+    if stats.in_range_pct >= 70:
+        notes.append("✅ 目標範圍內 (70–180) 的比例達到建議的 70% 以上")
+    else:
+        notes.append("📌 目標範圍內 (70–180) 的比例低於建議的 70%")
+    if stats.low_pct >= 4:
+        notes.append("⚠️ 低血糖 (<70) 的比例偏高，請留意低血糖症狀")
+    if stats.count >= 3 and stats.cv > STABLE_CV:
+        notes.append(f"📈 血糖波動較大 (變異係數 {stats.cv:.0f}%)")
+    return notes
+
+
+def format_report(report):
+    """報表的文字內容；沒有記錄時回傳 None"""
+    month = report.month
+    if not month.count:
+        return None
+    week = report.week
+    lines = ["📊 血糖報表", ""]
+    if week.count:
+        lines += [
+            f"【近 7 天】共 {week.count} 筆",
+            f"平均 {week.mean:.0f} mg/dL (最低 {week.min}、最高 {week.max})",
+            f"目標範圍內 {week.in_range_pct:.0f}%｜偏低 {week.low_pct:.0f}%｜偏高 {week.high_pct:.0f}%",
+            "",
+        ]
+    lines += [
+        f"【近 30 天】共 {month.count} 筆",
+        f"平均 {month.mean:.0f} mg/dL，標準差 {month.sd:.0f}，變異係數 {month.cv:.0f}%",
+        f"估算糖化血色素 (GMI) 約 {month.gmi:.1f}%",
+    ]
+    if report.daily:
+        lines += ["", "【每日平均】"]
+        lines += [f"{format_day(day)}  {mean:.0f}" for day, mean in report.daily]
+    weekly = [(w, stats) for w, stats in report.weekly if stats.count]
+    if len(weekly) > 1:
+        labels = ("本週", "上週", "兩週前", "三週前")
+        lines += ["", "【每週平均】"]
+        lines += [f"{labels[w]}  {stats.mean:.0f}" for w, stats in weekly]
+    if month.meals:
+        lines += ["", "【餐次平均 (近 30 天)】"]
+        lines += [f"{MEAL_LABELS[meal]}  {mean:.0f}" for meal, mean in month.meals.items()]
+    lines += ["", "【評估】", *assess(month), "", "以上僅供參考，用藥與治療請與醫療團隊討論。"]
+    return "\n".join(lines)
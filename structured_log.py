@@ -0,0 +1,219 @@
+"""結構化日誌 (JSON lines，背景執行緒寫出)
+
+webhook 每個請求都會記錄事件；直接 print 在 gunicorn 下是同步寫 stdout，
+還會把用戶的健康資訊 (訊息內容、原始請求) 原樣寫進日誌。這裡改為：
+
+- get_logger(name).info("事件名稱", 欄位=值, ...)：呼叫端只建立紀錄並放進
+  有界佇列；格式化、去識別化與寫出都在背景執行緒進行。佇列滿時丟棄並計數，
+  不會阻塞請求
+- 去識別化：user_id 以 HMAC 轉成固定代號 (同一用戶的紀錄仍可串起來)；
+  訊息內容類欄位 (CONTENT_FIELDS) 只留字數。content_users 中的用戶
+  (如測試帳號) 或 log_content=True 時保留原文
+- 取樣：高流量事件可設定取樣率 (sample_rates)，WARNING 以上一律記錄；
+  取樣的紀錄帶 sample_rate 欄位，統計時可回推總量
+
+有安裝 orjson 時以 orjson 序列化。
+"""
+import atexit
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueListener
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ROOT_LOGGER = "linebot"
+DEFAULT_QUEUE_SIZE = 10000
+# 內容可能含健康資訊的欄位
+CONTENT_FIELDS = ("text", "reply", "body", "question")
+
+
+def _dumps(entry):
+    if orjson is not None:
+        return orjson.dumps(entry, default=str).decode('utf-8')
+    return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def parse_sample_rates(spec):
+    """"message_received=0.1,reply=0.1" → {"message_received": 0.1, "reply": 0.1}"""
+    rates = {}
+    for item in (spec or "").split(","):
+        name, _, rate = item.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+class Redactor:
+    """user_id → 代號、內容欄位 → 字數"""
+
+    def __init__(self, key, log_content=False, content_users=()):
+        self.key = key
+        self.log_content = log_content
+        self.content_users = frozenset(content_users)
+
+    def pseudonym(self, user_id):
+        return hmac.new(self.key, user_id.encode('utf-8'), hashlib.sha256).hexdigest()[:12]
+
+    def __call__(self, fields):
+        user_id = fields.pop("user_id", None)
+        keep = self.log_content or (user_id is not None and user_id in self.content_users)
+        if user_id is not None:
+            fields["user"] = self.pseudonym(user_id)
+        if not keep:
+            for name in CONTENT_FIELDS:
+                value = fields.get(name)
+                if value is not None:
+                    del fields[name]
+                    fields[name + "_chars"] = len(value)
+        return fields
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, redactor):
+        super().__init__()
+        self.redactor = redactor
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.msg,
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(self.redactor(dict(fields)))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return _dumps(entry)
+
+
+class AsyncHandler(logging.Handler):
+    """把紀錄放進有界佇列，由背景執行緒 (QueueListener) 寫出
+
+    紀錄不做任何格式化就放進佇列 (行程內佇列，不需序列化)；fork 後的
+    worker 第一次寫日誌時各自建立佇列與背景執行緒。
+    """
+
+    def __init__(self, target, queue_size=DEFAULT_QUEUE_SIZE):
+        super().__init__()
+        self.target = target
+        self.queue_size = queue_size
+        self.dropped = 0
+        # 多個執行緒同時丟棄時 += 不是原子操作
+        self._dropped_lock = threading.Lock()
+        self._queue = None
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.queue_size)
+            self._listener = QueueListener(self._queue, self.target, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def flush(self):
+        """等背景執行緒寫完目前佇列中的紀錄 (結束時呼叫)"""
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "queue_size": self.queue_size,
+            "dropped": self.dropped,
+        }
+
+
+class EventLogger:
+    """以事件名稱加欄位記錄：log.info("reply", user_id=..., text=...)"""
+
+    __slots__ = ("logger",)
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def _log(self, level, event, fields, exc_info=False):
+        if not self.logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING:
+            rate = _sample_rates.get(event)
+            if rate is not None:
+                if random.random() >= rate:
+                    return
+                fields["sample_rate"] = rate
+        self.logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event, **fields):
+        """在 except 區塊中呼叫，附上 traceback"""
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+
+_sample_rates = {}
+_handler = None
+
+
+def get_logger(name):
+    return EventLogger(logging.getLogger(f"{ROOT_LOGGER}.{name}"))
+
+
+def configure(level="INFO", sample_rates=None, redact_key=b"", log_content=False,
+              content_users=(), stream=None, queue_size=DEFAULT_QUEUE_SIZE):
+    """設定 linebot.* 日誌：JSON lines 寫到 stream (預設 stdout)，回傳 AsyncHandler
+
+    行程結束時 (atexit) 會先寫完佇列中的紀錄。
+    """
+    global _handler
+    _sample_rates.clear()
+    _sample_rates.update(sample_rates or {})
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter(Redactor(redact_key, log_content, content_users)))
+    root = logging.getLogger(ROOT_LOGGER)
+    if _handler is not None:
+        root.removeHandler(_handler)
+        _handler.flush()
+        atexit.unregister(_handler.flush)
+    _handler = AsyncHandler(output, queue_size)
+    atexit.register(_handler.flush)
+    root.addHandler(_handler)
+    root.setLevel(level)
+    root.propagate = False
+    return _handler
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 測試直接匯入專案根目錄的模組 (本專案沒有打包)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,155 @@
+"""問答快取：不同寫法的問題對應同一個快取鍵、LRU / TTL 淘汰、知識庫換版時清除"""
+import os
+
+import pytest
+
+from answer_cache import AnswerCache, normalize_question
+from knowledge import KnowledgeBase, tokenize
+from knowledge_index import KnowledgeIndex, build_index
+
+KNOWLEDGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "knowledge")
+
+VARIANTS = [
+    "血糖高怎麼辦？",
+    "血糖高怎麼辦",
+    "請問血糖高怎麼辦",
+    "請問一下，血糖高怎麼辦呢？",
+    "您好！請問 血糖高 怎麼辦？？謝謝",
+    "血糖高怎么办",
+    "请问血糖高怎么办?",
+    "血糖高怎麼辦?!",
+    "「血糖高」怎麼辦…",
+    "血糖高怎麼辦～",
+]
+
+
+@pytest.mark.parametrize("question", VARIANTS)
+def test_variants_share_one_key(question):
+    assert normalize_question(question) == "血糖高怎麼辦"
+
+
+@pytest.mark.parametrize("question, expected", [
+    # 全形英數字、大小寫
+    ("ＨｂＡ１ｃ 是什麼？", "hba1c是什麼"),
+    ("HbA1c是什麼", "hba1c是什麼"),
+    # 英數字之間的空白保留一個
+    ("Blood   Sugar 多少算高", "blood sugar多少算高"),
+    ("空腹血糖 ７０ 到 １００", "空腹血糖70到100"),
+    # 簡體
+    ("糖尿病饮食要注意什么", "糖尿病飲食要注意什麼"),
+    ("运动后血糖会变低吗", "運動後血糖會變低"),
+    # 整句都是客套語時保留原字
+    ("你好！", "你好"),
+    ("謝謝", "謝謝"),
+])
+def test_normalize_question(question, expected):
+    assert normalize_question(question) == expected
+
+
+@pytest.fixture(scope="module")
+def base():
+    return KnowledgeBase.load(KNOWLEDGE_DIR)
+
+
+def test_variants_retrieve_the_same_passages(base):
+    # 檢索使用正規化後的問題：所有寫法的切詞與結果都相同，快取的回覆與重新檢索一致
+    keys = {normalize_question(question) for question in VARIANTS}
+    assert len(keys) == 1
+    key = keys.pop()
+    assert {tuple(tokenize(normalize_question(question))) for question in VARIANTS} == {tuple(tokenize(key))}
+    hits = base.answer(key)
+    assert hits
+    for question in VARIANTS:
+        assert [hit.passage for hit in base.answer(normalize_question(question))] == [
+            hit.passage for hit in hits]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_eviction_by_entries():
+    cache = AnswerCache(max_entries=2)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    assert cache.get("a") == "A"
+    cache.put("c", "C")
+    # b 最久未使用，被擠出
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ("A", "C")
+    assert cache.stats()["evicted"] == 1
+    assert cache.stats()["entries"] == 2
+
+
+def test_lru_eviction_by_bytes():
+    value = "糖" * 100
+    size = AnswerCache().sizeof("k0", value)
+    cache = AnswerCache(max_entries=100, max_bytes=size * 3)
+    for i in range(5):
+        cache.put(f"k{i}", value)
+    stats = cache.stats()
+    assert stats["entries"] == 3
+    assert stats["bytes"] == size * 3
+    assert [cache.get(f"k{i}") for i in range(5)] == [None, None, value, value, value]
+    # 單筆超過上限的值不快取，也不會擠掉其他結果
+    cache.put("huge", "糖" * size * 3)
+    assert cache.get("huge") is None
+    assert cache.stats()["entries"] == 3
+
+
+def test_ttl_expiry():
+    clock = Clock()
+    cache = AnswerCache(ttl=10, clock=clock)
+    cache.put("a", "A")
+    clock.now = 9.9
+    assert cache.get("a") == "A"
+    # 命中不會延長效期
+    clock.now = 10.0
+    assert cache.get("a") is None
+    stats = cache.stats()
+    assert (stats["expired"], stats["entries"], stats["bytes"]) == (1, 0, 0)
+    # 過期後重新寫入
+    cache.put("a", "A2")
+    clock.now = 19.9
+    assert cache.get("a") == "A2"
+
+
+def test_no_answer_is_cached():
+    cache = AnswerCache()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return ""
+
+    assert cache.get_or_compute("問題", compute) == ""
+    assert cache.get_or_compute("問題", compute) == ""
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
+
+
+def test_cache_is_cleared_when_index_reloads(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    output = str(tmp_path / "index")
+    (source / "飲食.md").write_text("# 飲食\n\n血糖高時少吃精緻澱粉。\n", encoding="utf-8")
+    build_index(str(source), output)
+
+    cache = AnswerCache()
+    index = KnowledgeIndex(output, check_interval=0, on_reload=cache.clear)
+    first = index.version
+    cache.put("血糖高怎麼辦", "舊的回覆")
+    # 版本沒有變動：不清除
+    assert index.version == first
+    assert cache.get("血糖高怎麼辦") == "舊的回覆"
+
+    (source / "飲食.md").write_text("# 飲食\n\n血糖高時多喝水並測量血糖。\n", encoding="utf-8")
+    build_index(str(source), output)
+    assert index.version != first
+    assert cache.get("血糖高怎麼辦") is None
+    assert cache.stats()["entries"] == 0
@@ -0,0 +1,104 @@
+"""事件分派：整批事件各處理一次，同一用戶依原順序"""
+import random
+import threading
+import time
+
+from dispatcher import EventDispatcher, QueuedDispatcher
+
+
+class Event:
+    def __init__(self, user, seq):
+        self.user_id = user
+        self.source_key = user
+        self.seq = seq
+        self.type = "message"
+
+
+def mixed_batch(events=600, users=40, seed=1):
+    rng = random.Random(seed)
+    counters = {}
+    batch = []
+    for _ in range(events):
+        user = f"U{rng.randrange(users)}"
+        counters[user] = counters.get(user, 0) + 1
+        batch.append(Event(user, counters[user]))
+    return batch
+
+
+class Recorder:
+    def __init__(self, delay=0.0, fail=()):
+        self.delay = delay
+        self.fail = set(fail)
+        self.handled = []
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        if self.delay:
+            time.sleep(self.delay * random.random())
+        with self.lock:
+            self.handled.append(event)
+        if (event.user_id, event.seq) in self.fail:
+            raise RuntimeError("handler failed")
+
+    def by_user(self):
+        result = {}
+        for event in self.handled:
+            result.setdefault(event.user_id, []).append(event.seq)
+        return result
+
+
+def assert_each_once_in_order(batch, recorder):
+    assert sorted(map(id, recorder.handled)) == sorted(map(id, batch))
+    for user, seqs in recorder.by_user().items():
+        assert seqs == list(range(1, len(seqs) + 1)), user
+
+
+def test_large_mixed_batch_handled_once_in_user_order():
+    batch = mixed_batch()
+    recorder = Recorder(delay=0.0005)
+    dispatcher = EventDispatcher(max_workers=8)
+    try:
+        dispatcher.dispatch(batch, recorder)
+    finally:
+        dispatcher.shutdown()
+    assert_each_once_in_order(batch, recorder)
+
+
+def test_failing_event_does_not_stop_the_rest_of_the_batch():
+    batch = mixed_batch(events=300, users=10)
+    failing = {(event.user_id, event.seq) for event in batch[::7]}
+    recorder = Recorder(fail=failing)
+    dispatcher = EventDispatcher(max_workers=4)
+    try:
+        dispatcher.dispatch(batch, recorder)
+    finally:
+        dispatcher.shutdown()
+    assert_each_once_in_order(batch, recorder)
+
+
+def test_single_user_batch_runs_in_order():
+    batch = [Event("U1", seq) for seq in range(1, 301)]
+    recorder = Recorder()
+    EventDispatcher().dispatch(batch, recorder)
+    assert [event.seq for event in recorder.handled] == list(range(1, 301))
+
+
+def test_queued_dispatcher_keeps_user_order_when_shards_are_full():
+    # 佇列很小、等待很短：舊版逾時後改在請求執行緒處理，會與分片中較早的事件顛倒順序
+    dispatcher = QueuedDispatcher(workers=2, queue_size=4, enqueue_timeout=0.01)
+    recorder = Recorder(delay=0.002)
+    batches = [mixed_batch(events=20, users=5, seed=seed) for seed in range(30)]
+    # 每批各自從 1 起算；改成跨批次遞增，才能檢查跨 webhook 的順序
+    offsets = {}
+    for batch in batches:
+        for event in batch:
+            event.seq += offsets.get(event.user_id, 0)
+        for event in batch:
+            offsets[event.user_id] = max(offsets.get(event.user_id, 0), event.seq)
+    try:
+        for batch in batches:
+            dispatcher.dispatch(batch, recorder)
+    finally:
+        dispatcher.shutdown()
+    assert_each_once_in_order([event for batch in batches for event in batch], recorder)
+    assert dispatcher.stats()["processed"] == sum(len(batch) for batch in batches)
@@ -0,0 +1,67 @@
+"""重送事件去重：處理完成才記錄，失敗或中斷的事件在重送時再處理"""
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import lockfile
+from event_dedup import CLAIMED, IN_PROGRESS, PROCESSED, EventDeduplicator
+
+pytestmark = pytest.mark.skipif(lockfile.fcntl is None, reason="需要 fcntl (POSIX)")
+
+
+def make_dedup(tmp_path, **kwargs):
+    return EventDeduplicator(str(tmp_path / "events.dedup"), slots=64, **kwargs)
+
+
+def event(event_id, redelivery):
+    return SimpleNamespace(webhook_event_id=event_id, is_redelivery=redelivery)
+
+
+def test_file_is_created_on_first_use(tmp_path):
+    dedup = make_dedup(tmp_path)
+    assert not os.path.exists(dedup.path)
+    dedup.is_duplicate(event("a", False))
+    assert os.path.exists(dedup.path)
+
+
+def test_completed_event_is_skipped_on_redelivery(tmp_path):
+    dedup = make_dedup(tmp_path)
+    assert not dedup.is_duplicate(event("a", False))
+    dedup.complete(event("a", False))
+    assert dedup.is_duplicate(event("a", True))
+    assert dedup.stats()["duplicates"] == 1
+
+
+def test_failed_event_is_processed_again_on_redelivery(tmp_path):
+    dedup = make_dedup(tmp_path)
+    assert not dedup.is_duplicate(event("a", False))
+    dedup.release(event("a", False))
+    assert not dedup.is_duplicate(event("a", True))
+    assert dedup.stats()["released"] == 1
+
+
+def test_in_progress_event_is_taken_over_after_lease(tmp_path):
+    dedup = make_dedup(tmp_path, lease=60)
+    assert dedup.claim("a", now=1000) == CLAIMED
+    # 另一個 worker 仍在處理
+    assert dedup.claim("a", now=1030) == IN_PROGRESS
+    # 處理的 worker 被終止，lease 過後由重送的事件接手
+    assert dedup.claim("a", now=1061) == CLAIMED
+    dedup.finish("a", now=1062)
+    assert dedup.claim("a", now=2000) == PROCESSED
+
+
+def test_completed_event_expires_after_window(tmp_path):
+    dedup = make_dedup(tmp_path, window=3600)
+    assert dedup.claim("a", now=1000) == CLAIMED
+    dedup.finish("a", now=1000)
+    assert dedup.claim("a", now=1000 + 3601) == CLAIMED
+
+
+def test_table_is_shared_between_instances(tmp_path):
+    first, second = make_dedup(tmp_path), make_dedup(tmp_path)
+    assert first.claim("a") == CLAIMED
+    assert second.claim("a") == IN_PROGRESS
+    first.finish("a")
+    assert second.claim("a") == PROCESSED
@@ -0,0 +1,98 @@
+"""七段顯示器辨識：以合成的血糖機螢幕照片檢查讀數"""
+import io
+
+import pytest
+
+# 匯入 glucometer_ocr 前先確認相依套件 (image_pipeline 需要 requests 與 linebot)
+pytest.importorskip("PIL", reason="需要 Pillow")
+pytest.importorskip("numpy", reason="需要 numpy")
+pytest.importorskip("requests", reason="需要 requests")
+pytest.importorskip("linebot", reason="需要 line-bot-sdk")
+
+import glucometer_ocr
+from image_pipeline import GLUCOMETER, UNKNOWN
+from PIL import Image, ImageDraw, ImageFilter
+
+SEGMENTS = {
+    "0": "abcdef", "1": "bc", "2": "abdeg", "3": "abcdg", "4": "bcfg",
+    "5": "acdfg", "6": "acdefg", "7": "abc", "8": "abcdefg", "9": "abcdfg",
+}
+
+
+def draw_digit(draw, x, y, width, height, segments, stroke):
+    """七段數字；直段在中間斷開 (與多數 LCD 相同)，「1」只有右側兩段"""
+    gap = max(1, stroke // 4)
+    half = height // 2
+    rects = {
+        "a": (x + stroke + gap, y, x + width - stroke - gap, y + stroke),
+        "g": (x + stroke + gap, y + half - stroke // 2, x + width - stroke - gap, y + half + stroke - stroke // 2),
+        "d": (x + stroke + gap, y + height - stroke, x + width - stroke - gap, y + height),
+        "f": (x, y, x + stroke, y + half - gap),
+        "b": (x + width - stroke, y, x + width, y + half - gap),
+        "e": (x, y + half + gap, x + stroke, y + height),
+        "c": (x + width - stroke, y + half + gap, x + width, y + height),
+    }
+    for name in segments:
+        draw.rectangle(rects[name], fill=(25, 30, 25))
+
+
+def display_photo(digits, pitch=1.35, size=(1600, 1200)):
+    """深色機身上的淺色 LCD，數字為 digits (各位數為要亮起的段)，另有一排小字的日期"""
+    width, height = size
+    image = Image.new("RGB", size, (40, 40, 45))
+    draw = ImageDraw.Draw(image)
+    lcd = (int(width * 0.2), int(height * 0.2), int(width * 0.8), int(height * 0.75))
+    draw.rounded_rectangle(lcd, 30, fill=(170, 185, 160))
+    digit_height = int(height * 0.3)
+    digit_width = int(digit_height * 0.55)
+    x, y = lcd[0] + int(width * 0.08), lcd[1] + int(height * 0.14)
+    for segments in digits:
+        draw_digit(draw, x, y, digit_width, digit_height, segments, digit_height // 9)
+        x += int(digit_width * pitch)
+    x = lcd[0] + 40
+    for char in "1030":
+        draw_digit(draw, x, lcd[1] + 10, digit_height // 7, digit_height // 4, SEGMENTS[char], 4)
+        x += digit_height // 5
+    image = image.filter(ImageFilter.GaussianBlur(1.5))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def photo_of(text, **kwargs):
+    return display_photo([SEGMENTS[char] for char in text], **kwargs)
+
+
+@pytest.mark.parametrize("text", ["100", "120", "156", "188", "199", "205", "250", "310", "340", "98"])
+@pytest.mark.parametrize("pitch", [1.35, 1.2])
+def test_reads_display(text, pitch):
+    reading = glucometer_ocr.read_display(photo_of(text, pitch=pitch))
+    assert reading is not None
+    assert reading.text == text
+    assert reading.mg_dl == int(text)
+
+
+@pytest.mark.parametrize("text", ["120", "156", "188", "250", "340"])
+def test_tight_digits_never_lose_a_digit(text):
+    # 數字幾乎相連時，「1」與「0」的上下兩段可能分成兩塊；讀不到時寧可不讀，不可少一位
+    reading = glucometer_ocr.read_display(photo_of(text, pitch=1.1))
+    assert reading is None or reading.text == text
+
+
+def test_partly_hidden_leading_digit_is_not_recorded():
+    # 開頭的「1」只看得到上半段 (反光)：讀到的 56 不能直接記錄
+    photo = display_photo(["b", SEGMENTS["5"], SEGMENTS["6"]])
+    assert glucometer_ocr.read_display(photo) is None
+    result = glucometer_ocr.GlucometerAnalyzer(processes=0).analyze(iter((photo,)), "image/jpeg")
+    assert result.kind == UNKNOWN
+    assert result.reading is None
+
+
+def test_analyzer_reads_in_a_child_process():
+    analyzer = glucometer_ocr.GlucometerAnalyzer(processes=1)
+    try:
+        result = analyzer.analyze(iter((photo_of("156"),)), "image/jpeg")
+    finally:
+        analyzer.shutdown()
+    assert result.kind == GLUCOMETER
+    assert result.reading == 156
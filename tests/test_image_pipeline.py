@@ -0,0 +1,197 @@
+"""圖片分析：以 (用戶, 內容雜湊) 快取結果，同一用戶重傳的照片不再分析"""
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+# 匯入 image_pipeline 前先確認相依套件
+pytest.importorskip("requests", reason="需要 requests")
+pytest.importorskip("linebot", reason="需要 line-bot-sdk")
+
+from image_pipeline import (
+    ANALYSIS_FAILED_REPLY, GLUCOMETER, TOO_LARGE_REPLY, AnalysisResult, Analyzer, ImagePipeline,
+    ResultCache,
+)
+
+PHOTO = bytes(range(256)) * 40
+OTHER_PHOTO = PHOTO[:-1] + b"\x00"
+
+
+class FakeResponse:
+    def __init__(self, data, piece):
+        self.status_code = 200
+        self.headers = {"Content-Type": "image/jpeg"}
+        self.data = data
+        self.piece = piece
+        self.response = SimpleNamespace(close=lambda: None)
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.data), self.piece):
+            yield self.data[i:i + self.piece]
+
+
+class FakeLineApi:
+    """以 message_id 對應圖片內容的 LINE API"""
+
+    data_endpoint = "https://api-data.line.me"
+    headers = {}
+
+    def __init__(self, photos, piece=1000):
+        self.photos = photos
+        self.piece = piece
+        self.http_client = self
+        self.downloads = 0
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        self.downloads += 1
+        message_id = url.split("/")[-2]
+        return FakeResponse(self.photos[message_id], self.piece)
+
+
+class CountingAnalyzer(Analyzer):
+    def __init__(self, fail=False):
+        self.calls = 0
+        self.fail = fail
+
+    def analyze(self, chunks, content_type):
+        self.calls += 1
+        size = sum(len(chunk) for chunk in chunks)
+        if self.fail:
+            raise RuntimeError("analyzer down")
+        return AnalysisResult(GLUCOMETER, f"血糖 123 mg/dL ({size} bytes)", reading=123)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def analyzer():
+    return CountingAnalyzer()
+
+
+def make_pipeline(analyzer, cache=True, **kwargs):
+    return ImagePipeline(analyzer, cache=ResultCache(**kwargs) if cache else None)
+
+
+def test_same_user_same_photo_is_analyzed_once(analyzer):
+    pipeline = make_pipeline(analyzer)
+    api = FakeLineApi({"m1": PHOTO, "m2": PHOTO})
+    first = pipeline.process(api, "U1", "m1")
+    second = pipeline.process(api, "U1", "m2")
+    assert analyzer.calls == 1
+    # 仍須下載才能比對雜湊
+    assert api.downloads == 2
+    assert (first.duplicate, second.duplicate) == (False, True)
+    assert (second.kind, second.text, second.reading) == (first.kind, first.text, first.reading)
+    stats = pipeline.stats()
+    assert (stats["completed"], stats["deduplicated"], stats["bytes_saved"]) == (2, 1, len(PHOTO))
+    assert stats["bytes"] == 2 * len(PHOTO)
+    # 命中時回傳副本：快取中的項目 (即第一次的結果) 不會被標記為重複
+    assert pipeline.process(api, "U1", "m1").duplicate
+    assert not first.duplicate
+
+
+def test_chunking_does_not_change_the_key(analyzer):
+    pipeline = make_pipeline(analyzer)
+    pipeline.process(FakeLineApi({"m1": PHOTO}, piece=7), "U1", "m1")
+    result = pipeline.process(FakeLineApi({"m1": PHOTO}, piece=4096), "U1", "m1")
+    assert result.duplicate
+    assert analyzer.calls == 1
+
+
+def test_other_users_photo_is_analyzed_again(analyzer):
+    # 鍵包含用戶：不會透露其他用戶傳過同一張照片
+    pipeline = make_pipeline(analyzer)
+    api = FakeLineApi({"m1": PHOTO})
+    pipeline.process(api, "U1", "m1")
+    result = pipeline.process(api, "U2", "m1")
+    assert not result.duplicate
+    assert analyzer.calls == 2
+
+
+def test_different_photo_is_analyzed(analyzer):
+    pipeline = make_pipeline(analyzer)
+    api = FakeLineApi({"m1": PHOTO, "m2": OTHER_PHOTO})
+    pipeline.process(api, "U1", "m1")
+    assert not pipeline.process(api, "U1", "m2").duplicate
+    assert analyzer.calls == 2
+
+
+def test_without_cache_every_photo_is_analyzed(analyzer):
+    pipeline = make_pipeline(analyzer, cache=False)
+    api = FakeLineApi({"m1": PHOTO})
+    for _ in range(3):
+        assert not pipeline.process(api, "U1", "m1").duplicate
+    assert analyzer.calls == 3
+    assert pipeline.stats()["cache"] is None
+
+
+def test_cached_result_expires(analyzer):
+    clock = Clock()
+    pipeline = make_pipeline(analyzer, ttl=60, clock=clock)
+    api = FakeLineApi({"m1": PHOTO})
+    pipeline.process(api, "U1", "m1")
+    clock.now = 59
+    assert pipeline.process(api, "U1", "m1").duplicate
+    clock.now = 60
+    assert not pipeline.process(api, "U1", "m1").duplicate
+    assert analyzer.calls == 2
+
+
+def test_cache_evicts_least_recently_used(analyzer):
+    pipeline = make_pipeline(analyzer, max_entries=2)
+    photos = {f"m{i}": bytes([i]) * 100 for i in range(3)}
+    api = FakeLineApi(photos)
+    for message_id in ("m0", "m1", "m0", "m2"):
+        pipeline.process(api, "U1", message_id)
+    assert analyzer.calls == 3
+    # m1 被擠出，m0 仍在快取中
+    assert not pipeline.process(api, "U1", "m1").duplicate
+    assert pipeline.process(api, "U1", "m2").duplicate
+
+
+def test_failures_are_not_cached():
+    analyzer = CountingAnalyzer(fail=True)
+    pipeline = make_pipeline(analyzer)
+    api = FakeLineApi({"m1": PHOTO})
+    assert pipeline.process(api, "U1", "m1").text == ANALYSIS_FAILED_REPLY
+    analyzer.fail = False
+    result = pipeline.process(api, "U1", "m1")
+    assert not result.duplicate
+    assert result.reading == 123
+    assert analyzer.calls == 2
+
+
+def test_too_large_photo_is_not_cached(analyzer):
+    pipeline = ImagePipeline(analyzer, max_bytes=len(PHOTO) - 1, cache=ResultCache())
+    api = FakeLineApi({"m1": PHOTO})
+    assert pipeline.process(api, "U1", "m1").text == TOO_LARGE_REPLY
+    assert analyzer.calls == 0
+    assert pipeline.cache.stats()["entries"] == 0
+    assert pipeline.stats()["too_large"] == 1
+
+
+def test_submit_delivers_duplicate_result(analyzer):
+    delivered = []
+    done = threading.Semaphore(0)
+
+    def deliver(line_bot_api, user_id, result, timestamp):
+        delivered.append((user_id, result.duplicate, timestamp))
+        done.release()
+
+    pipeline = ImagePipeline(analyzer, workers=1, deliver=deliver, cache=ResultCache())
+    api = FakeLineApi({"m1": PHOTO, "m2": PHOTO})
+    try:
+        assert pipeline.submit(api, "U1", "m1", timestamp=1000)
+        assert done.acquire(timeout=5)
+        assert pipeline.submit(api, "U1", "m2", timestamp=2000)
+        assert done.acquire(timeout=5)
+    finally:
+        pipeline.shutdown()
+    assert delivered == [("U1", False, 1000), ("U1", True, 2000)]
+    assert analyzer.calls == 1
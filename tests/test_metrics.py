@@ -0,0 +1,95 @@
+"""多 worker 指標：已結束的 worker 併入 retired.json，計數器不倒退"""
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import lockfile
+import metrics
+
+pytestmark = pytest.mark.skipif(lockfile.fcntl is None, reason="需要 fcntl (POSIX)")
+
+
+def make_registry(directory):
+    registry = metrics.Registry()
+    registry.configure(True, directory=str(directory), flush_interval=3600)
+    requests = registry.counter("requests_total", "requests", ("status",))
+    seconds = registry.histogram("seconds", "seconds", buckets=(0.1, 1.0))
+    return registry, requests, seconds
+
+
+def run_worker(directory, count, exit_cleanly):
+    registry, requests, seconds = make_registry(directory)
+    registry.start_flusher()
+    for _ in range(count):
+        requests.inc("200")
+        seconds.observe(0.05)
+    registry.flush()
+    if exit_cleanly:
+        # 正常結束時 atexit 執行的步驟 (multiprocessing 的子行程以 os._exit 結束，不執行 atexit)
+        registry._exit()
+
+
+def run_busy_worker(directory, count):
+    """寫檔執行緒幾乎不停寫檔時結束：結束後不應再出現本行程的檔案"""
+    registry, requests, _ = make_registry(directory)
+    registry.flush_interval = 0.0005
+    registry.start_flusher()
+    for _ in range(count):
+        requests.inc("200")
+        time.sleep(0.0001)
+    registry._exit()
+    # 重複呼叫不會再寫檔或重複併入
+    registry._exit()
+    time.sleep(0.05)
+    if os.path.exists(os.path.join(directory, f"{os.getpid()}.json")):
+        os._exit(1)
+
+
+def run_workers(directory, counts, *args, target=run_worker):
+    context = multiprocessing.get_context("fork")
+    for count in counts:
+        process = context.Process(target=target, args=(directory, count, *args))
+        process.start()
+        process.join()
+        assert process.exitcode == 0
+
+
+def total_requests(registry):
+    return sum(registry.collect()["requests_total"].values())
+
+
+def json_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".json"))
+
+
+@pytest.mark.parametrize("exit_cleanly", [True, False])
+def test_exited_workers_are_folded_into_retired(tmp_path, exit_cleanly):
+    run_workers(tmp_path, [3, 5, 7], exit_cleanly)
+    registry, requests, _ = make_registry(tmp_path)
+    requests.inc("200")
+
+    assert total_requests(registry) == 16
+    # 只剩存活的本行程與 retired.json
+    assert json_files(tmp_path) == sorted([f"{os.getpid()}.json", metrics.RETIRED_FILE])
+    # 再次輸出時不會重複計入
+    assert total_requests(registry) == 16
+    buckets = registry.collect()["seconds"]
+    assert sum(sum(entry[:-1]) for entry in buckets.values()) == 15
+
+
+def test_retired_counts_survive_more_restarts(tmp_path):
+    registry, _, _ = make_registry(tmp_path)
+    run_workers(tmp_path, [2], True)
+    assert total_requests(registry) == 2
+    run_workers(tmp_path, [4], False)
+    assert total_requests(registry) == 6
+    assert json_files(tmp_path) == sorted([f"{os.getpid()}.json", metrics.RETIRED_FILE])
+
+
+def test_exit_stops_flusher_before_retiring(tmp_path):
+    run_workers(tmp_path, [50, 80, 120], target=run_busy_worker)
+    registry, _, _ = make_registry(tmp_path)
+    assert total_requests(registry) == 250
+    assert json_files(tmp_path) == sorted([f"{os.getpid()}.json", metrics.RETIRED_FILE])
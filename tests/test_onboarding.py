@@ -0,0 +1,194 @@
+"""引導流程狀態機：逐一檢查 (狀態 × 輸入)、完整的同意流程、轉移表檢查與隨機事件"""
+import random
+
+import pytest
+
+from onboarding import (
+    AGREED, AWAITING_BUTTON_RESPONSE, AWAITING_TUTORIAL_CHOICE, CREATE_USER, DELETE_USER,
+    DETAILED_TUTORIAL, DISAGREED, FOLLOW, IMAGE, MEDIA, MEDIA_REPLY, NEW, ONBOARDING, OTHER,
+    PENDING, TUTORIAL_SHOWN, StateMachine, Transition,
+)
+
+STATES = list(ONBOARDING.defaults)
+HANDLER_NAMES = {"agreed_message", "blood_sugar_report", "image_message"}
+# 轉移表列出的輸入、代表其他輸入的 OTHER，以及幾則一般文字
+INPUTS = [*ONBOARDING.inputs(), OTHER, FOLLOW, MEDIA, IMAGE, "120", "血糖高怎麼辦？", ""]
+
+
+def step(state, signal):
+    """與 app.handle_event 相同的狀態變化：建立用戶為 PENDING，刪除用戶回到 NEW"""
+    transition, new_state = ONBOARDING.resolve(state, signal)
+    assert transition is not None
+    if transition.action == CREATE_USER:
+        return transition, PENDING
+    if transition.action == DELETE_USER:
+        return transition, NEW
+    return transition, state if new_state is None else new_state
+
+
+def replies(transition):
+    return bool(transition.templates) or transition.text is not None or transition.handler is not None
+
+
+@pytest.mark.parametrize("state", STATES)
+@pytest.mark.parametrize("signal", INPUTS)
+def test_every_state_and_input_resolves(state, signal):
+    transition, new_state = step(state, signal)
+    assert new_state in ONBOARDING.defaults
+    assert not transition.redispatch
+    # 每則輸入都有回覆 (樣板、文字或處理函式)
+    assert replies(transition)
+    if transition.handler is not None:
+        assert transition.handler in HANDLER_NAMES
+
+
+def test_table_validates():
+    ONBOARDING.validate(handler_names=HANDLER_NAMES)
+    # 建立用戶時的初始狀態與 app.new_user_record 一致
+    assert ONBOARDING.defaults[NEW].action == CREATE_USER
+    assert ONBOARDING.defaults[NEW].next_state == PENDING
+
+
+@pytest.mark.parametrize("state", [
+    NEW, PENDING, AWAITING_BUTTON_RESPONSE, AWAITING_TUTORIAL_CHOICE,
+    TUTORIAL_SHOWN, DETAILED_TUTORIAL, DISAGREED,
+])
+def test_image_outside_agreed_only_gets_media_reply(state):
+    transition, new_state = ONBOARDING.resolve(state, IMAGE)
+    assert transition.text == MEDIA_REPLY
+    assert transition.handler is None
+    assert transition.action is None
+    assert new_state is None
+
+
+def test_image_in_agreed_goes_to_image_handler():
+    transition, new_state = ONBOARDING.resolve(AGREED, IMAGE)
+    assert transition.handler == "image_message"
+    assert new_state is None
+
+
+def test_text_after_tutorial_still_enters_agreed():
+    transition, new_state = ONBOARDING.resolve(TUTORIAL_SHOWN, "120")
+    assert transition.handler == "agreed_message"
+    assert new_state == AGREED
+
+
+def test_follow_always_restarts_with_terms():
+    for state in STATES:
+        transition, new_state = step(state, FOLLOW)
+        assert transition.templates == ("terms",)
+        assert new_state == PENDING
+
+
+def walk(state, inputs):
+    """依序送出 inputs，回傳每一步的 (樣板, 處理函式, 狀態)"""
+    trace = []
+    for signal in inputs:
+        transition, state = step(state, signal)
+        trace.append((transition.templates, transition.handler, state))
+    return trace
+
+
+def test_consent_flow_with_tutorial():
+    trace = walk(NEW, ["你好", "同意", "沒有", "有", "我要教學", "血糖教學", "120", "報表"])
+    assert trace == [
+        (("terms",), None, PENDING),
+        (("welcome", "button_check"), None, AWAITING_BUTTON_RESPONSE),
+        # 沒看到按鈕：再說明一次，狀態不變
+        ((), None, AWAITING_BUTTON_RESPONSE),
+        (("tutorial_choice",), None, AWAITING_TUTORIAL_CHOICE),
+        (("tutorial",), None, TUTORIAL_SHOWN),
+        (("blood_sugar_tutorial",), None, DETAILED_TUTORIAL),
+        # 教學後的其他訊息以正常使用狀態處理
+        ((), "agreed_message", AGREED),
+        ((), "blood_sugar_report", AGREED),
+    ]
+
+
+def test_consent_flow_without_tutorial():
+    trace = walk(NEW, ["你好", "同意", "有", "我不要教學", "教學"])
+    assert [state for _, _, state in trace] == [
+        PENDING, AWAITING_BUTTON_RESPONSE, AWAITING_TUTORIAL_CHOICE, AGREED, TUTORIAL_SHOWN,
+    ]
+    assert trace[3][0] == ("skip_tutorial",)
+
+
+def test_agree_and_disagree_stamp_time():
+    assert ONBOARDING.resolve(PENDING, "同意")[0].stamp == "agreed_time"
+    assert ONBOARDING.resolve(PENDING, "不同意")[0].stamp == "disagreed_time"
+
+
+def test_disagreed_branch_and_restart():
+    trace = walk(NEW, ["你好", "不同意", "120", "同意", "重新開始", "同意", "同意"])
+    # 重新開始後已無用戶記錄：下一則訊息 (即使是「同意」) 先建立用戶並再送一次條款
+    assert [state for _, _, state in trace] == [
+        PENDING, DISAGREED, DISAGREED, DISAGREED, NEW, PENDING, AWAITING_BUTTON_RESPONSE,
+    ]
+    # 未同意時不使用任何功能
+    assert all(handler is None for _, handler, _ in trace[1:4])
+    # 重新開始：刪除用戶並重新發送條款 (下一則訊息會重新建立用戶)
+    transition, _ = ONBOARDING.resolve(DISAGREED, "重新開始")
+    assert transition.action == DELETE_USER
+    assert transition.templates == ("terms",)
+
+
+def test_validate_rejects_unknown_target_state():
+    machine = StateMachine({}, {}, {"a": Transition(text="a", next_state="missing")})
+    with pytest.raises(ValueError, match="未定義的狀態"):
+        machine.validate()
+
+
+def test_validate_rejects_table_without_default():
+    machine = StateMachine({}, {"b": {"x": Transition(text="x")}}, {"a": Transition(text="a")})
+    with pytest.raises(ValueError, match="沒有預設轉移"):
+        machine.validate()
+
+
+def test_validate_rejects_unregistered_template_and_handler():
+    machine = StateMachine({}, {}, {"a": Transition("missing")})
+    with pytest.raises(ValueError, match="未登記的樣板"):
+        machine.validate(template_names={"terms"})
+    machine = StateMachine({}, {}, {"a": Transition(handler="missing")})
+    with pytest.raises(ValueError, match="未登記的處理函式"):
+        machine.validate(handler_names=HANDLER_NAMES)
+
+
+def test_validate_rejects_default_redispatch_cycle():
+    machine = StateMachine({}, {}, {
+        "a": Transition(next_state="b", redispatch=True),
+        "b": Transition(next_state="a", redispatch=True),
+    })
+    with pytest.raises(ValueError, match="循環"):
+        machine.validate()
+    with pytest.raises(RuntimeError):
+        machine.resolve("a", "x")
+
+
+def test_validate_rejects_redispatch_cycle_through_keyed_transitions():
+    # 預設轉移沒有循環，只有特定輸入會在兩個狀態間來回
+    machine = StateMachine({}, {
+        "a": {"x": Transition(next_state="b", redispatch=True)},
+        "b": {"x": Transition(next_state="a", redispatch=True)},
+    }, {
+        "a": Transition(text="a"),
+        "b": Transition(text="b"),
+    })
+    with pytest.raises(ValueError, match="循環"):
+        machine.validate()
+
+
+def test_validate_rejects_redispatch_without_target():
+    machine = StateMachine({}, {}, {"a": Transition(redispatch=True)})
+    with pytest.raises(ValueError, match="redispatch"):
+        machine.validate()
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_events_always_end_in_known_state(seed):
+    rng = random.Random(seed)
+    state = rng.choice(STATES)
+    for _ in range(2000):
+        signal = rng.choice(INPUTS)
+        transition, state = step(state, signal)
+        assert state in ONBOARDING.defaults
+        assert replies(transition)
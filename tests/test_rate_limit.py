@@ -0,0 +1,36 @@
+"""訊息限流：token bucket、相同文字的合併與跨行程一致的摘要"""
+import os
+import subprocess
+import sys
+
+from rate_limit import ALLOW, COALESCED, LIMITED, LIMITED_NOTICE, RateLimiter, text_digest
+
+
+def test_repeated_text_is_coalesced():
+    limiter = RateLimiter(per_minute=60, burst=10, coalesce=10)
+    assert limiter.check("U1", "120", now=0) == ALLOW
+    assert limiter.check("U1", " 120 ", now=1) == COALESCED
+    assert limiter.check("U1", "130", now=2) == ALLOW
+    assert limiter.check("U2", "130", now=2) == ALLOW
+
+
+def test_notice_only_once_when_limited():
+    limiter = RateLimiter(per_minute=60, burst=2, coalesce=0)
+    assert limiter.check("U1", "a", now=0) == ALLOW
+    assert limiter.check("U1", "b", now=0) == ALLOW
+    assert limiter.check("U1", "c", now=0) == LIMITED_NOTICE
+    assert limiter.check("U1", "d", now=0) == LIMITED
+    # 補回一個 token 後恢復
+    assert limiter.check("U1", "e", now=1) == ALLOW
+
+
+def test_digest_does_not_depend_on_hash_seed():
+    code = "from rate_limit import text_digest; print(text_digest('血糖 120').hex())"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    digests = set()
+    for seed in ("1", "2"):
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        output = subprocess.run([sys.executable, "-c", code], cwd=root, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        digests.add(output.strip())
+    assert digests == {text_digest("血糖 120").hex()}
@@ -0,0 +1,204 @@
+"""血糖報表：每日彙總的統計值與 numpy / 純 Python 兩種併入方式一致"""
+import random
+import statistics
+
+import pytest
+
+import reports
+from blood_sugar import MEAL_AFTER_DINNER, MEAL_BEFORE_BREAKFAST, MEAL_UNKNOWN, BloodSugarSeries
+from reports import (
+    DAY_MS, UTC_OFFSET_MS, DailyRollup, Report, ReportEngine, WindowStats, format_report,
+)
+
+TODAY = 19700
+
+
+def at(day, hour=8):
+    """日序號 day 當地 hour 點的毫秒時間戳"""
+    return day * DAY_MS - UTC_OFFSET_MS + hour * 3600 * 1000
+
+
+def make_series(rows):
+    series = BloodSugarSeries()
+    for timestamp, mg_dl, meal in rows:
+        series.append(timestamp, mg_dl, meal)
+    return series
+
+
+def random_rows(seed, days=40, per_day=6):
+    rng = random.Random(seed)
+    rows = []
+    for day in range(TODAY - days + 1, TODAY + 1):
+        for _ in range(rng.randint(0, per_day)):
+            rows.append((at(day, rng.randint(0, 23)), rng.randint(40, 350), rng.randint(0, 10)))
+    return rows
+
+
+def window(rows, first_day, last_day):
+    return [(ts, mg_dl, meal) for ts, mg_dl, meal in rows
+            if first_day <= reports.day_of(ts) <= last_day]
+
+
+def check_window(stats, rows):
+    """WindowStats 與直接由記錄計算的結果相同"""
+    values = [mg_dl for _, mg_dl, _ in rows]
+    assert stats.count == len(values)
+    mean = statistics.fmean(values)
+    sd = statistics.pstdev(values)
+    assert stats.mean == pytest.approx(mean)
+    assert stats.sd == pytest.approx(sd, abs=1e-6)
+    assert stats.cv == pytest.approx(sd / mean * 100, abs=1e-6)
+    assert stats.gmi == pytest.approx(3.31 + 0.02392 * mean)
+    assert (stats.min, stats.max) == (min(values), max(values))
+    low = sum(v < reports.LOW_MG_DL for v in values) / len(values) * 100
+    high = sum(v > reports.HIGH_MG_DL for v in values) / len(values) * 100
+    assert stats.low_pct == pytest.approx(low)
+    assert stats.high_pct == pytest.approx(high)
+    assert stats.in_range_pct == pytest.approx(100 - low - high)
+    meals = {}
+    for _, mg_dl, meal in rows:
+        if meal != MEAL_UNKNOWN:
+            meals.setdefault(meal, []).append(mg_dl)
+    assert stats.meals.keys() == meals.keys()
+    for meal, readings in meals.items():
+        assert stats.meals[meal] == pytest.approx(statistics.fmean(readings))
+
+
+def fold_all(rows, use_numpy, monkeypatch):
+    monkeypatch.setattr(reports, "numpy", reports.numpy if use_numpy else None)
+    rollup = DailyRollup()
+    rollup.fold(make_series(rows))
+    return rollup
+
+
+def test_week_and_month_stats(monkeypatch):
+    rows = random_rows(1)
+    report = Report(fold_all(rows, False, monkeypatch), TODAY)
+    check_window(report.week, window(rows, TODAY - 6, TODAY))
+    check_window(report.month, window(rows, TODAY - 29, TODAY))
+
+
+def test_daily_and_weekly_means(monkeypatch):
+    rows = random_rows(2)
+    report = Report(fold_all(rows, False, monkeypatch), TODAY)
+    expected_daily = []
+    for day in range(TODAY - 6, TODAY + 1):
+        values = [mg_dl for _, mg_dl, _ in window(rows, day, day)]
+        if values:
+            expected_daily.append((day, pytest.approx(statistics.fmean(values))))
+    assert report.daily == expected_daily
+    assert [w for w, _ in report.weekly] == [0, 1, 2, 3]
+    for w, stats in report.weekly:
+        values = window(rows, TODAY - 7 * w - 6, TODAY - 7 * w)
+        if values:
+            check_window(stats, values)
+        else:
+            assert stats.count == 0
+
+
+def day_stats(values, meal=MEAL_UNKNOWN):
+    stats = reports.DayStats()
+    for value in values:
+        stats.add(value, meal)
+    return stats
+
+
+def test_time_in_range_boundaries():
+    # 70 與 180 都在目標範圍內
+    stats = WindowStats([day_stats([69, 70, 180, 181])])
+    assert stats.low_pct == 25
+    assert stats.high_pct == 25
+    assert stats.in_range_pct == 50
+
+
+def test_meal_tagged_means():
+    rows = [
+        (at(TODAY, 7), 100, MEAL_BEFORE_BREAKFAST),
+        (at(TODAY - 1, 7), 110, MEAL_BEFORE_BREAKFAST),
+        (at(TODAY, 20), 200, MEAL_AFTER_DINNER),
+        (at(TODAY, 12), 150, MEAL_UNKNOWN),
+    ]
+    rollup = DailyRollup()
+    rollup.fold(make_series(rows))
+    meals = Report(rollup, TODAY).month.meals
+    # 未標記餐次的記錄不列入餐次平均
+    assert meals == {MEAL_BEFORE_BREAKFAST: 105, MEAL_AFTER_DINNER: 200}
+
+
+def test_empty_window():
+    stats = WindowStats([])
+    assert (stats.count, stats.mean, stats.cv, stats.gmi, stats.meals) == (0, 0.0, 0.0, 0.0, {})
+    assert format_report(Report(DailyRollup(), TODAY)) is None
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_numpy_and_python_folds_agree(seed, monkeypatch):
+    if reports.numpy is None:
+        pytest.skip("需要 numpy")
+    rows = random_rows(seed, days=60, per_day=20)
+    assert len(rows) > 64  # 走 numpy 的批次路徑
+    fast = fold_all(rows, True, monkeypatch)
+    slow = fold_all(rows, False, monkeypatch)
+    assert fast.days.keys() == slow.days.keys()
+    for day in fast.days:
+        a, b = fast.days[day], slow.days[day]
+        for field in reports.DayStats.__slots__:
+            assert getattr(a, field) == getattr(b, field), (day, field)
+            assert type(getattr(a, field)) is type(getattr(b, field))
+
+
+def test_incremental_fold_matches_single_fold(monkeypatch):
+    rows = random_rows(4, per_day=10)
+    series = BloodSugarSeries()
+    rollup = DailyRollup()
+    # 分批追加、每批之後併入 (小批走純 Python、大批可能走 numpy)
+    for size in (3, 100, 1, 70):
+        for row in rows[:size]:
+            series.append(*row)
+        rows = rows[size:]
+        rollup.fold(series)
+    for row in rows:
+        series.append(*row)
+    rollup.fold(series)
+    whole = DailyRollup()
+    whole.fold(series)
+    assert rollup.processed == whole.processed == len(series)
+    for day in whole.days:
+        for field in reports.DayStats.__slots__:
+            assert getattr(rollup.days[day], field) == getattr(whole.days[day], field)
+
+
+def test_engine_rebuilds_when_series_is_replaced():
+    engine = ReportEngine(cache_size=2)
+    first = make_series([(at(TODAY), 100, 0), (at(TODAY), 200, 0)])
+    assert engine.rollup("U1", first).days[TODAY].count == 2
+    # 用戶刪除後重建：新序列較短或第一筆不同，重新彙總
+    second = make_series([(at(TODAY, 9), 300, 0)])
+    rollup = engine.rollup("U1", second)
+    assert rollup.days[TODAY].count == 1
+    assert rollup.days[TODAY].total == 300
+
+
+def test_engine_evicts_least_recently_used():
+    engine = ReportEngine(cache_size=2)
+    series = make_series([(at(TODAY), 100, 0)])
+    a = engine.rollup("A", series)
+    engine.rollup("B", series)
+    engine.rollup("A", series)
+    engine.rollup("C", series)
+    # B 最久未使用，被擠出；A 仍是同一份彙總
+    assert engine.rollup("A", series) is a
+    assert list(engine._rollups) == ["C", "A"]
+
+
+def test_format_report_lists_sections():
+    rows = [(at(TODAY - d, 8), 100 + d, MEAL_BEFORE_BREAKFAST) for d in range(20)]
+    rollup = DailyRollup()
+    rollup.fold(make_series(rows))
+    text = format_report(Report(rollup, TODAY))
+    assert "【近 7 天】共 7 筆" in text
+    assert "【近 30 天】共 20 筆" in text
+    assert "【每週平均】" in text
+    assert "早餐前" in text
+    month = Report(rollup, TODAY).month
+    assert f"估算糖化血色素 (GMI) 約 {month.gmi:.1f}%" in text
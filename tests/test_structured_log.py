@@ -0,0 +1,145 @@
+"""結構化日誌：內容欄位只留字數、user_id 轉成固定代號、依設定的比例取樣"""
+import atexit
+import hashlib
+import hmac
+import io
+import json
+import logging
+import random
+
+import pytest
+
+import structured_log
+from structured_log import EventLogger, JsonFormatter, Redactor, parse_sample_rates
+
+KEY = b"redact-key"
+USER = "U0123456789abcdef"
+TEXT = "我今天早餐前血糖 135，有點頭暈"
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def captured():
+    """不經過背景佇列，直接收集 EventLogger 產生的紀錄"""
+    logger = logging.getLogger("structured_log_test")
+    handler = ListHandler()
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    yield EventLogger(logger), handler.records
+    logger.removeHandler(handler)
+
+
+def format_fields(redactor, **fields):
+    record = logging.LogRecord("linebot.test", logging.INFO, __file__, 1, "reply", None, None)
+    record.fields = fields
+    return json.loads(JsonFormatter(redactor).format(record))
+
+
+def test_content_fields_are_logged_as_length_only():
+    entry = format_fields(Redactor(KEY), text=TEXT, reply="好的", body='{"events":[]}',
+                          question="血糖高怎麼辦？", stage="answer")
+    assert entry["text_chars"] == len(TEXT)
+    assert entry["reply_chars"] == 2
+    assert entry["body_chars"] == len('{"events":[]}')
+    assert entry["question_chars"] == 7
+    for name in structured_log.CONTENT_FIELDS:
+        assert name not in entry
+    # 其他欄位原樣保留
+    assert entry["stage"] == "answer"
+    assert TEXT not in json.dumps(entry, ensure_ascii=False)
+
+
+def test_user_id_becomes_stable_pseudonym():
+    redactor = Redactor(KEY)
+    entry = format_fields(redactor, user_id=USER, text=TEXT)
+    expected = hmac.new(KEY, USER.encode("utf-8"), hashlib.sha256).hexdigest()[:12]
+    assert entry["user"] == expected
+    assert "user_id" not in entry
+    assert USER not in json.dumps(entry)
+    # 同一用戶的紀錄可串起來；不同用戶、不同金鑰得到不同代號
+    assert format_fields(redactor, user_id=USER)["user"] == expected
+    assert format_fields(redactor, user_id=USER + "0")["user"] != expected
+    assert format_fields(Redactor(b"other-key"), user_id=USER)["user"] != expected
+
+
+def test_content_kept_only_when_allowed():
+    assert format_fields(Redactor(KEY, log_content=True), text=TEXT)["text"] == TEXT
+    redactor = Redactor(KEY, content_users=[USER])
+    entry = format_fields(redactor, user_id=USER, text=TEXT)
+    assert entry["text"] == TEXT
+    # 即使保留內容，user_id 仍轉成代號
+    assert "user_id" not in entry
+    assert format_fields(redactor, user_id="Uother", text=TEXT)["text_chars"] == len(TEXT)
+
+
+def test_parse_sample_rates():
+    assert parse_sample_rates("message_received=0.1, reply = 0.5,,bad") == {
+        "message_received": 0.1, "reply": 0.5,
+    }
+    assert parse_sample_rates(None) == {}
+
+
+@pytest.mark.parametrize("rate", [0.0, 0.1, 0.25, 0.5, 1.0])
+def test_sampling_drops_at_configured_rate(captured, monkeypatch, rate):
+    log, records = captured
+    monkeypatch.setattr(structured_log, "_sample_rates", {"hot": rate})
+    monkeypatch.setattr(structured_log, "random", random.Random(rate))
+    total = 20000
+    for _ in range(total):
+        log.info("hot")
+    assert len(records) == pytest.approx(total * rate, abs=total * 0.01)
+    # 取樣的紀錄帶取樣率，統計時可回推總量
+    assert all(record.fields["sample_rate"] == rate for record in records)
+
+
+def test_sampling_skips_warnings_and_unlisted_events(captured, monkeypatch):
+    log, records = captured
+    monkeypatch.setattr(structured_log, "_sample_rates", {"hot": 0.0})
+    for _ in range(100):
+        log.warning("hot")
+        log.info("cold")
+    assert len(records) == 200
+    assert all("sample_rate" not in record.fields for record in records)
+
+
+@pytest.fixture
+def configured():
+    """configure() 寫到 StringIO；結束時還原 linebot.* 日誌原本的設定"""
+    root = logging.getLogger(structured_log.ROOT_LOGGER)
+    saved = (root.handlers[:], root.level, root.propagate, structured_log._handler,
+             dict(structured_log._sample_rates))
+    stream = io.StringIO()
+    yield stream
+    handler = structured_log._handler
+    root.removeHandler(handler)
+    handler.flush()
+    atexit.unregister(handler.flush)
+    handlers, level, propagate, structured_log._handler, rates = saved
+    if structured_log._handler is not None:
+        atexit.register(structured_log._handler.flush)
+    root.handlers[:] = handlers
+    root.setLevel(level)
+    root.propagate = propagate
+    structured_log._sample_rates.clear()
+    structured_log._sample_rates.update(rates)
+
+
+def test_configured_output_is_redacted(configured):
+    handler = structured_log.configure(redact_key=KEY, stream=configured)
+    structured_log.get_logger("test").info("message_received", user_id=USER, text=TEXT)
+    handler.flush()
+    entry = json.loads(configured.getvalue())
+    assert (entry["logger"], entry["event"]) == ("linebot.test", "message_received")
+    assert entry["user"] == Redactor(KEY).pseudonym(USER)
+    assert entry["text_chars"] == len(TEXT)
+    assert USER not in configured.getvalue()
+    assert TEXT not in configured.getvalue()
@@ -0,0 +1,262 @@
+"""語音轉文字：同時進行數上限、大小 / 時間上限與讀取逾時、/voice/transcribe 的驗證"""
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from transcription import RecognitionStream, Recognizer, StubRecognizer, TranscriptionService
+
+CHUNK = b"\x00" * 1024
+
+
+class RecordingStream(RecognitionStream):
+    def __init__(self, fail=False):
+        self.chunks = []
+        self.closed = False
+        self.fail = fail
+
+    def feed(self, chunk):
+        if self.fail:
+            raise RuntimeError("recognizer down")
+        self.chunks.append(chunk)
+        return f"{len(self.chunks)} 塊"
+
+    def finish(self):
+        return f"共 {len(self.chunks)} 塊"
+
+    def close(self):
+        self.closed = True
+
+
+class RecordingRecognizer(Recognizer):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.streams = []
+
+    def start(self, language, content_type):
+        stream = RecordingStream(self.fail)
+        self.streams.append(stream)
+        return stream
+
+
+def stalled(count, release):
+    """送出 count 塊後停住 (用戶端未斷線但不再傳送)，直到 release 被設定"""
+    for _ in range(count):
+        yield CHUNK
+    release.wait()
+
+
+def trickle(interval, release):
+    """每隔 interval 秒送一塊，不會自行結束"""
+    while not release.is_set():
+        yield CHUNK
+        time.sleep(interval)
+
+
+@pytest.fixture
+def release():
+    event = threading.Event()
+    yield event
+    # 讓背景的讀取執行緒結束
+    event.set()
+
+
+def test_complete_upload():
+    recognizer = RecordingRecognizer()
+    service = TranscriptionService(recognizer)
+    events = list(service.transcribe([CHUNK] * 3, "zh-TW", "audio/webm"))
+    assert events == [
+        {"type": "partial", "text": "1 塊"},
+        {"type": "partial", "text": "2 塊"},
+        {"type": "partial", "text": "3 塊"},
+        {"type": "final", "text": "共 3 塊", "bytes": 3 * len(CHUNK), "truncated": False},
+    ]
+    assert recognizer.streams[0].closed
+    stats = service.stats()
+    assert (stats["completed"], stats["truncated"], stats["bytes"]) == (1, 0, 3 * len(CHUNK))
+
+
+def test_stub_recognizer_reports_received_audio():
+    service = TranscriptionService(StubRecognizer())
+    events = list(service.transcribe([CHUNK] * 40, "nan-TW", "audio/webm"))
+    assert [event["type"] for event in events] == ["partial", "final"]
+    assert "台語" in events[-1]["text"]
+
+
+def test_concurrency_limit():
+    service = TranscriptionService(RecordingRecognizer(), max_streams=2)
+    assert service.acquire()
+    assert service.acquire()
+    assert not service.acquire()
+    assert service.stats()["active"] == 2
+    assert service.stats()["rejected"] == 1
+    service.release()
+    assert service.acquire()
+    service.release()
+    service.release()
+    assert service.stats()["active"] == 0
+
+
+def test_concurrent_requests_beyond_limit_are_rejected():
+    service = TranscriptionService(RecordingRecognizer(), max_streams=3)
+    barrier = threading.Barrier(8)
+    results = []
+
+    def request():
+        barrier.wait()
+        results.append(service.acquire())
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False] * 5 + [True] * 3
+    assert service.stats()["rejected"] == 5
+
+
+def test_max_bytes_cutoff():
+    recognizer = RecordingRecognizer()
+    service = TranscriptionService(recognizer, max_bytes=int(2.5 * len(CHUNK)))
+    final = list(service.transcribe([CHUNK] * 10, "zh-TW", None))[-1]
+    assert final["truncated"]
+    # 超過上限的那一塊不交給辨識器
+    assert len(recognizer.streams[0].chunks) == 2
+    assert final["text"] == "共 2 塊"
+
+
+def test_max_seconds_cutoff_while_upload_is_stalled(release):
+    # 停頓期間沒有新的區塊，仍在 max_seconds 到期時結束
+    recognizer = RecordingRecognizer()
+    service = TranscriptionService(recognizer, max_seconds=0.3, read_timeout=30)
+    started = time.monotonic()
+    final = list(service.transcribe(stalled(2, release), "zh-TW", None))[-1]
+    assert time.monotonic() - started < 5
+    assert final == {"type": "final", "text": "共 2 塊", "bytes": 2 * len(CHUNK), "truncated": True}
+    assert recognizer.streams[0].closed
+    assert service.stats()["truncated"] == 1
+
+
+def test_max_seconds_cutoff_while_upload_keeps_arriving(release):
+    service = TranscriptionService(RecordingRecognizer(), max_seconds=0.3, read_timeout=30)
+    started = time.monotonic()
+    final = list(service.transcribe(trickle(0.01, release), "zh-TW", None))[-1]
+    assert time.monotonic() - started < 5
+    assert final["truncated"]
+    assert final["bytes"] > 0
+
+
+def test_read_timeout(release):
+    service = TranscriptionService(RecordingRecognizer(), max_seconds=60, read_timeout=0.2)
+    started = time.monotonic()
+    final = list(service.transcribe(stalled(1, release), "zh-TW", None))[-1]
+    assert time.monotonic() - started < 5
+    assert final["truncated"]
+    assert final["text"] == "共 1 塊"
+
+
+def test_recognizer_error():
+    recognizer = RecordingRecognizer(fail=True)
+    service = TranscriptionService(recognizer)
+    events = list(service.transcribe([CHUNK], "zh-TW", None))
+    assert events[-1]["type"] == "error"
+    assert recognizer.streams[0].closed
+    assert service.stats()["failed"] == 1
+
+
+def test_upload_error():
+    def broken():
+        yield CHUNK
+        raise OSError("client disconnected")
+
+    recognizer = RecordingRecognizer()
+    service = TranscriptionService(recognizer)
+    events = list(service.transcribe(broken(), "zh-TW", None))
+    assert events[-1]["type"] == "error"
+    assert recognizer.streams[0].closed
+
+
+def test_stream_closed_when_response_is_abandoned(release):
+    # 用戶端中途斷線：回應的產生器被關閉
+    recognizer = RecordingRecognizer()
+    service = TranscriptionService(recognizer)
+    events = service.transcribe(trickle(0.001, release), "zh-TW", None)
+    assert next(events)["type"] == "partial"
+    events.close()
+    assert recognizer.streams[0].closed
+
+
+class FakeVerifier:
+    def __init__(self, valid):
+        self.valid = valid
+        self.tokens = []
+
+    def verify(self, line_bot_api, token):
+        self.tokens.append(token)
+        return token == self.valid
+
+
+@pytest.fixture
+def client(tmp_path_factory, monkeypatch):
+    pytest.importorskip("flask")
+    pytest.importorskip("linebot")
+    pytest.importorskip("requests")
+    # 匯入 app 時建立的數據檔案放在暫存目錄
+    monkeypatch.setenv("DATA_DIR", str(tmp_path_factory.mktemp("app_data")))
+    monkeypatch.setenv("CHART_CACHE_DIR", str(tmp_path_factory.mktemp("charts")))
+    import app
+    monkeypatch.setattr(app, "transcription", TranscriptionService(RecordingRecognizer(), max_streams=1))
+    monkeypatch.setattr(app, "get_line_clients", lambda: SimpleNamespace(line_bot_api=None))
+    return app.app.test_client()
+
+
+def upload(client, token=None, lang="zh-TW"):
+    headers = {"Content-Type": "audio/webm"}
+    if token is not None:
+        headers["Authorization"] = f"Bearer {token}"
+    return client.post(f"/voice/transcribe?lang={lang}", data=CHUNK * 2, headers=headers)
+
+
+def test_endpoint_disabled_without_verifier(client, monkeypatch):
+    import app
+    monkeypatch.setattr(app, "liff_verifier", None)
+    # 未設定 LIFF_CHANNEL_ID 時無從驗證，不接受任何上傳
+    assert upload(client).status_code == 404
+    assert upload(client, "any-token").status_code == 404
+    assert app.transcription.stats()["active"] == 0
+
+
+@pytest.mark.parametrize("token", [None, "", "wrong-token"])
+def test_endpoint_rejects_bad_token(client, monkeypatch, token):
+    import app
+    monkeypatch.setattr(app, "liff_verifier", FakeVerifier("liff-token"))
+    assert upload(client, token).status_code == 401
+    assert app.transcription.stats()["active"] == 0
+
+
+def test_endpoint_streams_events(client, monkeypatch):
+    import app
+    verifier = FakeVerifier("liff-token")
+    monkeypatch.setattr(app, "liff_verifier", verifier)
+    response = upload(client, "liff-token")
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    events = [json.loads(line) for line in response.data.splitlines()]
+    assert events[-1] == {"type": "final", "text": "共 1 塊", "bytes": 2 * len(CHUNK), "truncated": False}
+    assert verifier.tokens == ["liff-token"]
+    # 回應結束後釋放名額
+    response.close()
+    assert app.transcription.stats()["active"] == 0
+    assert upload(client, "liff-token", lang="en").status_code == 400
+
+
+def test_endpoint_busy(client, monkeypatch):
+    import app
+    monkeypatch.setattr(app, "liff_verifier", FakeVerifier("liff-token"))
+    assert app.transcription.acquire()
+    response = upload(client, "liff-token")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    app.transcription.release()
@@ -0,0 +1,44 @@
+"""兩種用戶存儲後端的行為一致"""
+import pytest
+
+from user_store import JsonUserStore, SqliteUserStore
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "json":
+        store = JsonUserStore(str(tmp_path / "user_data.json"))
+    else:
+        store = SqliteUserStore(str(tmp_path / "user_data.db"))
+    yield store
+    store.close()
+
+
+def readings(store, user_id):
+    return [mg_dl for batch in store.iter_blood_sugar(user_id) for _, mg_dl, _ in batch]
+
+
+def test_create_resets_blood_sugar(store):
+    store.create("U1", {"status": "pending"})
+    store.update_status("U1", "agreed")
+    store.append_blood_sugar("U1", 1700000000000, 120)
+    assert len(store.get_blood_sugar("U1")) == 1
+
+    # 重新加好友：與新用戶相同，不保留先前的記錄
+    store.create("U1", {"status": "pending"})
+    assert store.get("U1")["status"] == "pending"
+    assert readings(store, "U1") == []
+    assert len(store.get_blood_sugar("U1")) == 0
+
+
+def test_put_keeps_blood_sugar(store):
+    store.create("U1", {"status": "agreed"})
+    store.append_blood_sugar("U1", 1700000000000, 120)
+    store.put("U1", {"status": "agreed", "note": 1})
+    assert readings(store, "U1") == [120]
+
+
+def test_append_for_unknown_user_is_ignored(store):
+    store.append_blood_sugar("Unknown", 1700000000000, 120)
+    assert store.append_blood_sugar_many("Unknown", [(1700000000000, 130, 0)]) == 0
+    assert readings(store, "Unknown") == []
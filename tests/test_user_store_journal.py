@@ -0,0 +1,128 @@
+"""JSON 後端的日誌引擎：當機後的恢復、壓縮與輪替"""
+import glob
+import json
+import os
+
+import pytest
+
+import lockfile
+from user_store import JournaledUserStore
+
+pytestmark = pytest.mark.skipif(lockfile.fcntl is None, reason="需要 fcntl (POSIX 記錄鎖)")
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    return str(tmp_path / "user_data.json")
+
+
+def open_store(snapshot, **kwargs):
+    store = JournaledUserStore(snapshot, **kwargs)
+    store.load()
+    return store
+
+
+def reopen(store):
+    store.close()
+    return open_store(store.snapshot_path)
+
+
+def test_torn_trailing_line_is_dropped(snapshot):
+    store = open_store(snapshot)
+    store.record("U1", {"status": "agreed"})
+    store.record("U2", {"status": "pending"})
+    store.close()
+    # 寫入途中當機：最後一行只寫了一半
+    with open(store.journal_path, "ab") as f:
+        f.write(b'{"u": "U3", "d": {"sta')
+
+    store = open_store(snapshot)
+    assert store.sync() == {"U1": {"status": "agreed"}, "U2": {"status": "pending"}}
+    # 殘行已截掉，新記錄不會接在殘行後面
+    store.record("U4", {"status": "agreed"})
+    store = reopen(store)
+    assert sorted(store.sync()) == ["U1", "U2", "U4"]
+    store.close()
+
+
+def test_compaction_rotates_journal_into_snapshot(snapshot):
+    store = open_store(snapshot)
+    for i in range(10):
+        store.record(f"U{i}", {"status": "agreed", "i": i})
+    store.record("U3", None)
+    assert store.compact()
+
+    with open(snapshot, encoding="utf-8") as f:
+        data = json.load(f)
+    assert sorted(data) == sorted(f"U{i}" for i in range(10) if i != 3)
+    assert not os.path.exists(store.compacting_path)
+    # 新日誌以下一個世代的檔頭開始
+    with open(store.journal_path, "rb") as f:
+        assert f.read() == b'{"gen": 1}\n'
+
+    store.record("U10", {"status": "agreed", "i": 10})
+    store = reopen(store)
+    assert store.sync()["U10"] == {"status": "agreed", "i": 10}
+    assert "U3" not in store.sync()
+    store.close()
+
+
+def test_threshold_triggers_background_compaction(snapshot):
+    store = open_store(snapshot, compact_threshold=5)
+    for i in range(5):
+        store.record(f"U{i}", {"i": i})
+    store.close()
+    # close() 會等已要求的壓縮結束 (或取消)，不會留下暫存檔
+    assert glob.glob(snapshot + ".tmp.*") == []
+    store = open_store(snapshot)
+    assert len(store.sync()) == 5
+    store.close()
+
+
+def test_leftover_compacting_file_is_replayed_and_merged(snapshot):
+    store = open_store(snapshot)
+    store.record("U1", {"status": "agreed"})
+    store.record("U2", {"status": "agreed"})
+    store.close()
+    # 壓縮輪替完日誌、寫快照前當機：記錄只在 .compacting 中
+    os.replace(store.journal_path, store.compacting_path)
+    with open(store.journal_path, "wb") as f:
+        f.write(b'{"gen": 1}\n{"u": "U2", "d": {"status": "disagreed"}}\n')
+
+    store = open_store(snapshot)
+    assert store.sync() == {"U1": {"status": "agreed"}, "U2": {"status": "disagreed"}}
+    assert store.compact()
+    # 載入時也會在背景再壓縮一次；close() 等它結束
+    store.close()
+    assert not os.path.exists(store.compacting_path)
+    store = open_store(snapshot)
+    assert store.sync() == {"U1": {"status": "agreed"}, "U2": {"status": "disagreed"}}
+    store.close()
+
+
+def test_corrupt_snapshot_is_moved_aside(snapshot):
+    with open(snapshot, "w", encoding="utf-8") as f:
+        f.write('{"U1": {"status": "agr')
+    store = open_store(snapshot)
+    store.record("U2", {"status": "agreed"})
+    assert store.sync() == {"U2": {"status": "agreed"}}
+    store.close()
+
+    broken = glob.glob(snapshot + ".corrupt-*")
+    assert len(broken) == 1
+    with open(broken[0], encoding="utf-8") as f:
+        assert f.read() == '{"U1": {"status": "agr'
+    assert not os.path.exists(snapshot)
+
+
+def test_close_cancels_pending_compaction(snapshot):
+    # 已要求但尚未執行的壓縮不能在關閉後重新開啟日誌；同一行程重新開啟也不受影響
+    for i in range(50):
+        store = open_store(snapshot, compact_threshold=1)
+        store.record(f"U{i}", {"i": i})
+        store.close()
+        assert store._journal_fd is None
+        assert store._compactor is None or not store._compactor.is_alive()
+    store = open_store(snapshot)
+    assert len(store.sync()) == 50
+    store.close()
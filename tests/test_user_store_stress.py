@@ -0,0 +1,107 @@
+"""多個 worker 行程同時寫入用戶存儲 (JSON 日誌與 SQLite)，不應遺失任何更新或失敗"""
+import multiprocessing
+import os
+
+import pytest
+
+import lockfile
+from user_store import JsonUserStore, SqliteUserStore
+
+pytestmark = pytest.mark.skipif(lockfile.fcntl is None, reason="需要 fcntl (POSIX 記錄鎖)")
+
+PROCESSES = 4
+ROUNDS = 200
+SHARED = "Ushared"
+
+
+def worker(directory, index, rounds):
+    # 壓縮門檻設低，讓日誌輪替與寫入交錯發生
+    store = JsonUserStore(os.path.join(directory, "user_data.json"), compact_threshold=50)
+    try:
+        for i in range(rounds):
+            # 共用用戶：讀取 → 加一 → 寫回，必須在用戶鎖內完成
+            with store.lock(SHARED):
+                record = store.get(SHARED) or {"status": "agreed", "count": 0}
+                store.put(SHARED, dict(record, count=record["count"] + 1))
+            # 各行程自己的用戶
+            with store.lock(f"U{index}-{i}"):
+                store.put(f"U{index}-{i}", {"status": "agreed", "worker": index, "i": i})
+                store.append_blood_sugar(f"U{index}-{i}", 1700000000000 + i, 100 + i % 50)
+    finally:
+        store.close()
+
+
+def run_workers(directory, rounds=ROUNDS):
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=worker, args=(str(directory), index, rounds))
+                 for index in range(PROCESSES)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=120)
+        assert process.exitcode == 0
+
+
+def test_concurrent_workers_lose_no_updates(tmp_path):
+    run_workers(tmp_path)
+
+    # 重新開啟：由快照 + 日誌重播的結果也必須完整
+    store = JsonUserStore(str(tmp_path / "user_data.json"))
+    try:
+        assert store.get(SHARED)["count"] == PROCESSES * ROUNDS
+        for index in range(PROCESSES):
+            for i in range(ROUNDS):
+                record = store.get(f"U{index}-{i}")
+                assert record == {"status": "agreed", "worker": index, "i": i}
+                rows = [row for batch in store.iter_blood_sugar(f"U{index}-{i}") for row in batch]
+                assert [mg_dl for _, mg_dl, _ in rows] == [100 + i % 50]
+    finally:
+        store.close()
+
+
+def test_live_store_sees_other_workers(tmp_path):
+    store = JsonUserStore(str(tmp_path / "user_data.json"))
+    try:
+        run_workers(tmp_path, rounds=50)
+        # 已開啟的 store 追讀其他行程追加的日誌
+        assert store.get(SHARED)["count"] == PROCESSES * 50
+        assert store.get(f"U{PROCESSES - 1}-49")["i"] == 49
+    finally:
+        store.close()
+
+
+def sqlite_worker(path, index, rounds):
+    store = SqliteUserStore(path)
+    try:
+        for i in range(rounds):
+            # 先查詢用戶再寫入的交易：其他行程在中間提交時也不能失敗
+            rows = [(1700000000000 + i, 100 + index, 0), (1700000000001 + i, 200 + index, 1)]
+            assert store.append_blood_sugar_many(SHARED, rows) == 2
+            store.create(f"U{index}-{i}", {"status": "agreed"})
+            store.append_blood_sugar(f"U{index}-{i}", 1700000000000, 100)
+            if i % 2:
+                store.delete(f"U{index}-{i}")
+    finally:
+        store.close()
+
+
+def test_concurrent_sqlite_appends(tmp_path):
+    path = str(tmp_path / "user_data.db")
+    store = SqliteUserStore(path)
+    store.create(SHARED, {"status": "agreed"})
+    try:
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=sqlite_worker, args=(path, index, ROUNDS))
+                     for index in range(PROCESSES)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(timeout=120)
+            assert process.exitcode == 0
+
+        assert len(store.get_blood_sugar(SHARED)) == PROCESSES * ROUNDS * 2
+        for index in range(PROCESSES):
+            alive = [i for i in range(ROUNDS) if store.get(f"U{index}-{i}") is not None]
+            assert alive == list(range(0, ROUNDS, 2))
+    finally:
+        store.close()
@@ -0,0 +1,95 @@
+"""Webhook 簽章驗證與事件解析"""
+import base64
+import hashlib
+import hmac
+import json
+
+import pytest
+
+from webhook import parse_events, verify_signature
+
+SECRET = b"channel-secret"
+BODY = json.dumps({
+    "destination": "Ubot",
+    "events": [{
+        "type": "message",
+        "replyToken": "token",
+        "timestamp": 1700000000000,
+        "webhookEventId": "01H",
+        "deliveryContext": {"isRedelivery": True},
+        "source": {"type": "user", "userId": "U1"},
+        "message": {"type": "text", "id": "m1", "text": "120"},
+    }],
+}).encode()
+
+
+def sign(body, secret=SECRET):
+    return base64.b64encode(hmac.new(secret, body, hashlib.sha256).digest()).decode()
+
+
+def test_valid_signature():
+    assert verify_signature(SECRET, BODY, sign(BODY))
+
+
+def test_tampered_body_is_rejected():
+    signature = sign(BODY)
+    assert not verify_signature(SECRET, BODY.replace(b"120", b"999"), signature)
+    assert not verify_signature(SECRET, BODY + b" ", signature)
+
+
+def test_wrong_secret_is_rejected():
+    assert not verify_signature(SECRET, BODY, sign(BODY, b"other-secret"))
+
+
+@pytest.mark.parametrize("signature", [
+    None,
+    "",
+    "簽章",
+    "not base64!",
+    "abc",
+    # 合法的 base64，但長度不是 SHA-256
+    base64.b64encode(b"short").decode(),
+])
+def test_malformed_signature_is_rejected(signature):
+    assert not verify_signature(SECRET, BODY, signature)
+
+
+def test_parse_events():
+    [event] = parse_events(BODY)
+    assert event.type == "message"
+    assert event.user_id == "U1"
+    assert event.source_key == "U1"
+    assert event.reply_token == "token"
+    assert event.webhook_event_id == "01H"
+    assert event.is_redelivery
+    assert (event.message_type, event.message_id, event.text) == ("text", "m1", "120")
+
+
+def test_group_source_key_without_user_id():
+    body = json.dumps({"events": [{"type": "join", "source": {"type": "group", "groupId": "G1"}}]})
+    [event] = parse_events(body.encode())
+    assert event.user_id is None
+    assert event.source_key == "G1"
+    assert not event.is_redelivery
+
+
+@pytest.mark.parametrize("payload", [
+    [], [{"events": []}], "events", 1, None,
+    {}, {"destination": "Ubot"}, {"events": None}, {"events": {"type": "message"}},
+])
+def test_payload_without_event_list_gives_no_events(payload):
+    assert parse_events(json.dumps(payload).encode()) == []
+
+
+def test_non_object_entries_are_skipped():
+    body = json.dumps({"events": [1, "x", None, {"type": "follow", "source": "U1", "message": []}]})
+    [event] = parse_events(body.encode())
+    assert event.type == "follow"
+    assert event.user_id is None
+    assert event.message_type is None
+
+
+@pytest.mark.parametrize("body", [b"", b"{", b"\xff\xfe", b"events"])
+def test_malformed_json_raises_value_error(body):
+    with pytest.raises(ValueError):
+        parse_events(body)
@@ -0,0 +1,291 @@
+"""語音轉文字 (LIFF 錄音頁面)
+
+錄音頁面以分塊上傳 (Transfer-Encoding: chunked) 把錄音送到
+POST /voice/transcribe，伺服器邊收邊交給辨識器，並以 NDJSON 逐行回傳
+部分結果，最後一行為完整的文字；頁面再以 liff.sendMessages() 送進聊天室。
+音訊不寫入磁碟，也不在記憶體中組成完整的檔案。
+
+- Recognizer：辨識器介面，start(language, content_type) → RecognitionStream
+- StubRecognizer：本機測試用，不需額外套件，只回報收到的音訊量
+- TranscriptionService：同時進行的辨識數上限、單段錄音的大小與時間上限、
+  上傳停頓的讀取逾時
+- LiffTokenVerifier：確認 LIFF access token 屬於本服務的 LINE Login channel
+
+SPEECH_RECOGNIZER 設定辨識器："stub" 或 "模組:函式" (回傳 Recognizer 的工廠函式)。
+"""
+import hashlib
+import importlib
+import queue
+import threading
+import time
+
+from answer_cache import AnswerCache
+from structured_log import get_logger
+
+# 支援的語言：國語、台語
+LANGUAGES = {
+    "zh-TW": "國語",
+    "nan-TW": "台語",
+}
+DEFAULT_LANGUAGE = "zh-TW"
+
+CHUNK_SIZE = 16 * 1024
+DEFAULT_MAX_STREAMS = 4
+# 約 5 分鐘的 16 kHz 16-bit 單聲道 PCM
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_MAX_SECONDS = 300
+# 上傳停頓超過此秒數 (用戶端未斷線但不再傳送) 即以已收到的部分結束
+DEFAULT_READ_TIMEOUT = 15
+
+log = get_logger("voice")
+
+
+class RecognitionStream:
+    """一段進行中的辨識
+
+    feed() 收到一塊音訊後回傳目前為止的部分結果 (沒有新結果時回傳 None)；
+    finish() 在音訊結束後回傳最終結果；close() 一定會被呼叫 (含中途中斷)。
+    """
+
+    def feed(self, chunk):
+        raise NotImplementedError
+
+    def finish(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class Recognizer:
+    """辨識器介面；start() 可能在多個執行緒同時呼叫"""
+
+    def start(self, language, content_type):
+        raise NotImplementedError
+
+
+class _StubStream(RecognitionStream):
+    PARTIAL_EVERY = 32 * 1024
+
+    def __init__(self, language):
+        self.language = language
+        self.received = 0
+        self._reported = 0
+
+    def feed(self, chunk):
+        self.received += len(chunk)
+        if self.received - self._reported < self.PARTIAL_EVERY:
+            return None
+        self._reported = self.received
+        return f"[測試] 已收到 {self.received // 1024} KB 語音…"
+
+    def finish(self):
+        return (f"[測試] 語音辨識服務尚未設定 "
+                f"({LANGUAGES[self.language]}，共收到 {self.received // 1024} KB 語音)")
+
+
+class StubRecognizer(Recognizer):
+    """本機測試用的辨識器：不辨識內容，只回報收到的音訊量"""
+
+    def start(self, language, content_type):
+        return _StubStream(language)
+
+
+def load_recognizer(spec):
+    """SPEECH_RECOGNIZER 設定 → Recognizer；未設定時回傳 None"""
+    if not spec:
+        return None
+    if spec == "stub":
+        return StubRecognizer()
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name or "create_recognizer")()
+
+
+_END = object()
+
+
+class _ChunkReader:
+    """在背景執行緒讀取上傳的區塊，讀取端可以限定等待時間
+
+    在請求執行緒直接 read() 時，用戶端停止傳送 (但不斷線) 就會一直卡住，
+    max_seconds 也無從生效。停止讀取後，背景執行緒可能仍卡在 read()，
+    直到回應結束、伺服器關閉連線為止；佇列有界，不會預先讀入整段錄音。
+    """
+
+    def __init__(self, chunks, depth=4):
+        self._queue = queue.Queue(depth)
+        self._stopped = threading.Event()
+        threading.Thread(target=self._run, args=(chunks,), name="voice-read", daemon=True).start()
+
+    def _run(self, chunks):
+        try:
+            for chunk in chunks:
+                if not self._put(chunk):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(_END)
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, timeout):
+        """下一個區塊；上傳結束時回傳 None，逾時拋出 queue.Empty"""
+        item = self._queue.get(timeout=timeout)
+        if item is _END:
+            return None
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def stop(self):
+        self._stopped.set()
+
+
+class TranscriptionService:
+    """限制同時進行的辨識數，並把上傳的音訊區塊轉成辨識事件
+
+    每段辨識佔用一個 worker 執行緒直到上傳結束，因此以 max_streams 限制
+    同時進行的數量 (超過時 acquire() 回傳 False，由呼叫端回應 503)；
+    單段錄音超過 max_bytes 或 max_seconds，或上傳停頓超過 read_timeout 時
+    停止讀取，以已收到的部分結束。
+    """
+
+    def __init__(self, recognizer, max_streams=DEFAULT_MAX_STREAMS,
+                 max_bytes=DEFAULT_MAX_BYTES, max_seconds=DEFAULT_MAX_SECONDS,
+                 read_timeout=DEFAULT_READ_TIMEOUT):
+        self.recognizer = recognizer
+        self.max_streams = max_streams
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.read_timeout = read_timeout
+        self._slots = threading.BoundedSemaphore(max_streams)
+        self._stats_lock = threading.Lock()
+        self._active = 0
+        self._completed = 0
+        self._rejected = 0
+        self._truncated = 0
+        self._failed = 0
+        self._bytes = 0
+
+    def acquire(self):
+        """取得一個辨識名額；已滿時回傳 False"""
+        if not self._slots.acquire(blocking=False):
+            with self._stats_lock:
+                self._rejected += 1
+            return False
+        with self._stats_lock:
+            self._active += 1
+        return True
+
+    def release(self):
+        with self._stats_lock:
+            self._active -= 1
+        self._slots.release()
+
+    def transcribe(self, chunks, language, content_type):
+        """音訊區塊 → 辨識事件 (dict)
+
+        依序產出 {"type": "partial", "text": ...}，最後是
+        {"type": "final", "text": ..., "bytes": ..., "truncated": ...}；
+        辨識器出錯時最後一個事件為 {"type": "error"}。
+        """
+        stream = self.recognizer.start(language, content_type)
+        reader = _ChunkReader(chunks)
+        received = 0
+        truncated = False
+        deadline = time.monotonic() + self.max_seconds
+        last = None
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    truncated = True
+                    break
+                try:
+                    chunk = reader.get(min(self.read_timeout, remaining))
+                except queue.Empty:
+                    # 上傳停頓超過 read_timeout，或等待中到了 max_seconds
+                    truncated = True
+                    break
+                if chunk is None:
+                    break
+                received += len(chunk)
+                if received > self.max_bytes:
+                    truncated = True
+                    break
+                partial = stream.feed(chunk)
+                if partial and partial != last:
+                    last = partial
+                    yield {"type": "partial", "text": partial}
+            text = stream.finish()
+        except Exception:
+            log.exception("transcription_failed", language=language, bytes=received)
+            with self._stats_lock:
+                self._failed += 1
+            yield {"type": "error", "message": "語音辨識失敗，請稍後再試"}
+            return
+        finally:
+            reader.stop()
+            stream.close()
+            with self._stats_lock:
+                self._bytes += received
+        with self._stats_lock:
+            self._completed += 1
+            self._truncated += truncated
+        yield {"type": "final", "text": text, "bytes": received, "truncated": truncated}
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "max_streams": self.max_streams,
+                "active": self._active,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "truncated": self._truncated,
+                "failed": self._failed,
+                "bytes": self._bytes,
+            }
+
+
+class LiffTokenVerifier:
+    """以 LINE 的 verify API 確認 LIFF access token 有效且屬於 channel_id
+
+    驗證通過的 token (以雜湊為鍵) 快取 ttl 秒，同一個錄音頁面重複上傳時
+    不必每次都呼叫 LINE。
+    """
+
+    VERIFY_PATH = '/oauth2/v2.1/verify'
+
+    def __init__(self, channel_id, ttl=300, timeout=(3.05, 5)):
+        self.channel_id = str(channel_id)
+        self.ttl = ttl
+        self.timeout = timeout
+        self._verified = AnswerCache(max_entries=10000, max_bytes=4 * 1024 * 1024, ttl=ttl)
+
+    def verify(self, line_bot_api, token):
+        if not token:
+            return False
+        key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        if self._verified.get(key):
+            return True
+        response = line_bot_api.http_client.get(
+            line_bot_api.endpoint + self.VERIFY_PATH,
+            params={"access_token": token}, timeout=self.timeout
+        )
+        if response.status_code != 200:
+            return False
+        body = response.json
+        if str(body.get("client_id")) != self.channel_id:
+            return False
+        # 剩餘效期比快取時間短的 token 不快取
+        if body.get("expires_in", 0) >= self.ttl:
+            self._verified.put(key, True)
+        return body.get("expires_in", 0) > 0
@@ -0,0 +1,724 @@
+"""用戶數據儲存
+
+UserStore 定義 webhook 使用的存取介面，提供兩種後端：
+- JsonUserStore：相容舊版 user_data.json 的快照 + 追加式日誌
+- SqliteUserStore：SQLite (WAL 模式)，記憶體用量不隨用戶數成長
+
+以下為 JSON 後端的日誌引擎說明：
+
+每次狀態變更只把「單一用戶的最新記錄」追加到日誌檔，寫入成本與
+該用戶記錄大小成正比，而不是重寫整份 user_data.json。
+日誌累積到一定筆數後，由背景執行緒壓縮成新的快照。
+啟動時以「快照 → 壓縮中的日誌 → 日誌」的順序重播恢復。
+
+快照格式與舊版 user_data.json 完全相同（userId → 記錄），
+因此既有的資料檔可直接作為第一份快照使用。
+
+併發模型 (gunicorn 多 worker + 多執行緒)：
+- 對同一用戶的「讀取 → 轉移 → 寫入」以 UserStore.lock(user_id) 包住。
+  行程內為分段 threading.Lock，跨行程為鎖檔上同一分段位元組的 lockf 鎖。
+- JSON 後端的每個 worker 各自持有記憶體副本，每次存取前先讀取其他
+  worker 追加到日誌的新記錄 (以 pread 追蹤自己的讀取位置)。
+- 日誌輪替 (壓縮) 需取得鎖檔第 0 位元組的獨佔鎖，寫入與追讀則取共享鎖；
+  同一時間只會有一個行程進行壓縮 (第 1 位元組)。
+"""
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from blood_sugar import MEAL_UNKNOWN, BloodSugarLog, BloodSugarSeries
+from lockfile import LockFile
+from structured_log import get_logger
+
+# 日誌累積超過此筆數即觸發背景壓縮
+DEFAULT_COMPACT_THRESHOLD = 5000
+
+# 用戶鎖的分段數量
+DEFAULT_LOCK_STRIPES = 1024
+
+# 鎖檔中的位元組配置
+ROTATE_LOCK_BYTE = 0
+COMPACT_LOCK_BYTE = 1
+USER_LOCK_BASE = 2
+
+log = get_logger("user_store")
+
+
+class UserLocks:
+    """每位用戶的互斥鎖
+
+    依 userId 雜湊到固定數量的分段，記憶體用量不隨用戶數成長。
+    行程內以 threading.Lock 互斥，跨行程則鎖住鎖檔上對應分段的位元組；
+    不同用戶落在不同分段時可完全並行。
+    """
+
+    def __init__(self, lock_file=None, stripes=DEFAULT_LOCK_STRIPES):
+        self._lock_file = lock_file
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    @contextmanager
+    def hold(self, user_id):
+        index = zlib.crc32(user_id.encode('utf-8')) % len(self._locks)
+        with self._locks[index]:
+            if self._lock_file is None:
+                yield
+                return
+            with self._lock_file.hold(USER_LOCK_BASE + index):
+                yield
+
+
+class JournaledUserStore:
+    """快照 + 追加式日誌的用戶存儲"""
+
+    def __init__(self, snapshot_path, journal_path=None,
+                 compact_threshold=DEFAULT_COMPACT_THRESHOLD, fsync=False,
+                 lock_file=None):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path or snapshot_path + ".journal"
+        self.compacting_path = self.journal_path + ".compacting"
+        self.compact_threshold = compact_threshold
+        self.fsync = fsync
+        self.lock_file = lock_file or LockFile(snapshot_path + ".lock")
+
+        self._lock = threading.RLock()
+        self._data = {}       # userId → 記錄 (供程式直接使用的 dict)
+        self._encoded = {}    # userId → 最後寫入的 JSON 字串 (壓縮時使用)
+        self._journal_fd = None   # 追加寫入用
+        self._read_fd = None      # 追讀其他行程寫入用 (pread，不共用檔案位置)
+        self._read_offset = 0
+        self._gen = 0             # 目前日誌的世代編號
+        self._pid = os.getpid()
+        self._journal_records = 0
+
+        self._compact_event = threading.Event()
+        # 鎖檔的 lockf 鎖屬於整個行程，行程內的壓縮另以 threading.Lock 互斥
+        self._compact_lock = threading.Lock()
+        self._compact_done = threading.Event()
+        self._compact_done.set()
+        self._compactor = None
+        self._stopped = False     # close() 之後不再壓縮 (在 self._lock 內讀寫)
+
+    # ---------- 載入與恢復 ----------
+
+    def load(self):
+        """載入快照並重播日誌，回傳 userId → 記錄 的 dict"""
+        with self._lock, self.lock_file.hold(ROTATE_LOCK_BYTE):
+            # 持有獨佔鎖，沒有其他行程正在寫入，可以安全地截掉殘行
+            self._truncate_partial_tail(self.journal_path)
+            with self.lock_file.hold(COMPACT_LOCK_BYTE, blocking=False) as idle:
+                if idle:
+                    # 沒有行程在壓縮，清掉中斷的壓縮留下的暫存快照
+                    for path in glob.glob(glob.escape(self.snapshot_path) + ".tmp.*"):
+                        os.remove(path)
+            replayed = self._reload()
+            # 上次壓縮中途中斷，重新壓縮一次
+            if replayed:
+                self._compact_event.set()
+            self._start_compactor()
+            return self._data
+
+    def _reload(self):
+        """從快照、壓縮中的日誌與目前日誌重建記憶體狀態
+
+        呼叫端須持有鎖檔第 0 位元組 (共享或獨佔)。壓縮中的日誌只會在
+        獨佔鎖下刪除，因此讀到的快照無論新舊，重播後的結果都一致。
+        回傳壓縮中日誌的筆數。
+        """
+        self._data = {}
+        self._encoded = {}
+        self._load_snapshot()
+        replayed = self._replay(self.compacting_path)
+        self._open_journal()
+        self._journal_records = self._read_tail()
+        return replayed
+
+    def _load_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            # 快照以原子替換寫入，理論上不會損毀；保留原檔以便人工檢查
+            broken = f"{self.snapshot_path}.corrupt-{int(time.time())}"
+            log.error("snapshot_corrupt", moved_to=broken, error=repr(e))
+            try:
+                os.replace(self.snapshot_path, broken)
+            except OSError:
+                pass
+            return
+        for user_id, record in snapshot.items():
+            self._data[user_id] = record
+            self._encoded[user_id] = json.dumps(record, ensure_ascii=False)
+
+    def _replay(self, path):
+        """重播日誌檔，回傳成功套用的筆數"""
+        if not os.path.exists(path):
+            return 0
+        count = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                self._apply_line(line)
+                count += 1
+        return count
+
+    def _apply_line(self, line):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # 寫入途中當機造成的半行記錄，直接略過
+            return
+        if "u" not in entry:
+            return  # 日誌檔頭 {"gen": N}
+        user_id = entry["u"]
+        if entry.get("del"):
+            self._data.pop(user_id, None)
+            self._encoded.pop(user_id, None)
+        else:
+            record = entry["d"]
+            self._data[user_id] = record
+            self._encoded[user_id] = json.dumps(record, ensure_ascii=False)
+
+    @staticmethod
+    def _truncate_partial_tail(path):
+        """截掉當機留下的半行，避免下一筆追加接在殘行後面"""
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            f.seek(max(0, size - (1 << 16)))
+            tail = f.read()
+            if tail.endswith(b"\n"):
+                return
+            cut = tail.rfind(b"\n")
+            f.truncate(size - len(tail) + cut + 1 if cut >= 0 else max(0, size - len(tail)))
+
+    def _open_journal(self, new_gen=None):
+        """(重新) 開啟目前的日誌檔，讀取位置歸零
+
+        new_gen 不為 None 時表示剛輪替出新日誌 (持有獨佔鎖)，先寫入
+        檔頭 {"gen": N}；其他行程據此判斷是否錯過了中間的日誌。
+        """
+        for fd in (self._journal_fd, self._read_fd):
+            if fd is not None:
+                os.close(fd)
+        self._journal_fd = os.open(
+            self.journal_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        if new_gen is not None:
+            os.write(self._journal_fd, ('{"gen": %d}\n' % new_gen).encode())
+        self._read_fd = os.open(self.journal_path, os.O_RDONLY)
+        self._read_offset = 0
+        self._pid = os.getpid()
+        head = os.pread(self._read_fd, 64, 0)
+        if head.startswith(b'{"gen": '):
+            self._gen = int(head[8:head.index(b"}")])
+        else:
+            self._gen = 0  # 舊版或第一份日誌沒有檔頭
+
+    # ---------- 跨行程同步 ----------
+
+    def _read_tail(self):
+        """套用日誌中尚未讀到的完整記錄，回傳筆數"""
+        count = 0
+        size = 1 << 20
+        while True:
+            chunk = os.pread(self._read_fd, size, self._read_offset)
+            if not chunk:
+                break
+            end = chunk.rfind(b"\n")
+            if end < 0:
+                if len(chunk) < size:
+                    break  # 其他行程正在寫入的半行，下次再讀
+                size *= 2
+                continue
+            for line in chunk[:end + 1].splitlines():
+                self._apply_line(line)
+                count += 1
+            self._read_offset += end + 1
+        return count
+
+    def _catch_up(self):
+        """讀取其他行程的新記錄；日誌被輪替時改追新的日誌檔
+
+        呼叫端須持有 self._lock 與鎖檔第 0 位元組的共享鎖。
+        """
+        if self._read_fd is None:
+            self._open_journal()
+        elif self._pid != os.getpid():
+            # fork 後與父行程共用的 fd 會共用檔案位置，追加用的 fd 需各自開啟
+            os.close(self._journal_fd)
+            self._journal_fd = os.open(
+                self.journal_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self._pid = os.getpid()
+        count = self._read_tail()
+        try:
+            current = os.stat(self.journal_path).st_ino
+        except FileNotFoundError:
+            current = None
+        if current != os.fstat(self._read_fd).st_ino:
+            # 舊日誌已讀完 (輪替後不會再有寫入)，接著讀新日誌
+            previous_gen = self._gen
+            self._open_journal()
+            if self._gen != previous_gen + 1:
+                # 中間錯過了一次以上的輪替，改從快照重建
+                self._reload()
+                return
+            self._journal_records = 0
+            count += self._read_tail()
+        self._journal_records += count
+        if self._journal_records >= self.compact_threshold:
+            self._request_compaction()
+
+    def sync(self):
+        """同步其他行程寫入的變更，回傳 userId → 記錄 的 dict"""
+        with self._lock, self.lock_file.hold(ROTATE_LOCK_BYTE, exclusive=False):
+            self._catch_up()
+        return self._data
+
+    # ---------- 寫入 ----------
+
+    def record(self, user_id, record):
+        """記錄單一用戶的最新狀態；record 為 None 表示刪除該用戶"""
+        if record is None:
+            encoded = None
+            line = json.dumps({"u": user_id, "del": True}, ensure_ascii=False)
+        else:
+            encoded = json.dumps(record, ensure_ascii=False)
+            line = '{"u": %s, "d": %s}' % (json.dumps(user_id), encoded)
+        data = (line + "\n").encode('utf-8')
+
+        with self._lock, self.lock_file.hold(ROTATE_LOCK_BYTE, exclusive=False):
+            self._catch_up()
+            os.write(self._journal_fd, data)
+            if self.fsync:
+                os.fsync(self._journal_fd)
+            # O_APPEND 寫入後檔案位置即為這筆記錄的結尾；若中間沒有其他
+            # 行程的記錄，直接跳過自己剛寫的這一行，不必再解析一次
+            end = os.lseek(self._journal_fd, 0, os.SEEK_CUR)
+            if end - len(data) == self._read_offset:
+                self._read_offset = end
+            if encoded is None:
+                self._data.pop(user_id, None)
+                self._encoded.pop(user_id, None)
+            else:
+                self._data[user_id] = record
+                self._encoded[user_id] = encoded
+            self._journal_records += 1
+            if self._journal_records >= self.compact_threshold:
+                self._request_compaction()
+
+    # ---------- 壓縮 ----------
+
+    def _request_compaction(self):
+        self._start_compactor()
+        self._compact_event.set()
+
+    def _start_compactor(self):
+        # fork 之後背景執行緒不會被複製，需在子行程重新啟動
+        if self._stopped or (self._compactor is not None and self._compactor.is_alive()):
+            return
+        self._compactor = threading.Thread(
+            target=self._compact_loop, name="user-store-compactor", daemon=True)
+        self._compactor.start()
+
+    def _compact_loop(self):
+        while True:
+            self._compact_event.wait()
+            self._compact_event.clear()
+            with self._lock:
+                if self._stopped:
+                    return
+            try:
+                self.compact()
+            except Exception:
+                log.exception("compaction_failed")
+
+    def compact(self):
+        """把目前狀態寫成新快照並清空日誌
+
+        持鎖期間只做日誌輪替與參照複製 (O(用戶數) 的指標複製)，
+        JSON 組裝與磁碟寫入都在鎖外進行，不會阻塞 webhook 寫入。
+        其他行程正在壓縮時直接略過，回傳 False；同一行程的其他執行緒正在
+        壓縮時等它完成後再壓縮一次。
+        """
+        with self._compact_lock, self.lock_file.hold(COMPACT_LOCK_BYTE, blocking=False) as acquired:
+            if not acquired:
+                return False
+            with self._lock, self.lock_file.hold(ROTATE_LOCK_BYTE):
+                if self._stopped:
+                    return False
+                self._catch_up()
+                if os.path.exists(self.compacting_path):
+                    # 上一輪壓縮未完成，先把剩餘日誌併入
+                    self._append_file(self.journal_path, self.compacting_path)
+                elif os.path.exists(self.journal_path):
+                    os.replace(self.journal_path, self.compacting_path)
+                self._open_journal(new_gen=self._gen + 1)
+                self._journal_records = 0
+                items = list(self._encoded.items())
+                self._compact_done.clear()
+
+            try:
+                tmp_path = f"{self.snapshot_path}.tmp.{os.getpid()}"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write("{")
+                    for i, (user_id, encoded) in enumerate(items):
+                        if i:
+                            f.write(",\n")
+                        f.write(json.dumps(user_id))
+                        f.write(": ")
+                        f.write(encoded)
+                    f.write("}\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.snapshot_path)
+                with self._lock, self.lock_file.hold(ROTATE_LOCK_BYTE):
+                    if os.path.exists(self.compacting_path):
+                        os.remove(self.compacting_path)
+            finally:
+                self._compact_done.set()
+            return True
+
+    @staticmethod
+    def _append_file(src, dst):
+        if not os.path.exists(src):
+            return
+        with open(src, 'rb') as s, open(dst, 'ab') as d:
+            while True:
+                chunk = s.read(1 << 16)
+                if not chunk:
+                    break
+                d.write(chunk)
+        os.remove(src)
+
+    def close(self):
+        """停止背景壓縮 (等進行中的壓縮完成) 並關閉日誌檔
+
+        已要求但尚未開始的壓縮不再執行；否則它會在日誌檔關閉後重新開啟日誌，
+        同一行程重新開啟的 store 也可能被它刪掉暫存快照。
+        """
+        with self._lock:
+            self._stopped = True
+        self._compact_event.set()
+        compactor = self._compactor
+        if compactor is not None and compactor is not threading.current_thread():
+            compactor.join()
+        # 其他執行緒直接呼叫 compact() 時也要等它寫完快照
+        self._compact_done.wait()
+        with self._lock:
+            for fd in (self._journal_fd, self._read_fd):
+                if fd is not None:
+                    os.close(fd)
+            self._journal_fd = None
+            self._read_fd = None
+
+
+class UserStore:
+    """用戶存儲介面
+
+    記錄格式：{"status": ..., "first_contact": ..., 其他時間欄位...}
+    血糖記錄不放在用戶記錄內，另以 append_blood_sugar / get_blood_sugar 存取。
+    """
+
+    def get(self, user_id):
+        """取得用戶記錄，不存在時回傳 None"""
+        raise NotImplementedError
+
+    def put(self, user_id, record):
+        """寫入 (覆蓋) 整筆用戶記錄，不影響血糖記錄"""
+        raise NotImplementedError
+
+    def create(self, user_id, record):
+        """建立 (或重設) 用戶：寫入記錄並清除既有的血糖記錄 (重新加好友時)"""
+        raise NotImplementedError
+
+    def update_status(self, user_id, status, **fields):
+        """更新用戶狀態，並一併寫入額外欄位 (如 agreed_time)"""
+        raise NotImplementedError
+
+    def append_blood_sugar(self, user_id, timestamp, mg_dl, meal=MEAL_UNKNOWN):
+        """新增一筆血糖記錄 (毫秒時間戳、mg/dL、餐次)"""
+        raise NotImplementedError
+
+    def append_blood_sugar_many(self, user_id, rows):
+        """批次新增血糖記錄 [(毫秒時間戳, mg/dL, 餐次), ...]，回傳寫入筆數"""
+        raise NotImplementedError
+
+    def iter_blood_sugar(self, user_id, batch_size=8192):
+        """逐批產出用戶的血糖記錄 (依寫入順序)，不載入整個序列"""
+        raise NotImplementedError
+
+    def get_blood_sugar(self, user_id):
+        """取得用戶的血糖時間序列 (BloodSugarSeries，依寫入順序)
+
+        序列只會在尾端追加 (用戶刪除後重建除外)，呼叫端可用已處理的筆數
+        作為游標，只處理新增的記錄。
+        """
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        """刪除用戶與其所有資料"""
+        raise NotImplementedError
+
+    def lock(self, user_id):
+        """取得單一用戶的互斥鎖 (行程內 + 跨 worker)
+
+        同一用戶的「讀取狀態 → 轉移 → 寫入」須在此鎖內完成，
+        避免多個 worker 同時處理同一用戶時互相覆蓋。
+        """
+        return self._user_locks.hold(user_id)
+
+    def close(self):
+        pass
+
+
+class JsonUserStore(UserStore):
+    """JSON 檔案後端 (快照 + 追加式日誌)"""
+
+    def __init__(self, snapshot_path, journal_path=None, blood_sugar_dir=None, **kwargs):
+        lock_file = LockFile(snapshot_path + ".lock")
+        self._engine = JournaledUserStore(
+            snapshot_path, journal_path, lock_file=lock_file, **kwargs)
+        self._engine.load()
+        self._user_locks = UserLocks(lock_file)
+        # 血糖記錄以每位用戶一個二進位追加檔存放，不進快照與日誌
+        self._blood_sugar = BloodSugarLog(
+            blood_sugar_dir or os.path.splitext(snapshot_path)[0] + ".blood_sugar")
+
+    # 記錄一律整筆替換 (不就地修改)，其他執行緒持有的舊參照不受影響
+
+    def get(self, user_id):
+        record = self._engine.sync().get(user_id)
+        return dict(record) if record is not None else None
+
+    def put(self, user_id, record):
+        record = dict(record)
+        record.pop("blood_sugar_records", None)
+        self._engine.record(user_id, record)
+
+    def create(self, user_id, record):
+        self._blood_sugar.delete(user_id)
+        self.put(user_id, record)
+
+    def update_status(self, user_id, status, **fields):
+        record = self._engine.sync().get(user_id)
+        if record is None:
+            return
+        record = dict(record, status=status, **fields)
+        self._engine.record(user_id, record)
+
+    def append_blood_sugar(self, user_id, timestamp, mg_dl, meal=MEAL_UNKNOWN):
+        if user_id not in self._engine.sync():
+            return
+        self._blood_sugar.append(user_id, timestamp, mg_dl, meal)
+
+    def append_blood_sugar_many(self, user_id, rows):
+        if user_id not in self._engine.sync():
+            return 0
+        rows = list(rows)
+        self._blood_sugar.append_many(user_id, rows)
+        return len(rows)
+
+    def iter_blood_sugar(self, user_id, batch_size=8192):
+        return self._blood_sugar.iter_rows(user_id, batch_size)
+
+    def get_blood_sugar(self, user_id):
+        return self._blood_sugar.get(user_id)
+
+    def delete(self, user_id):
+        self._blood_sugar.delete(user_id)
+        if user_id in self._engine.sync():
+            self._engine.record(user_id, None)
+
+    def close(self):
+        self._engine.close()
+        self._engine.lock_file.close()
+
+
+class SqliteUserStore(UserStore):
+    """SQLite 後端
+
+    以 WAL 模式開啟，讀寫可並行；每個執行緒使用自己的連線。
+    先讀後寫的交易以 BEGIN IMMEDIATE 開始：一般的 BEGIN 先取得讀取快照，
+    其他行程在中間提交時升級為寫入會直接失敗 (SQLITE_BUSY_SNAPSHOT，
+    busy_timeout 不會重試)。
+    users 以 user_id 為主鍵 (WITHOUT ROWID，即 B-tree 索引本身)，
+    另對 status 建索引；血糖記錄獨立成表 (整數欄位)，以 user_id 建索引
+    (索引內依 rowid 排序，讀取新增的記錄只需範圍掃描)。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            data TEXT NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_users_status ON users(status);
+        CREATE TABLE IF NOT EXISTS blood_sugar (
+            user_id TEXT NOT NULL,
+            recorded_at INTEGER NOT NULL,
+            mg_dl INTEGER NOT NULL,
+            meal INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_blood_sugar_user ON blood_sugar(user_id);
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._user_locks = UserLocks(LockFile(db_path + ".lock"))
+        # userId → (序列, 第一筆的 rowid, 最後一筆的 rowid)
+        self._series_cache = OrderedDict()
+        self._series_lock = threading.Lock()
+        self.series_cache_size = 1024
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            # SQLite 連線不可跨 fork 使用，子行程需重新連線
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, user_id):
+        row = self._conn().execute(
+            "SELECT status, data FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        record = json.loads(row[1])
+        record["status"] = row[0]
+        return record
+
+    def put(self, user_id, record):
+        self._put(self._conn(), user_id, record)
+
+    @staticmethod
+    def _put(conn, user_id, record):
+        record = dict(record)
+        record.pop("blood_sugar_records", None)
+        status = record.pop("status", "pending")
+        conn.execute(
+            "INSERT OR REPLACE INTO users (user_id, status, data) VALUES (?, ?, ?)",
+            (user_id, status, json.dumps(record, ensure_ascii=False))
+        )
+
+    def create(self, user_id, record):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM blood_sugar WHERE user_id = ?", (user_id,))
+            self._put(conn, user_id, record)
+        self._forget_series(user_id)
+
+    def update_status(self, user_id, status, **fields):
+        conn = self._conn()
+        if not fields:
+            conn.execute(
+                "UPDATE users SET status = ? WHERE user_id = ?", (status, user_id))
+            return
+        conn.execute(
+            "UPDATE users SET status = ?, data = json_patch(data, ?) WHERE user_id = ?",
+            (status, json.dumps(fields, ensure_ascii=False), user_id)
+        )
+
+    def append_blood_sugar(self, user_id, timestamp, mg_dl, meal=MEAL_UNKNOWN):
+        # 與 JSON 後端一致：不存在的用戶不記錄 (避免留下沒有用戶的血糖記錄)
+        self._conn().execute(
+            "INSERT INTO blood_sugar (user_id, recorded_at, mg_dl, meal) "
+            "SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE user_id = ?)",
+            (user_id, timestamp, mg_dl, meal, user_id)
+        )
+
+    def append_blood_sugar_many(self, user_id, rows):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is None:
+                return 0
+            cursor = conn.executemany(
+                "INSERT INTO blood_sugar (user_id, recorded_at, mg_dl, meal) VALUES (?, ?, ?, ?)",
+                ((user_id, timestamp, mg_dl, meal) for timestamp, mg_dl, meal in rows)
+            )
+            return cursor.rowcount
+
+    def iter_blood_sugar(self, user_id, batch_size=8192):
+        cursor = self._conn().execute(
+            "SELECT recorded_at, mg_dl, meal FROM blood_sugar WHERE user_id = ? ORDER BY rowid",
+            (user_id,)
+        )
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            cursor.close()
+
+    def get_blood_sugar(self, user_id):
+        conn = self._conn()
+        first = conn.execute(
+            "SELECT min(rowid) FROM blood_sugar WHERE user_id = ?", (user_id,)
+        ).fetchone()[0]
+        with self._series_lock:
+            series, first_rowid, last_rowid = self._series_cache.get(user_id, (None, None, 0))
+        if first is None:
+            self._forget_series(user_id)
+            return BloodSugarSeries()
+        if series is None or first != first_rowid:
+            # 首次讀取，或用戶已被 (其他 worker) 刪除後重建
+            series, last_rowid = BloodSugarSeries(), 0
+        rows = conn.execute(
+            "SELECT rowid, recorded_at, mg_dl, meal FROM blood_sugar "
+            "WHERE user_id = ? AND rowid > ? ORDER BY rowid",
+            (user_id, last_rowid)
+        )
+        for last_rowid, timestamp, mg_dl, meal in rows:
+            series.append(timestamp, mg_dl, meal)
+        with self._series_lock:
+            self._series_cache[user_id] = (series, first, last_rowid)
+            self._series_cache.move_to_end(user_id)
+            while len(self._series_cache) > self.series_cache_size:
+                self._series_cache.popitem(last=False)
+        return series
+
+    def _forget_series(self, user_id):
+        with self._series_lock:
+            self._series_cache.pop(user_id, None)
+
+    def delete(self, user_id):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM blood_sugar WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+        self._forget_series(user_id)
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def create_user_store(backend, json_path, journal_path=None, db_path=None, **kwargs):
+    """依設定建立用戶存儲後端 (json / sqlite)"""
+    if backend == "sqlite":
+        return SqliteUserStore(db_path or os.path.splitext(json_path)[0] + ".db")
+    if backend == "json":
+        return JsonUserStore(json_path, journal_path, **kwargs)
+    raise ValueError(f"未知的用戶存儲後端: {backend}")
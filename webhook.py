@@ -0,0 +1,88 @@
+"""Webhook 請求解析
+
+/callback 的單一入口：對原始位元組做一次 HMAC 簽章驗證、一次 JSON 解析，
+再轉成輕量的 WebhookEvent 物件交給狀態機，不再經過 SDK 的 WebhookHandler
+重複解析與驗證。有安裝 orjson 時自動改用較快的解析器。
+"""
+import base64
+import hashlib
+import hmac
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def verify_signature(secret, body, signature):
+    """驗證 X-Line-Signature (HMAC-SHA256, base64)，以固定時間比較
+
+    secret 與 body 皆為 bytes。
+    """
+    if not signature:
+        return False
+    digest = hmac.new(secret, body, hashlib.sha256).digest()
+    try:
+        expected = base64.b64decode(signature, validate=True)
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest, expected)
+
+
+def loads(body):
+    """解析 JSON (bytes)；有 orjson 時使用 orjson"""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def _object(value):
+    """JSON 物件欄位；型別不符時視為空物件"""
+    return value if isinstance(value, dict) else {}
+
+
+class WebhookEvent:
+    """狀態機使用的事件欄位"""
+
+    __slots__ = (
+        "type", "user_id", "source_key", "reply_token", "timestamp",
+        "webhook_event_id", "is_redelivery",
+        "message_type", "message_id", "text", "raw",
+    )
+
+    def __init__(self, raw):
+        source = _object(raw.get("source"))
+        message = _object(raw.get("message"))
+        delivery = _object(raw.get("deliveryContext"))
+        self.type = raw.get("type")
+        self.user_id = source.get("userId")
+        # 分組鍵：userId，沒有時退而使用群組 / 聊天室 ID
+        self.source_key = self.user_id or source.get("groupId") or source.get("roomId")
+        self.reply_token = raw.get("replyToken")
+        self.timestamp = raw.get("timestamp")
+        self.webhook_event_id = raw.get("webhookEventId")
+        self.is_redelivery = bool(delivery.get("isRedelivery"))
+        self.message_type = message.get("type")
+        self.message_id = message.get("id")
+        self.text = message.get("text")
+        self.raw = raw
+
+    def __repr__(self):
+        return (f"WebhookEvent(type={self.type!r}, user_id={self.user_id!r}, "
+                f"message_type={self.message_type!r})")
+
+
+def parse_events(body):
+    """把 webhook 內容 (bytes) 解析成 WebhookEvent 列表
+
+    內容不是 JSON 時拋出 ValueError；不是物件、沒有 events 陣列時回傳空列表，
+    陣列中不是物件的元素略過。
+    """
+    payload = loads(body)
+    if not isinstance(payload, dict):
+        return []
+    events = payload.get("events")
+    if not isinstance(events, list):
+        return []
+    return [WebhookEvent(raw) for raw in events if isinstance(raw, dict)]